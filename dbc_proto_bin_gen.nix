@@ -21,5 +21,6 @@ pkgs.stdenv.mkDerivation rec {
     mkdir -p $out/bin
     cp hytech.proto $out/proto
     cp hytech.bin $out/bin
+    cp hytech_pack.py $out/bin
   '';
 }
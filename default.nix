@@ -22,6 +22,8 @@ python311Packages.buildPythonApplication {
     asyncudp_pkg
     python311Packages.lz4
     python311Packages.zstandard
+    python311Packages.numpy
+    python311Packages.pyarrow
     py_foxglove_websocket_pkg
     python311Packages.protobuf
     mcap_support_pkg
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import random
+import cantools
+
+import py_data_acq.common.protobuf_helpers as pb_helpers
+from py_data_acq.common.common_types import QueueData
+from py_data_acq.common.decode_plan import DecodePlan
+
+# how many synthetic frames to push through each path
+NUM_FRAMES = 200000
+
+
+# this is what can_receiver did per frame before the decode plan
+def cantools_path(db, message_classes, frames):
+    for frame_id, data in frames:
+        try:
+            decoded_msg = db.decode_message(frame_id, data, decode_containers=True)
+            msg = db.get_message_by_frame_id(frame_id)
+            msg = pb_helpers.pack_protobuf_msg(decoded_msg, msg.name.lower(), message_classes)
+            QueueData(msg.DESCRIPTOR.name, msg)
+        except:
+            pass
+
+
+def decode_plan_path(decode_plan, frames):
+    for frame_id, data in frames:
+        msg = decode_plan.pack(frame_id, data)
+        if msg is not None:
+            QueueData(msg.DESCRIPTOR.name, msg)
+
+
+def time_frames_per_sec(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return NUM_FRAMES / (time.perf_counter() - start)
+
+
+def main():
+    # Same DBC as test.py / runner.py
+    if len(sys.argv) > 1:
+        path_to_dbc = sys.argv[1]
+    else:
+        path_to_dbc = os.environ.get("DBC_PATH")
+    db = cantools.db.load_file(os.path.join(path_to_dbc, "car.dbc"))
+    list_of_msg_names, msg_pb_classes = pb_helpers.get_msg_names_and_classes()
+
+    # Random payloads for every message that has a protobuf class, so each frame id gets exercised
+    random.seed(0)
+    messages = [msg for msg in db.messages if msg.name.lower() in msg_pb_classes]
+    frames = []
+    for _ in range(NUM_FRAMES):
+        msg = random.choice(messages)
+        frames.append((msg.frame_id, bytes(random.getrandbits(8) for _ in range(msg.length))))
+
+    start = time.perf_counter()
+    decode_plan = DecodePlan(db, msg_pb_classes)
+    print(f"decode plan for {len(decode_plan.frames)} frame ids built in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    before = time_frames_per_sec(cantools_path, db, msg_pb_classes, frames)
+    after = time_frames_per_sec(decode_plan_path, decode_plan, frames)
+    print(f"cantools + pack_protobuf_msg: {before:,.0f} frames/sec")
+    # the packers dbc_to_proto.py generates, from BIN_PATH like runner.py
+    if pb_helpers.load_generated_packers(os.environ.get("BIN_PATH", "")):
+        generated = time_frames_per_sec(cantools_path, db, msg_pb_classes, frames)
+        print(f"cantools + generated packers: {generated:,.0f} frames/sec")
+    print(f"decode plan:                  {after:,.0f} frames/sec")
+    print(f"speedup:                      {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
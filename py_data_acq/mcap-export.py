@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import argparse
+
+from py_data_acq.mcap_writer.export import export_recording
+from py_data_acq.mcap_writer.recordings import RecordingReader
+
+
+# usage: mcap-export.py <recording> [output dir] [--topics ...] [--start s] [--end s] [--format arrow]
+# writes one parquet (or arrow) table per message type, with the log_time column as the time index,
+# e.g. pandas.read_parquet("out/BMS_Status.parquet").set_index("log_time")
+def main():
+    parser = argparse.ArgumentParser(description="Export a recording to one columnar table per message type")
+    parser.add_argument("recording")
+    parser.add_argument("output", nargs="?", help="output directory, the recording's name without .mcap by default")
+    parser.add_argument("--topics", help="comma separated topics or message names, all of them by default")
+    parser.add_argument("--start", type=float, help="seconds from the start of the recording")
+    parser.add_argument("--end", type=float, help="seconds from the start of the recording")
+    parser.add_argument("--format", default="parquet", choices=("parquet", "arrow"))
+    parser.add_argument("--workers", type=int, help="decode processes, one per cpu by default")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.recording)[0]
+    topics = [topic.strip() for topic in args.topics.split(",")] if args.topics else None
+    start_time = end_time = None
+    if args.start is not None or args.end is not None:
+        reader = RecordingReader(args.recording)
+        if args.start is not None:
+            start_time = reader.start_time + int(args.start * 1e9)
+        if args.end is not None:
+            end_time = reader.start_time + int(args.end * 1e9)
+        reader.close()
+
+    started = time.perf_counter()
+    rows = export_recording(args.recording, output, topics, start_time, end_time, args.format, args.workers)
+    elapsed = time.perf_counter() - started
+    for name, count in sorted(rows.items()):
+        print(f"{name}: {count} rows")
+    print(f"exported {sum(rows.values())} rows to {output} in {elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+import sys
+import os
+from py_data_acq.mcap_writer.recovery import recover_mcap
+from py_data_acq.mcap_writer.writer import PARTIAL_SUFFIX
+
+
+# usage: mcap-recover.py <recording> [output]
+# rebuilds the index / summary of a recording that was cut off, by default a .mcap.part segment
+# left behind by a power cut is recovered to the .mcap name it would have been finalized as
+def main():
+    if len(sys.argv) < 2:
+        print("usage: mcap-recover.py <recording> [output]")
+        sys.exit(1)
+    input_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        output_path = sys.argv[2]
+    elif input_path.endswith(PARTIAL_SUFFIX):
+        output_path = input_path[: -len(PARTIAL_SUFFIX)]
+    else:
+        output_path = os.path.splitext(input_path)[0] + "_recovered.mcap"
+
+    result = recover_mcap(input_path, output_path)
+    print(
+        f"recovered {result['messages']} messages in {result['chunks']} chunks "
+        f"({result['recovered_bytes']} of {os.path.getsize(input_path)} bytes) to {output_path}"
+    )
+    if result["complete"]:
+        print("input was not truncated, its data section was complete")
+
+
+if __name__ == "__main__":
+    main()
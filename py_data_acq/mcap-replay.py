@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import os
+import sys
+import asyncio
+
+import py_data_acq.common.protobuf_helpers as pb_helpers
+from py_data_acq.common.common_types import parse_channel_topic
+from py_data_acq.foxglove_live.foxglove_ws import HTProtobufFoxgloveServer
+from py_data_acq.foxglove_live.replay import REPLAY_CAPABILITIES, ReplayControl, ReplayPlayer
+from py_data_acq.mcap_writer.recordings import RecordingReader
+
+
+# usage: mcap-replay.py <recording> [speed]
+# serves a recording on the same foxglove channels as the live data so the same layouts work,
+# speed 1 is real time, 2 twice as fast and 0 as fast as the websocket takes it. replay_time
+# (seconds from the start), replay_speed and replay_paused in foxglove's parameters panel seek,
+# change speed and pause. BIN_PATH and FOXGLOVE_MAX_HZ are the same as for runner.py
+async def replay(recording_path, speed):
+    reader = RecordingReader(recording_path)
+    list_of_msg_names, _ = pb_helpers.get_msg_names_and_classes()
+    bus_names = sorted({
+        bus for _, bus in (parse_channel_topic(channel.topic) for channel in reader.channels.values()) if bus
+    })
+    foxglove_max_hz = float(os.environ.get("FOXGLOVE_MAX_HZ", "30"))
+    fx_s = HTProtobufFoxgloveServer(
+        "0.0.0.0",
+        8765,
+        "asdf",
+        os.path.join(os.environ.get("BIN_PATH", "."), "hytech.bin"),
+        list_of_msg_names,
+        max_rate_hz=foxglove_max_hz if foxglove_max_hz > 0 else None,
+        bus_names=bus_names or None,
+        capabilities=REPLAY_CAPABILITIES,
+    )
+    player = ReplayPlayer(reader, fx_s, speed=speed)
+    fx_s.set_listener(ReplayControl(fx_s, player))
+    print(
+        f"replaying {recording_path}, {(reader.end_time - reader.start_time) / 1e9:.1f} s "
+        f"in {len(reader.chunk_indexes)} chunks at {speed}x"
+    )
+    try:
+        async with fx_s:
+            await asyncio.gather(player.run(), player.publish_parameters())
+    finally:
+        reader.close()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: mcap-replay.py <recording> [speed]")
+        sys.exit(1)
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    asyncio.run(replay(sys.argv[1], speed))
+
+
+if __name__ == "__main__":
+    main()
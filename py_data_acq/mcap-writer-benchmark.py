@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+import cantools
+
+import py_data_acq.common.protobuf_helpers as pb_helpers
+from py_data_acq.common.common_types import QueueData
+from py_data_acq.common.decode_plan import DecodePlan
+from py_data_acq.common.fanout_bus import FanoutBus, BLOCK
+from py_data_acq.common.loop_monitor import LoopLagMonitor
+from py_data_acq.mcap_writer.writer import HTPBMcapWriter
+
+# frames per second the fake receiver puts on the bus, and for how long
+FRAME_RATE = 5000
+DURATION = 5.0
+
+
+async def fake_receiver(bus, frames):
+    # put frames on the bus in 1 ms bursts to get roughly FRAME_RATE
+    per_tick = max(1, FRAME_RATE // 1000)
+    index = 0
+    while True:
+        for _ in range(per_tick):
+            await bus.put(frames[index % len(frames)])
+            index += 1
+        await asyncio.sleep(0.001)
+
+
+async def run_writer(frames, msg_names, msg_classes, threaded, compression):
+    bus = FanoutBus()
+    mcap_queue = bus.subscribe("mcap", policy=BLOCK)
+    monitor = LoopLagMonitor()
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        writer = HTPBMcapWriter(out_dir, msg_names, msg_classes, threaded=threaded, compression=compression)
+
+        async def write_forever():
+            async with writer as mcw:
+                while True:
+                    await mcw.write_data(mcap_queue)
+
+        tasks = [
+            asyncio.create_task(monitor.run()),
+            asyncio.create_task(fake_receiver(bus, frames)),
+            asyncio.create_task(write_forever()),
+        ]
+        await asyncio.sleep(DURATION)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        written = mcap_queue.delivered
+        size = os.path.getsize(writer.actual_path)
+    return monitor.summary(), written, size
+
+
+def main():
+    # Same DBC as test.py / runner.py
+    if len(sys.argv) > 1:
+        path_to_dbc = sys.argv[1]
+    else:
+        path_to_dbc = os.environ.get("DBC_PATH")
+    db = cantools.db.load_file(os.path.join(path_to_dbc, "car.dbc"))
+    list_of_msg_names, msg_pb_classes = pb_helpers.get_msg_names_and_classes()
+    decode_plan = DecodePlan(db, msg_pb_classes)
+
+    random.seed(0)
+    frames = []
+    for _ in range(10000):
+        frame_id = random.choice(list(decode_plan.frames.keys()))
+        msg = decode_plan.pack(frame_id, bytes(random.getrandbits(8) for _ in range(8)))
+        if msg is not None:
+            frames.append(QueueData(msg.DESCRIPTOR.name, msg))
+
+    for compression in ("zstd", "lz4"):
+        for threaded in (False, True):
+            lag, written, size = asyncio.run(
+                run_writer(frames, list_of_msg_names, msg_pb_classes, threaded, compression)
+            )
+            mode = "writer thread" if threaded else "on event loop"
+            print(
+                f"{compression:>4} {mode:>13}: {written / DURATION:,.0f} msgs/sec, {size / 1e6:.1f} MB, "
+                f"loop lag p50 {lag['p50_ms']:.2f} ms p99 {lag['p99_ms']:.2f} ms max {lag['max_ms']:.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+import can
+import cantools
+from mcap.reader import make_reader
+from mcap_protobuf.decoder import DecoderFactory
+
+import py_data_acq.common.protobuf_helpers as pb_helpers
+from py_data_acq.common.common_types import QueueData
+from py_data_acq.common.decode_plan import DecodePlan, create_field_name
+from py_data_acq.common.batch_decode import BatchDecoder
+from py_data_acq.common.fanout_bus import FanoutBus, BLOCK
+from py_data_acq.common.clock import wall_time_ns
+from py_data_acq.common.latency import StageLatency
+from py_data_acq.common.loop_monitor import LoopLagMonitor
+from py_data_acq.common.metrics import registry
+from py_data_acq.io_handler.can_handle import can_receiver
+from py_data_acq.mcap_writer.writer import HTPBMcapWriter
+
+# usage: pipeline-benchmark.py <dbc dir> [options], see --help
+#
+# Pushes frames through decode -> fanout bus -> mcap writer and reports sustained frames/sec,
+# receive to write latency, cpu and memory, saved as json so runs on different commits can be
+# compared. Frames are made up for every message in the DBC or replayed from a recorded mcap /
+# candump log, and either handed straight to the decoder (--feed inprocess) or sent over a real
+# python-can bus from another process and read back by can_receiver (--feed socketcan:vcan0).
+
+# rate of messages the DBC has no cycle time for
+DEFAULT_RATE = 100.0
+# how many random payloads are made per message for the synthetic source
+PAYLOADS_PER_MESSAGE = 256
+# how often the paced sources put frames out
+TICK = 0.001
+# most frames a source hands over at once when running as fast as it can
+MAX_STEP = 512
+# latency samples kept per stage, enough for the whole measured window of most runs
+LATENCY_HISTORY = 500000
+
+
+class SyntheticSource:
+    """Random payloads for every message at its own rate, interleaved in time order"""
+
+    def __init__(self, db, frame_ids, rates):
+        rng = random.Random(0)
+        self.messages = []
+        for msg in db.messages:
+            rate = rates.get(msg.name, 0)
+            if msg.frame_id not in frame_ids or rate <= 0:
+                continue
+            payloads = [rng.randbytes(msg.length) for _ in range(PAYLOADS_PER_MESSAGE)]
+            self.messages.append((msg.frame_id, rate, payloads))
+        self.sent = [0] * len(self.messages)
+        self.total_rate = sum(rate for _, rate, _ in self.messages)
+        self.time = 0.0
+        self.done = not self.messages
+
+    def take(self, until: float, limit: int) -> list:
+        # as fast as possible just moves time on by about limit frames
+        if math.isinf(until):
+            until = self.time + limit / self.total_rate
+        due = []
+        for index, (frame_id, rate, payloads) in enumerate(self.messages):
+            target = int(until * rate)
+            for count in range(self.sent[index], target):
+                due.append((count / rate, frame_id, payloads[count % PAYLOADS_PER_MESSAGE]))
+            self.sent[index] = max(self.sent[index], target)
+        self.time = until
+        due.sort(key=lambda frame: frame[0])
+        return [(frame_id, data) for _, frame_id, data in due]
+
+
+class ReplaySource:
+    """Frames of a recorded log at the times they were recorded, relative to the first one"""
+
+    def __init__(self, frames):
+        self.frames = iter(frames)
+        self.next_frame = next(self.frames, None)
+        self.done = self.next_frame is None
+
+    def take(self, until: float, limit: int) -> list:
+        frames = []
+        while self.next_frame is not None and self.next_frame[0] <= until and len(frames) < limit:
+            frames.append(self.next_frame[1:])
+            self.next_frame = next(self.frames, None)
+        self.done = self.next_frame is None
+        return frames
+
+
+def candump_frames(path: str):
+    # anything python-can reads: candump -l .log, .asc, .blf, .csv, .trc
+    first = None
+    for msg in can.LogReader(path):
+        if msg.is_error_frame or msg.is_remote_frame:
+            continue
+        if first is None:
+            first = msg.timestamp
+        yield msg.timestamp - first, msg.arbitration_id, bytes(msg.data)
+
+
+def _signal_value(value):
+    # choice signals are strings in the protobuf, and so are values that werent in the choices
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def mcap_frames(path: str, db):
+    # the recording only has the decoded messages, they get encoded back into frames with the DBC
+    can_msgs = {msg.name.lower(): msg for msg in db.messages}
+    first = None
+    skipped = 0
+    with open(path, "rb") as f:
+        reader = make_reader(f, decoder_factories=[DecoderFactory()])
+        for schema, channel, message, pb_msg in reader.iter_decoded_messages(log_time_order=True):
+            can_msg = can_msgs.get(schema.name.lower())
+            if can_msg is None:
+                continue
+            values = {}
+            for signal in can_msg.signals:
+                field = create_field_name(signal.name)
+                if hasattr(pb_msg, field):
+                    values[signal.name] = _signal_value(getattr(pb_msg, field))
+            try:
+                data = can_msg.encode(values, strict=False)
+            except (KeyError, ValueError, cantools.database.EncodeError):
+                skipped += 1
+                continue
+            if first is None:
+                first = message.log_time
+            yield (message.log_time - first) / 1e9, can_msg.frame_id, data
+    if skipped:
+        print(f"{skipped} messages of {path} could not be encoded back into frames")
+
+
+def make_source(spec: dict):
+    """Sources are built from a plain dict so the sender process can make its own"""
+    db = cantools.db.load_file(spec["dbc"])
+    if spec["kind"] == "synthetic":
+        return SyntheticSource(db, set(spec["frame_ids"]), spec["rates"])
+    # logs are read in up front so reading them doesnt count against the pipeline
+    if spec["path"].endswith(".mcap"):
+        return ReplaySource(list(mcap_frames(spec["path"], db)))
+    return ReplaySource(list(candump_frames(spec["path"])))
+
+
+def message_rates(db, rate: float, overrides: dict) -> dict:
+    # --rates beats --rate beats the cycle time in the DBC
+    rates = {}
+    for msg in db.messages:
+        if msg.name in overrides:
+            rates[msg.name] = overrides[msg.name]
+        elif rate is not None:
+            rates[msg.name] = rate
+        elif msg.cycle_time:
+            rates[msg.name] = 1000.0 / msg.cycle_time
+        else:
+            rates[msg.name] = DEFAULT_RATE
+    return rates
+
+
+def source_until(elapsed: float, speed: float) -> float:
+    return elapsed * speed if speed > 0 else math.inf
+
+
+def thread_cpu(native_id) -> float:
+    """cpu seconds of one thread of this process, None where /proc isnt there"""
+    try:
+        with open(f"/proc/self/task/{native_id}/stat") as f:
+            # utime and stime are fields 14 and 15, the 12th and 13th after the command name
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, TypeError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class FeedStats:
+    def __init__(self):
+        self.offered = 0
+        self.source_cpu = 0.0
+        self.decode_cpu = 0.0
+
+
+async def feed_inprocess(source, decode_plan, bus, batch_size, speed, stats):
+    """Stands in for the receiver, frames are stamped as received when the source hands them over"""
+    loop = asyncio.get_running_loop()
+    batch_decoder = BatchDecoder(decode_plan)
+    start = loop.time()
+    while not source.done:
+        elapsed = loop.time() - start
+        cpu = time.thread_time()
+        frames = source.take(source_until(elapsed, speed), MAX_STEP)
+        rx_time = wall_time_ns()
+        stats.offered += len(frames)
+        decode_start = time.thread_time()
+        stats.source_cpu += decode_start - cpu
+
+        if batch_size > 0:
+            for offset in range(0, len(frames), batch_size):
+                batch = batch_decoder.decode(
+                    [(frame_id, rx_time, data) for frame_id, data in frames[offset:offset + batch_size]]
+                )
+                stats.decode_cpu += time.thread_time() - decode_start
+                if len(batch) > 0:
+                    await bus.put(batch)
+                decode_start = time.thread_time()
+        else:
+            for frame_id, data in frames:
+                pb_msg = decode_plan.pack(frame_id, data)
+                if pb_msg is None:
+                    continue
+                queue_data = QueueData(pb_msg.DESCRIPTOR.name, pb_msg, timestamp=rx_time)
+                stats.decode_cpu += time.thread_time() - decode_start
+                await bus.put(queue_data)
+                decode_start = time.thread_time()
+        stats.decode_cpu += time.thread_time() - decode_start
+
+        if speed > 0:
+            await asyncio.sleep(TICK)
+        else:
+            # give the sinks a turn, the bus only makes the source wait once it is full
+            await asyncio.sleep(0)
+
+
+def send_frames(spec, interface, channel, speed, duration, conn):
+    """Runs in the sender process, puts the source's frames on a real bus"""
+    source = make_source(spec)
+    can_bus = can.Bus(interface=interface, channel=channel)
+    sent = 0
+    send_errors = 0
+    start = time.perf_counter()
+    while not source.done:
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+        frames = source.take(source_until(elapsed, speed), MAX_STEP)
+        for frame_id, data in frames:
+            msg = can.Message(arbitration_id=frame_id, data=data, is_extended_id=frame_id > 0x7FF)
+            try:
+                can_bus.send(msg)
+                sent += 1
+            except can.CanError:
+                # the socket's send buffer is full, the receiving side is behind
+                send_errors += 1
+                time.sleep(TICK)
+        if speed > 0 or not frames:
+            time.sleep(TICK)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    can_bus.shutdown()
+    conn.send({
+        "sent": sent,
+        "send_errors": send_errors,
+        "cpu_percent": 100 * (usage.ru_utime + usage.ru_stime) / (time.perf_counter() - start),
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+    })
+
+
+async def cancel_all(tasks):
+    # a cancel that lands just as a wait_for finishes can get lost before python 3.12, keep at it
+    while not all(task.done() for task in tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks, timeout=0.1)
+
+
+def snapshot(writer, stats, frames_received):
+    writer_thread = writer.writer_thread
+    return {
+        "time": time.perf_counter(),
+        "process_cpu": time.process_time(),
+        "main_cpu": time.thread_time(),
+        "writer_cpu": thread_cpu(writer_thread.native_id) if writer_thread is not None else 0.0,
+        "written": writer.messages_written.value,
+        "received": frames_received.value,
+        "offered": stats.offered,
+        "source_cpu": stats.source_cpu,
+        "decode_cpu": stats.decode_cpu,
+    }
+
+
+def cpu_percent(start, end, key, elapsed):
+    if start[key] is None or end[key] is None:
+        return None
+    return round(100 * (end[key] - start[key]) / elapsed, 1)
+
+
+async def run_once(args, spec, decode_plan, msg_names, msg_classes, batch_size):
+    bus = FanoutBus(capacity=args.bus_capacity)
+    mcap_queue = bus.subscribe("mcap", policy=BLOCK)
+    monitor = LoopLagMonitor()
+    stats = FeedStats()
+    frames_received = registry.counter("frames_received_total", "Frames read off each receiver", source="can")
+    sender = None
+    tasks = []
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        writer = HTPBMcapWriter(
+            out_dir, msg_names, msg_classes, threaded=args.threaded, compression=args.compression
+        )
+        # the writer's own history is only the last few seconds
+        writer.latency = StageLatency(history=LATENCY_HISTORY)
+
+        async def write_forever():
+            while True:
+                await writer.write_data(mcap_queue)
+
+        if args.feed == "inprocess":
+            receiver = feed_inprocess(make_source(spec), decode_plan, bus, batch_size, args.speed, stats)
+        else:
+            interface, _, channel = args.feed.partition(":")
+            # spawn so the sender doesnt inherit this process's threads
+            context = multiprocessing.get_context("spawn")
+            conn, sender_conn = context.Pipe(duplex=False)
+            sender = context.Process(
+                target=send_frames,
+                args=(spec, interface, channel, args.speed, args.warmup + args.duration, sender_conn),
+                daemon=True,
+            )
+            rx_bus = can.Bus(interface=interface, channel=channel)
+            receiver = can_receiver(decode_plan, bus, batch_size=batch_size, can_bus=rx_bus)
+
+        tasks = [
+            asyncio.create_task(monitor.run()),
+            asyncio.create_task(write_forever()),
+            asyncio.create_task(receiver),
+        ]
+        if sender is not None:
+            sender.start()
+            sender_conn.close()
+
+        receiver_task = tasks[-1]
+        start = snapshot(writer, stats, frames_received)
+        start_rss = rss_mb()
+        await asyncio.wait([receiver_task], timeout=args.warmup)
+        if not receiver_task.done():
+            # everything before here was the pipeline getting going
+            writer.latency = StageLatency(history=LATENCY_HISTORY)
+            monitor.samples.clear()
+            monitor.max_lag = 0.0
+            start = snapshot(writer, stats, frames_received)
+            start_rss = rss_mb()
+            await asyncio.wait([receiver_task], timeout=args.duration)
+        # a replay that ran out is timed until the writer has caught up with it
+        while receiver_task.done() and not mcap_queue.empty():
+            await asyncio.sleep(TICK)
+        end = snapshot(writer, stats, frames_received)
+        end_rss = rss_mb()
+        elapsed = end["time"] - start["time"]
+        backlog = mcap_queue.lag()
+
+        await cancel_all(tasks)
+        if not receiver_task.cancelled() and receiver_task.exception() is not None:
+            raise receiver_task.exception()
+        sender_result = None
+        if sender is not None:
+            try:
+                sender_result = await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+            except EOFError:
+                print("sender process died without reporting")
+            sender.join()
+            rx_bus.shutdown()
+        writer.finish()
+        mcap_bytes = sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir))
+
+    written = end["written"] - start["written"]
+    cpu = {
+        "process": cpu_percent(start, end, "process_cpu", elapsed),
+        "mcap_writer_thread": cpu_percent(start, end, "writer_cpu", elapsed),
+    }
+    event_loop = end["main_cpu"] - start["main_cpu"]
+    if args.feed == "inprocess":
+        source_cpu = end["source_cpu"] - start["source_cpu"]
+        decode_cpu = end["decode_cpu"] - start["decode_cpu"]
+        cpu["source"] = round(100 * source_cpu / elapsed, 1)
+        cpu["decode"] = round(100 * decode_cpu / elapsed, 1)
+        # what is left of the event loop is the bus and the writer collecting records
+        cpu["mcap_event_loop"] = round(100 * (event_loop - source_cpu - decode_cpu) / elapsed, 1)
+        offered = end["offered"] - start["offered"]
+    else:
+        # can_receiver, the bus and the writer all share the event loop here
+        cpu["receive_decode_mcap_event_loop"] = round(100 * event_loop / elapsed, 1)
+        cpu["sender_process"] = round(sender_result["cpu_percent"], 1) if sender_result else None
+        offered = end["received"] - start["received"]
+
+    return {
+        "batch_size": batch_size,
+        "seconds": round(elapsed, 3),
+        "frames_written": written,
+        "frames_per_sec": round(written / elapsed, 1),
+        "offered_per_sec": round(offered / elapsed, 1),
+        "backlog_at_end": backlog,
+        "latency_ms": writer.latency.summary(),
+        "event_loop_lag_ms": monitor.summary(),
+        "cpu_percent": cpu,
+        "rss_mb": {"start": start_rss, "end": end_rss, "peak": peak_rss_mb()},
+        "mcap_bytes": mcap_bytes,
+        "sender": sender_result,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Throughput / latency benchmark of the data acq pipeline")
+    parser.add_argument("dbc_dir", nargs="?", default=os.environ.get("DBC_PATH"), help="directory with car.dbc, DBC_PATH by default")
+    parser.add_argument("--replay", help="recorded .mcap or candump / python-can log to replay instead of synthetic frames")
+    parser.add_argument("--rate", type=float, help=f"frames/sec of every message, default is the DBC cycle time or {DEFAULT_RATE}")
+    parser.add_argument("--rates", default="", help='per message frames/sec, e.g. "BMS_Status=10,Wheel_Speeds=500"')
+    parser.add_argument("--speed", type=float, default=1.0, help="multiplies the rates / replay speed, 0 runs as fast as the pipeline takes frames")
+    parser.add_argument("--feed", default="inprocess", help='"inprocess" or a python-can interface:channel, e.g. "socketcan:vcan0"')
+    parser.add_argument("--batch-size", default="0,256", help="receiver batch sizes to run, 0 is frame at a time")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds run before measuring")
+    parser.add_argument("--threaded", type=int, default=1, help="1 uses the mcap writer thread")
+    parser.add_argument("--compression", default="zstd")
+    parser.add_argument("--bus-capacity", type=int, default=4096)
+    parser.add_argument("--output", help="json file for the results, named after the commit and time by default")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.dbc_dir is None:
+        print("no DBC directory given and DBC_PATH is not set")
+        sys.exit(1)
+    dbc_path = os.path.join(args.dbc_dir, "car.dbc")
+    db = cantools.db.load_file(dbc_path)
+    msg_names, msg_classes = pb_helpers.get_msg_names_and_classes()
+    decode_plan = DecodePlan(db, msg_classes)
+
+    overrides = {}
+    for entry in args.rates.split(","):
+        if "=" in entry:
+            name, rate = entry.split("=", 1)
+            overrides[name.strip()] = float(rate)
+    if args.replay:
+        spec = {"kind": "replay", "dbc": dbc_path, "path": args.replay}
+    else:
+        rates = message_rates(db, args.rate, overrides)
+        spec = {"kind": "synthetic", "dbc": dbc_path, "frame_ids": list(decode_plan.frames), "rates": rates}
+
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "source": args.replay or "synthetic",
+            "rates": spec.get("rates"),
+            "speed": args.speed,
+            "feed": args.feed,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "threaded": bool(args.threaded),
+            "compression": args.compression,
+            "bus_capacity": args.bus_capacity,
+        },
+        "runs": [],
+    }
+    for batch_size in (int(size) for size in args.batch_size.split(",")):
+        run = asyncio.run(run_once(args, spec, decode_plan, msg_names, msg_classes, batch_size))
+        results["runs"].append(run)
+        rx_to_write = run["latency_ms"].get("rx_to_write", {})
+        print(
+            f"batch {batch_size:>4}: {run['frames_per_sec']:>10,.0f} frames/sec written "
+            f"(offered {run['offered_per_sec']:,.0f}), rx -> write p50 {rx_to_write.get('p50_ms', 0):.2f} ms "
+            f"p99 {rx_to_write.get('p99_ms', 0):.2f} ms, cpu {run['cpu_percent']}, rss {run['rss_mb']['end']:.0f} MB"
+        )
+
+    output = args.output or "pipeline-benchmark-{}-{}.json".format(
+        commit[:8] if commit else "nocommit", datetime.now().strftime("%Y%m%d_%H%M%S")
+    )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
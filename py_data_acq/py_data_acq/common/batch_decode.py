@@ -0,0 +1,143 @@
+import numpy as np
+from google.protobuf.descriptor import FieldDescriptor
+from .common_types import QueueData, QueueDataBatch
+from .decode_plan import DecodePlan
+
+_FLOAT_VIEWS = {32: (np.uint32, np.float32), 64: (np.uint64, np.float64)}
+
+# what the integer protobuf fields can hold, anything outside fails when the message is built
+_FIELD_RANGES = {
+    FieldDescriptor.CPPTYPE_INT32: (-(1 << 31), (1 << 31) - 1),
+    FieldDescriptor.CPPTYPE_INT64: (-(1 << 63), (1 << 63) - 1),
+    FieldDescriptor.CPPTYPE_UINT32: (0, (1 << 32) - 1),
+    FieldDescriptor.CPPTYPE_UINT64: (0, (1 << 64) - 1),
+}
+
+
+def _decode_column(words, big_endian, shift, length, is_signed, is_float, scale, offset, to_field, choices):
+    # words is a tuple of the (little endian, big endian) uint64 view of every payload in the group
+    word = words[1] if big_endian else words[0]
+    raw = (word >> np.uint64(shift)) & np.uint64((1 << length) - 1)
+
+    if is_float:
+        int_type, float_type = _FLOAT_VIEWS[length]
+        raw = raw.astype(int_type).view(float_type).astype(np.float64)
+    elif is_signed:
+        raw = raw.astype(np.int64)
+        if length < 64:
+            raw = np.where(raw >= (1 << (length - 1)), raw - (1 << length), raw)
+    elif length == 64 and (scale != 1 or offset != 0):
+        # scaling a full 64 bit unsigned value would wrap, python ints dont
+        raw = raw.astype(object)
+    elif length < 64:
+        raw = raw.astype(np.int64)
+
+    value = raw
+    if scale != 1:
+        value = value * scale
+    if offset != 0:
+        value = value + offset
+
+    if to_field == "str":
+        # choices go out as their names, anything not in the table as the scaled number
+        return [choices.get(r) or str(v) for r, v in zip(raw.tolist(), value.tolist())]
+    if to_field == "bool":
+        return value != 0
+    if to_field == "float":
+        return value.astype(np.float64)
+    if value.dtype == object:
+        return np.array([int(v) for v in value.tolist()], dtype=object)
+    if value.dtype == np.uint64:
+        # stays unsigned, values past 2^63 dont fit an int64
+        return value
+    return value.astype(np.int64)
+
+
+class BatchDecoder:
+    """Decodes a whole batch of raw frames at once, one vectorized pass per frame ID.
+
+    Uses the signal layouts of the DecodePlan so the results match what the per frame path would
+    produce. Frame IDs whose layout cant be done in a single 64 bit word (multiplexed, container
+    or CAN FD sized messages) go through the per frame packers instead.
+    """
+
+    def __init__(self, decode_plan: DecodePlan):
+        self.decode_plan = decode_plan
+        # frame ID -> (column index, min, max) per integer signal
+        self.ranges = {}
+
+    def decode(self, frames) -> QueueDataBatch:
+        """frames is a list of (frame id, receive timestamp in ns, payload) tuples in receive order"""
+        grouped = {}
+        for frame in frames:
+            group = grouped.get(frame[0])
+            if group is None:
+                grouped[frame[0]] = [frame]
+            else:
+                group.append(frame)
+
+        batch = QueueDataBatch()
+        for frame_id, group in grouped.items():
+            frame_plan = self.decode_plan.frames.get(frame_id)
+            if frame_plan is None:
+                self.decode_plan.unknown_frames.value += len(group)
+                continue
+            if frame_plan.source is None or frame_plan.length > 8:
+                self._decode_per_frame(batch, frame_plan, group)
+            else:
+                self._decode_vectorized(batch, frame_plan, group)
+        return batch
+
+    def _decode_per_frame(self, batch, frame_plan, group):
+        for frame_id, timestamp, data in group:
+            pb_msg = self.decode_plan.pack(frame_id, data)
+            if pb_msg is not None:
+                batch.add_queue_data(QueueData(frame_plan.name, pb_msg, timestamp=timestamp), timestamp)
+
+    def _decode_vectorized(self, batch, frame_plan, group):
+        length = frame_plan.length
+        # short frames cant be decoded, same as the per frame path
+        received = len(group)
+        group = [frame for frame in group if len(frame[2]) >= length]
+        self.decode_plan.bad_frames.value += received - len(group)
+        if not group:
+            return
+
+        # pad every payload out to 8 bytes so the group becomes one uint64 per frame
+        padding = bytes(8 - length)
+        payloads = b"".join(bytes(frame[2][:length]) + padding for frame in group)
+        little = np.frombuffer(payloads, dtype="<u8")
+        big = np.frombuffer(payloads, dtype=">u8") >> np.uint64(8 * (8 - length))
+        words = (little, big.astype(np.uint64))
+
+        columns = [_decode_column(words, *signal[1:]) for signal in frame_plan.signals]
+        timestamps = [frame[1] for frame in group]
+
+        # values the fields cant hold are dropped and counted here, same as the per frame path,
+        # instead of failing later in whichever consumer builds the message
+        in_range = None
+        for index, low, high in self._ranges(group[0][0], frame_plan):
+            column = columns[index]
+            fits = (column >= low) & (column <= high)
+            in_range = fits if in_range is None else in_range & fits
+        if in_range is not None and not in_range.all():
+            self.decode_plan.bad_values.value += int(np.count_nonzero(~in_range))
+            if not in_range.any():
+                return
+            columns = [column[in_range] for column in columns]
+            timestamps = [timestamp for timestamp, fits in zip(timestamps, in_range.tolist()) if fits]
+        self.decode_plan.frame_counters[group[0][0]].value += len(timestamps)
+
+        batch.add_group(frame_plan.name, frame_plan.build, columns, timestamps)
+
+    def _ranges(self, frame_id, frame_plan):
+        ranges = self.ranges.get(frame_id)
+        if ranges is None:
+            fields = frame_plan.pb_class.DESCRIPTOR.fields_by_name
+            ranges = []
+            for index, signal in enumerate(frame_plan.signals):
+                field_range = _FIELD_RANGES.get(fields[signal[0]].cpp_type)
+                if field_range is not None:
+                    ranges.append((index, *field_range))
+            self.ranges[frame_id] = ranges
+        return ranges
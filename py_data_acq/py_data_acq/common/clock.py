@@ -0,0 +1,27 @@
+import time
+
+# the wall clock read once at startup next to the monotonic clock, every stamp taken after that is
+# the monotonic clock moved onto the wall clock, so an NTP step while driving doesnt put a jump
+# into the data
+_ANCHOR_WALL_NS = time.time_ns()
+_ANCHOR_MONOTONIC_NS = time.monotonic_ns()
+
+# receive timestamps further than this from our own clock are taken to be from some other epoch
+_MAX_RX_SKEW_NS = 24 * 3600 * 10**9
+
+
+def wall_time_ns() -> int:
+    """Unix time in ns that only ever moves forward at the monotonic clock's rate"""
+    return _ANCHOR_WALL_NS + time.monotonic_ns() - _ANCHOR_MONOTONIC_NS
+
+
+def rx_timestamp_ns(timestamp: float) -> int:
+    """Receive time of a can.Message in ns, the kernel / interface timestamp when it has a usable
+    one and the time it was picked up otherwise"""
+    now = wall_time_ns()
+    if not timestamp:
+        return now
+    rx_time = int(timestamp * 1e9)
+    if abs(now - rx_time) > _MAX_RX_SKEW_NS:
+        return now
+    return rx_time
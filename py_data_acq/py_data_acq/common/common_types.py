@@ -1,6 +1,147 @@
 
+import operator
+
+from py_data_acq.common.clock import wall_time_ns
+from py_data_acq.common.metrics import registry
+
+_timestamp = operator.attrgetter("timestamp")
+
+# same counter DecodePlan counts values the protobuf fields cant hold in
+_bad_values = registry.counter("decode_errors_total", "Frames that could not be decoded", reason="value_error")
+
+
+def channel_topic(schema_name: str, bus: str = None) -> str:
+    """Topic a message is published on, prefixed with its bus when there is more than one"""
+    if bus:
+        return f"{bus}/{schema_name}_data"
+    return schema_name + "_data"
+
+
+def parse_channel_topic(topic: str) -> tuple:
+    """(schema name, bus) of a topic made by channel_topic, bus is None without a prefix"""
+    bus, _, name = topic.rpartition("/")
+    return name.removesuffix("_data"), bus or None
+
+
 class QueueData():
-    def __init__(self, schema_name: str, msg):
+    """One decoded frame on its way to the consumers.
+
+    Holds whichever form the frame was decoded into, a row of its batch's decoded signal columns,
+    the protobuf message or its serialized bytes, and only builds the others when a consumer first
+    asks for pb_msg or data. Whatever gets built is kept for every consumer after that, so nothing
+    is built or parsed twice and a frame nobody wants serialized never is.
+
+    A row that cant be built into its message is counted as a value error, pb_msg and data are
+    None for it and the consumers skip it.
+    """
+
+    __slots__ = ("name", "bus", "decoded", "timestamp", "_msg", "_data", "_msg_class", "_group", "_row")
+
+    def __init__(self, schema_name: str, msg, bus: str = None, data: bytes = None, timestamp: int = None, msg_class=None):
         self.name = schema_name
-        self.data = msg.SerializeToString()
-        self.pb_msg = msg
\ No newline at end of file
+        # name of the bus the frame came in on, None with a single bus
+        self.bus = bus
+        # frames decoded in a bus process arrive already serialized and without a message, with
+        # msg_class pb_msg can still parse them for the consumers that need the signals
+        self._msg = None if data is not None else msg
+        self._data = data
+        self._msg_class = type(msg) if msg is not None else msg_class
+        self._group = None
+        self._row = None
+        # when the frame was decoded and when it was received (ns), the receive time is what it
+        # gets logged and shown at so queueing delays downstream dont end up in the data
+        self.decoded = wall_time_ns()
+        self.timestamp = self.decoded if timestamp is None else timestamp
+
+    @classmethod
+    def from_row(cls, schema_name: str, group: tuple, row: int, timestamp: int, decoded: int, bus: str = None):
+        """A frame that is still row `row` of group, a (build function, [column per signal]) tuple
+        shared by every frame of that message in a batch"""
+        data = cls.__new__(cls)
+        data.name = schema_name
+        data.bus = bus
+        data._msg = None
+        data._data = None
+        data._msg_class = None
+        data._group = group
+        data._row = row
+        data.decoded = decoded
+        data.timestamp = timestamp
+        return data
+
+    def _build(self):
+        build, columns = self._group
+        row = self._row
+        self._group = self._row = None
+        try:
+            msg = build(*[column[row] for column in columns])
+        except (ValueError, TypeError):
+            # the batch decoder drops what it knows doesnt fit, this is anything it missed
+            _bad_values.value += 1
+            return None
+        self._msg_class = type(msg)
+        return msg
+
+    @property
+    def pb_msg(self):
+        """The protobuf message, None for frames that only ever came as bytes or could not be built"""
+        if self._msg is None:
+            if self._group is not None:
+                self._msg = self._build()
+            elif self._data is not None and self._msg_class is not None:
+                # handed over as bytes along with the class they parse into
+                self._msg = self._msg_class.FromString(self._data)
+        return self._msg
+
+    @property
+    def data(self) -> bytes:
+        """The serialized message, None if it could not be built"""
+        if self._data is None:
+            msg = self.pb_msg
+            if msg is not None:
+                self._data = msg.SerializeToString()
+        return self._data
+
+class QueueDataBatch():
+    """A batch of decoded frames that goes through the queues as one item.
+
+    Frames are kept grouped by message as decoded signal columns until a consumer iterates over
+    the batch, which gets them in receive order. Even then the protobuf messages only get built
+    when they are asked for.
+    """
+
+    def __init__(self):
+        # (schema name, build function, [column per signal], timestamps) per message in the batch,
+        # the build function takes one value per column and returns the protobuf message
+        self.groups = []
+        # the frames in a batch are all decoded here, not whenever the messages get built
+        self.decoded = wall_time_ns()
+        # (QueueData, timestamp) for frames that were decoded one at a time
+        self.queue_data = []
+        # built on the first iteration and shared by every consumer after that
+        self.materialized = None
+
+    def add_group(self, schema_name: str, build, columns: list, timestamps: list):
+        self.groups.append((schema_name, build, columns, timestamps))
+
+    def add_queue_data(self, data: QueueData, timestamp: int):
+        self.queue_data.append((data, timestamp))
+
+    def __len__(self):
+        return sum(len(group[3]) for group in self.groups) + len(self.queue_data)
+
+    def __iter__(self):
+        if self.materialized is None:
+            self.materialized = []
+            for schema_name, build, columns, timestamps in self.groups:
+                # every frame of the group points into the same columns, the messages only get
+                # built by whichever consumer needs them first
+                group = (build, [column.tolist() if hasattr(column, "tolist") else column for column in columns])
+                self.materialized.extend(
+                    QueueData.from_row(schema_name, group, row, timestamp, self.decoded)
+                    for row, timestamp in enumerate(timestamps)
+                )
+            self.materialized.extend(data for data, timestamp in self.queue_data)
+            # back in receive order, every group is already sorted so this is mostly merging runs
+            self.materialized.sort(key=_timestamp)
+        return iter(self.materialized)
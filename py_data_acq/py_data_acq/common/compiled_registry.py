@@ -0,0 +1,124 @@
+import os
+import glob
+import pickle
+import hashlib
+import tempfile
+from typing import Optional
+
+import cantools
+
+from . import protobuf_helpers as pb_helpers
+from .decode_plan import DecodePlan
+
+# bump when what gets pickled changes shape
+CACHE_VERSION = 2
+CACHE_PREFIX = "registry_"
+
+# content key -> CompiledRegistry, so every component of a process shares one
+_loaded = {}
+
+
+def default_cache_dir() -> str:
+    return os.environ.get(
+        "REGISTRY_CACHE_DIR",
+        os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "py_data_acq"),
+    )
+
+
+def content_key(dbc_path: str, bin_path: str) -> str:
+    """Hash of everything the registry is built from, car.dbc, hytech.bin and the generated pack
+    functions, plus the cantools version since that is what the parsed DBC is pickled with and
+    decode_plan.py since that is what writes the cached decoder source"""
+    key = hashlib.sha256(f"{CACHE_VERSION} {cantools.__version__}".encode())
+    for path in (
+        dbc_path,
+        os.path.join(bin_path or "", "hytech.bin"),
+        os.path.join(bin_path or "", pb_helpers.GENERATED_PACKERS_FILE),
+        os.path.join(os.path.dirname(__file__), "decode_plan.py"),
+    ):
+        key.update(b"\0")
+        try:
+            with open(path, "rb") as source:
+                key.update(source.read())
+        except FileNotFoundError:
+            pass
+    return key.hexdigest()
+
+
+def _read_cache(cache_path: str):
+    try:
+        with open(cache_path, "rb") as cache_file:
+            return pickle.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # a cache from a different cantools or a half written file, it just gets rebuilt
+        print(f"ignoring registry cache {cache_path}: {e}")
+        return None
+
+
+def _write_cache(cache_dir: str, cache_path: str, cached: tuple):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written next to it and renamed, so a power cut never leaves a broken cache behind
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as cache_file:
+            pickle.dump(cached, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        for stale in glob.glob(os.path.join(glob.escape(cache_dir), CACHE_PREFIX + "*.pickle")):
+            if stale != cache_path:
+                os.remove(stale)
+    except OSError as e:
+        print(f"could not write registry cache to {cache_dir}: {e}")
+
+
+class CompiledRegistry:
+    """Everything decoding needs out of car.dbc and hytech.bin: the parsed DBC, the protobuf
+    message names and classes and the decode plan, built once per process and shared by every
+    component that asks load_registry() for it.
+
+    Parsing the DBC and generating the decoders is the slow part of starting up, so the parsed
+    database and the generated decoder source are pickled into cache_dir under the content key
+    and the next start with the same files only unpickles them and compiles the source.
+    """
+
+    def __init__(self, dbc_path: str, bin_path: str, cache_dir: Optional[str] = None, key: Optional[str] = None):
+        self.dbc_path = dbc_path
+        self.bin_path = bin_path
+        self.key = key or content_key(dbc_path, bin_path)
+        cached = None
+        cache_path = None
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, f"{CACHE_PREFIX}{self.key[:32]}.pickle")
+            cached = _read_cache(cache_path)
+        self.from_cache = cached is not None
+        db, plan_sources = cached if cached is not None else (cantools.db.load_file(dbc_path), None)
+        self.db = db
+        self.msg_names, self.msg_classes = pb_helpers.get_msg_names_and_classes()
+        # messages the decode plan hands to cantools get packed by the functions generated with the proto
+        if bin_path is not None:
+            pb_helpers.load_generated_packers(bin_path)
+        self.decode_plan = DecodePlan(db, self.msg_classes, plan_sources)
+        if cache_path is not None and not self.from_cache:
+            _write_cache(cache_dir, cache_path, (db, self.decode_plan.sources()))
+
+
+def load_registry(dbc_path: str, bin_path: str, cache_dir: Optional[str] = None) -> CompiledRegistry:
+    """The registry for these files, built (or unpickled) on the first call and the same object
+    on every call after that. cache_dir defaults to REGISTRY_CACHE_DIR or ~/.cache/py_data_acq,
+    an empty string turns the cache off."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    key = content_key(dbc_path, bin_path)
+    compiled = _loaded.get(key)
+    if compiled is None:
+        compiled = CompiledRegistry(dbc_path, bin_path, cache_dir, key)
+        _loaded[key] = compiled
+    return compiled
+
+
+def shared_registry() -> Optional[CompiledRegistry]:
+    """The registry this process loaded last, None before anything called load_registry()"""
+    if not _loaded:
+        return None
+    return next(reversed(_loaded.values()))
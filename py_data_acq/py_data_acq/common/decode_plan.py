@@ -0,0 +1,233 @@
+import struct
+import keyword
+import cantools
+from google.protobuf.descriptor import FieldDescriptor
+from . import protobuf_helpers
+from .metrics import registry
+
+
+# this has to stay in sync with create_field_name in py_dbc_proto_gen/dbc_to_proto.py since
+# that is what names the fields of the generated protobuf messages
+def create_field_name(name: str) -> str:
+    replaced_text = name.replace(" ", "_")
+    replaced_text = replaced_text.replace("(", "")
+    replaced_text = replaced_text.replace(")", "")
+    return replaced_text
+
+
+_FLOAT_FORMATS = {32: "<f", 64: "<d"}
+
+_CONVERTERS_BY_CPP_TYPE = {
+    FieldDescriptor.CPPTYPE_FLOAT: "float",
+    FieldDescriptor.CPPTYPE_DOUBLE: "float",
+    FieldDescriptor.CPPTYPE_INT32: "int",
+    FieldDescriptor.CPPTYPE_INT64: "int",
+    FieldDescriptor.CPPTYPE_UINT32: "int",
+    FieldDescriptor.CPPTYPE_UINT64: "int",
+    FieldDescriptor.CPPTYPE_BOOL: "bool",
+    FieldDescriptor.CPPTYPE_STRING: "str",
+}
+
+
+def _network_bitnum(sawtooth_bitnum: int) -> int:
+    # DBC big endian start bits count in a "sawtooth" pattern, this gets the MSB first position
+    return 8 * (sawtooth_bitnum // 8) + (7 - (sawtooth_bitnum % 8))
+
+
+class FramePlan:
+    """Decoder for one frame ID, compiled to a straight-line function when the plan is built.
+
+    The generated function pulls every signal out of the payload with shifts and masks, applies
+    scale / offset / choices and sets the protobuf field with the type the field already has,
+    so nothing is looked up or converted by trial and error per frame.
+    """
+
+    def __init__(self, can_msg, pb_class, message_classes, cached=None):
+        self.name = pb_class.DESCRIPTOR.name
+        self.pb_class = pb_class
+        self.can_msg = can_msg
+        self.length = can_msg.length
+        self.source = None
+        # (field name, big endian, shift, bit length, signed, float, scale, offset, field type, choices)
+        # per signal, kept around for decoders that work on more than one frame at a time
+        self.signals = []
+
+        # multiplexed and container messages change their layout per frame, so those get
+        # handed to cantools instead of having a fixed plan
+        if can_msg.is_multiplexed() or can_msg.is_container:
+            self.message_classes = message_classes
+            self.pack = self._pack_with_cantools
+        elif cached is not None:
+            # source and signals out of the registry cache, only compiling them is left
+            self.source, self.signals = cached
+            self.pack = self._load()
+        else:
+            self.pack = self._compile()
+
+    def _compile(self):
+        can_msg = self.can_msg
+        length = can_msg.length
+        total_bits = 8 * length
+        fields = self.pb_class.DESCRIPTOR.fields_by_name
+        body = []
+        needs_le = False
+        needs_be = False
+
+        for sig in can_msg.signals:
+            field = fields.get(create_field_name(sig.name))
+            if field is None:
+                print(f"signal {sig.name} of {can_msg.name} has no field in {self.name}, skipping")
+                continue
+
+            if sig.byte_order == "big_endian":
+                word = "be"
+                shift = total_bits - _network_bitnum(sig.start) - sig.length
+                needs_be = True
+            else:
+                word = "le"
+                shift = sig.start
+                needs_le = True
+            mask = (1 << sig.length) - 1
+            # unpack_N and choices_N are named after the position in self.signals so _load can
+            # put them back together from the signals alone
+            index = len(self.signals)
+            body.append(f"raw = ({word} >> {shift}) & {mask}" if shift else f"raw = {word} & {mask}")
+
+            if sig.is_float:
+                body.append(f"raw = unpack_{index}(raw.to_bytes({sig.length // 8}, 'little'))[0]")
+            elif sig.is_signed:
+                body.append(f"if raw >= {1 << (sig.length - 1)}: raw -= {mask + 1}")
+
+            value = "raw"
+            if sig.scale != 1:
+                value = f"{value} * {sig.scale!r}"
+            if sig.offset != 0:
+                value = f"{value} + {sig.offset!r}"
+
+            to_field = _CONVERTERS_BY_CPP_TYPE[field.cpp_type]
+            choice_names = {raw: str(name) for raw, name in (sig.choices or {}).items()}
+            self.signals.append(
+                (
+                    field.name,
+                    word == "be",
+                    shift,
+                    sig.length,
+                    sig.is_signed,
+                    sig.is_float,
+                    sig.scale,
+                    sig.offset,
+                    to_field,
+                    choice_names,
+                )
+            )
+            if to_field == "str":
+                # choices go out as their names, anything not in the table as the scaled number
+                value = f"choices_{index}.get(raw) or str({value})"
+            elif to_field == "bool":
+                value = f"{value} != 0"
+            elif to_field == "float" and value == "raw":
+                value = "float(raw)"
+            elif to_field == "int" and value != "raw":
+                value = f"int({value})"
+            if keyword.iskeyword(field.name):
+                body.append(f"setattr(pb_msg, {field.name!r}, {value})")
+            else:
+                body.append(f"pb_msg.{field.name} = {value}")
+
+        header = [
+            "def pack(data):",
+            f"    if len(data) < {length}:",
+            "        return None",
+        ]
+        if needs_le:
+            header.append(f"    le = from_bytes(data[:{length}], 'little')")
+        if needs_be:
+            header.append(f"    be = from_bytes(data[:{length}], 'big')")
+        header.append("    pb_msg = pb_class()")
+        self.source = "\n".join(header + ["    " + line for line in body] + ["    return pb_msg", ""])
+
+        # build() takes already decoded values in signal order, for decoders that do the bit work themselves
+        build = ["def build(" + ", ".join(f"v{i}" for i in range(len(self.signals))) + "):"]
+        build.append("    pb_msg = pb_class()")
+        for i, signal in enumerate(self.signals):
+            if keyword.iskeyword(signal[0]):
+                build.append(f"    setattr(pb_msg, {signal[0]!r}, v{i})")
+            else:
+                build.append(f"    pb_msg.{signal[0]} = v{i}")
+        build.append("    return pb_msg")
+        self.source += "\n".join(build) + "\n"
+        return self._load()
+
+    def _load(self):
+        namespace = {"pb_class": self.pb_class, "from_bytes": int.from_bytes}
+        for index, (_, _, _, length, _, is_float, _, _, to_field, choice_names) in enumerate(self.signals):
+            if is_float:
+                namespace[f"unpack_{index}"] = struct.Struct(_FLOAT_FORMATS[length]).unpack
+            if to_field == "str":
+                namespace[f"choices_{index}"] = choice_names
+        exec(compile(self.source, f"<decode plan {self.can_msg.name}>", "exec"), namespace)
+        self.build = namespace["build"]
+        return namespace["pack"]
+
+    def _pack_with_cantools(self, data):
+        try:
+            decoded_msg = self.can_msg.decode(bytes(data), decode_containers=True)
+        except (cantools.database.DecodeError, KeyError, ValueError):
+            return None
+        return protobuf_helpers.pack_protobuf_msg(
+            decoded_msg, self.can_msg.name.lower(), self.message_classes
+        )
+
+
+class DecodePlan:
+    """Per frame ID decoders built once from the DBC and the protobuf classes."""
+
+    def __init__(self, can_db: cantools.db.Database, message_classes, cached_sources=None):
+        cached_sources = cached_sources or {}
+        self.frames = {}
+        self.packers = {}
+        # per frame ID counters are made here so decoding only ever bumps an existing one
+        self.frame_counters = {}
+        for can_msg in can_db.messages:
+            pb_class = message_classes.get(can_msg.name.lower())
+            if pb_class is None:
+                print(f"no protobuf message for {can_msg.name}, frames with id {can_msg.frame_id} will be dropped")
+                continue
+            frame_plan = FramePlan(can_msg, pb_class, message_classes, cached_sources.get(can_msg.frame_id))
+            self.frames[can_msg.frame_id] = frame_plan
+            self.packers[can_msg.frame_id] = frame_plan.pack
+            self.frame_counters[can_msg.frame_id] = registry.counter(
+                "frames_decoded_total", "Frames decoded per frame ID", frame_id=hex(can_msg.frame_id), message=can_msg.name
+            )
+        self.unknown_frames = registry.counter("decode_errors_total", "Frames that could not be decoded", reason="unknown_id")
+        self.bad_frames = registry.counter("decode_errors_total", "Frames that could not be decoded", reason="bad_frame")
+        self.bad_values = registry.counter("decode_errors_total", "Frames that could not be decoded", reason="value_error")
+        # frame IDs a value error was already printed for
+        self.bad_value_ids = set()
+
+    def sources(self) -> dict:
+        """(source, signals) of every generated decoder by frame ID, what the registry cache keeps"""
+        return {frame_id: (plan.source, plan.signals) for frame_id, plan in self.frames.items() if plan.source is not None}
+
+    def pack(self, frame_id: int, data):
+        """Decode a raw CAN frame into its protobuf message, None for unknown or bad frames."""
+        packer = self.packers.get(frame_id)
+        if packer is None:
+            self.unknown_frames.value += 1
+            return None
+        try:
+            pb_msg = packer(data)
+        except ValueError as e:
+            # a value that doesnt fit the protobuf field type, ie a DBC / proto mismatch
+            self.bad_values.value += 1
+            if frame_id not in self.bad_value_ids:
+                # the counter keeps track after this, a bad signal would otherwise print every frame
+                self.bad_value_ids.add(frame_id)
+                print(f"Error packing frame {frame_id}: {e}")
+            return None
+        if pb_msg is None:
+            # too short or cantools could not decode it
+            self.bad_frames.value += 1
+            return None
+        self.frame_counters[frame_id].value += 1
+        return pb_msg
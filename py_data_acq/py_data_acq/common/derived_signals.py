@@ -0,0 +1,501 @@
+import ast
+import math
+import keyword
+import re
+from collections import deque
+from typing import Iterable, Optional
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from google.protobuf.descriptor import FieldDescriptor
+
+from .common_types import QueueData, QueueDataBatch
+from .decode_plan import create_field_name
+from .metrics import registry
+
+# derived signals without a group.name of their own end up on this channel
+DEFAULT_GROUP = "derived_signals"
+PROTO_FILE = "derived_signals.proto"
+
+_SECOND = 1e9
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+_NUMERIC_TYPES = {
+    FieldDescriptor.CPPTYPE_DOUBLE,
+    FieldDescriptor.CPPTYPE_FLOAT,
+    FieldDescriptor.CPPTYPE_INT32,
+    FieldDescriptor.CPPTYPE_INT64,
+    FieldDescriptor.CPPTYPE_UINT32,
+    FieldDescriptor.CPPTYPE_UINT64,
+    FieldDescriptor.CPPTYPE_BOOL,
+}
+
+
+class _Integrate:
+    """Trapezoidal integral over time in seconds"""
+
+    __slots__ = ("total", "last_value", "last_time")
+
+    def __init__(self):
+        self.total = 0.0
+        self.last_value = None
+        self.last_time = None
+
+    def update(self, value, t):
+        if self.last_time is not None and t > self.last_time:
+            self.total += (value + self.last_value) * 0.5 * (t - self.last_time) / _SECOND
+        self.last_value = value
+        self.last_time = t
+        return self.total
+
+
+class _Lowpass:
+    """First order low pass with a time constant in seconds, so uneven frame spacing is fine"""
+
+    __slots__ = ("tau", "value", "last_time")
+
+    def __init__(self, tau: float):
+        if tau <= 0:
+            raise ValueError("lowpass needs a time constant above 0")
+        self.tau = tau
+        self.value = None
+        self.last_time = None
+
+    def update(self, value, t):
+        if self.value is None:
+            self.value = float(value)
+        elif t > self.last_time:
+            alpha = 1.0 - math.exp(-(t - self.last_time) / _SECOND / self.tau)
+            self.value += alpha * (value - self.value)
+        self.last_time = t
+        return self.value
+
+
+class _Rate:
+    """Change per second since the last update"""
+
+    __slots__ = ("rate", "last_value", "last_time")
+
+    def __init__(self):
+        self.rate = 0.0
+        self.last_value = None
+        self.last_time = None
+
+    def update(self, value, t):
+        if self.last_time is not None and t > self.last_time:
+            self.rate = (value - self.last_value) / ((t - self.last_time) / _SECOND)
+        self.last_value = value
+        self.last_time = t
+        return self.rate
+
+
+class _Mean:
+    """Mean of the last n updates, a running sum over a preallocated ring"""
+
+    __slots__ = ("ring", "index", "count", "total")
+
+    def __init__(self, n: int):
+        if n < 1:
+            raise ValueError("mean needs a window of at least 1")
+        self.ring = [0.0] * int(n)
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+    def update(self, value, t):
+        ring = self.ring
+        self.total += value - ring[self.index]
+        ring[self.index] = value
+        self.index += 1
+        if self.index == len(ring):
+            self.index = 0
+            # once per lap, so rounding errors of the running sum never pile up
+            self.total = math.fsum(ring)
+        if self.count < len(ring):
+            self.count += 1
+        return self.total / self.count
+
+
+class _RollingExtreme:
+    """Min or max of the last n updates, a monotonic queue so every update is amortized O(1)"""
+
+    __slots__ = ("n", "is_max", "window", "seq")
+
+    def __init__(self, n: int, is_max: bool):
+        if n < 1:
+            raise ValueError("rolling windows need at least 1 update")
+        self.n = int(n)
+        self.is_max = is_max
+        self.window = deque()
+        self.seq = 0
+
+    def update(self, value, t):
+        window = self.window
+        if self.is_max:
+            while window and window[-1][1] <= value:
+                window.pop()
+        else:
+            while window and window[-1][1] >= value:
+                window.pop()
+        window.append((self.seq, value))
+        if window[0][0] <= self.seq - self.n:
+            window.popleft()
+        self.seq += 1
+        return window[0][1]
+
+
+class _Delta:
+    """Change since the last update"""
+
+    __slots__ = ("last_value",)
+
+    def __init__(self):
+        self.last_value = None
+
+    def update(self, value, t):
+        last = self.last_value
+        self.last_value = value
+        return 0.0 if last is None else value - last
+
+
+# name -> (state factory, number of constant arguments after the signal)
+_STATEFUL = {
+    "integrate": (_Integrate, 0),
+    "lowpass": (_Lowpass, 1),
+    "rate": (_Rate, 0),
+    "delta": (_Delta, 0),
+    "mean": (_Mean, 1),
+    "rolling_min": (lambda n: _RollingExtreme(n, False), 1),
+    "rolling_max": (lambda n: _RollingExtreme(n, True), 1),
+}
+
+
+def _div(a, b):
+    return a / b if b else math.nan
+
+
+def _mod(a, b):
+    return a % b if b else math.nan
+
+
+def _pow(a, b):
+    # math.pow raises where ** would overflow or turn complex, a negative current ** 0.5 say
+    try:
+        return math.pow(a, b)
+    except (OverflowError, ValueError):
+        return math.nan
+
+
+def _sqrt(a):
+    return math.sqrt(a) if a >= 0 else math.nan
+
+
+_FUNCTIONS = {"abs": abs, "min": min, "max": max, "sqrt": _sqrt, "hypot": math.hypot}
+
+_BIN_OPS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*"}
+_COMPARE_OPS = {ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=", ast.Eq: "==", ast.NotEq: "!="}
+
+
+def parse_definitions(text: str) -> list[tuple[str, str, str]]:
+    """(group, name, expression) of every "name = expression" or "group.name = expression" line
+    of text, lines can also be split with ;. # starts a comment."""
+    definitions = []
+    for line in re.split(r"[;\n]", text):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        if "=" not in line:
+            raise ValueError(f"derived signal {line!r} is not name = expression")
+        target, expression = line.split("=", 1)
+        group, _, name = target.strip().rpartition(".")
+        definitions.append((group or DEFAULT_GROUP, name, expression.strip()))
+    return definitions
+
+
+class DerivedSignal:
+    """One compiled expression. evaluate(values, t) takes the table of current values and the
+    frame time, and returns None until every input has been seen once."""
+
+    def __init__(self, group: str, name: str, expression: str, message_classes):
+        for identifier in (group, name):
+            if not _IDENTIFIER.fullmatch(identifier) or keyword.iskeyword(identifier):
+                raise ValueError(f"{identifier} is not a valid derived signal or group name")
+        self.group = group
+        self.name = name
+        self.expression = expression
+        self.message_classes = message_classes
+        # "message.field" keys of the decoded signals this reads, names of derived ones it reads
+        self.inputs = {}
+        self.derived_inputs = set()
+        self.stateful = False
+        self.states = 0
+        self.namespace = {"_div": _div, "_mod": _mod, "_pow": _pow, "nan": math.nan, **_FUNCTIONS}
+        self.locals = {}
+
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"{name}: {e.msg} in {expression!r}") from None
+        body = self._emit(tree.body)
+        lines = ["def evaluate(v, t):"]
+        for key, local in self.locals.items():
+            lines.append(f"    {local} = v[{key!r}]")
+        if self.locals:
+            lines.append(f"    if {' or '.join(f'{local} is None' for local in self.locals.values())}:")
+            lines.append("        return None")
+        lines.append(f"    return float({body})")
+        self.source = "\n".join(lines) + "\n"
+        exec(compile(self.source, f"<derived signal {name}>", "exec"), self.namespace)
+        self.evaluate = self.namespace["evaluate"]
+        self.depends = frozenset(self.inputs) | frozenset(self.derived_inputs)
+
+    def _local(self, key: str) -> str:
+        local = self.locals.get(key)
+        if local is None:
+            local = self.locals[key] = f"a{len(self.locals)}"
+        return local
+
+    def _constant(self, node) -> float:
+        try:
+            value = ast.literal_eval(node)
+        except ValueError:
+            value = None
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError(f"{self.name}: {ast.unparse(node)} has to be a number")
+        return value
+
+    def _signal(self, msg_name: str, signal_name: str) -> str:
+        msg_name = msg_name.lower()
+        msg_class = self.message_classes.get(msg_name)
+        if msg_class is None:
+            raise ValueError(f"{self.name}: there is no message {msg_name}")
+        field_name = create_field_name(signal_name).lower()
+        for field in msg_class.DESCRIPTOR.fields:
+            if field.name.lower() == field_name:
+                break
+        else:
+            raise ValueError(f"{self.name}: {msg_name} has no signal {signal_name}")
+        if field.cpp_type not in _NUMERIC_TYPES:
+            raise ValueError(f"{self.name}: {msg_name}.{field.name} is not a number")
+        key = f"{msg_name}.{field.name}"
+        self.inputs[key] = (msg_name, field.name)
+        return self._local(key)
+
+    def _emit(self, node) -> str:
+        if isinstance(node, ast.Constant):
+            return repr(float(self._constant(node)))
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            return self._signal(node.value.id, node.attr)
+        if isinstance(node, ast.Name):
+            if node.id == "nan":
+                return "nan"
+            self.derived_inputs.add(node.id)
+            return self._local(node.id)
+        if isinstance(node, ast.BinOp):
+            left, right = self._emit(node.left), self._emit(node.right)
+            if isinstance(node.op, ast.Div):
+                return f"_div({left}, {right})"
+            if isinstance(node.op, ast.Mod):
+                return f"_mod({left}, {right})"
+            if isinstance(node.op, ast.Pow):
+                return f"_pow({left}, {right})"
+            if type(node.op) in _BIN_OPS:
+                return f"({left} {_BIN_OPS[type(node.op)]} {right})"
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            return f"({'-' if isinstance(node.op, ast.USub) else '+'}{self._emit(node.operand)})"
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _COMPARE_OPS:
+            return f"({self._emit(node.left)} {_COMPARE_OPS[type(node.ops[0])]} {self._emit(node.comparators[0])})"
+        if isinstance(node, ast.IfExp):
+            return f"({self._emit(node.body)} if {self._emit(node.test)} else {self._emit(node.orelse)})"
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            function = node.func.id
+            if function in _STATEFUL:
+                factory, constants = _STATEFUL[function]
+                if len(node.args) != 1 + constants:
+                    raise ValueError(f"{self.name}: {function} takes a signal and {constants} numbers")
+                state = f"state_{self.states}"
+                self.states += 1
+                self.namespace[state] = factory(*[self._constant(arg) for arg in node.args[1:]])
+                self.stateful = True
+                return f"{state}.update({self._emit(node.args[0])}, t)"
+            if function in _FUNCTIONS and node.args:
+                return f"{function}({', '.join(self._emit(arg) for arg in node.args)})"
+        raise ValueError(f"{self.name}: {ast.unparse(node)} is not supported")
+
+
+def _build_group_classes(groups: dict) -> tuple[dict, bytes]:
+    # one message per group with a double per derived signal, in a pool of their own so they
+    # cant clash with hytech.proto
+    file_proto = descriptor_pb2.FileDescriptorProto(name=PROTO_FILE, syntax="proto3")
+    for group, names in groups.items():
+        message_proto = file_proto.message_type.add(name=group)
+        for number, name in enumerate(names, 1):
+            message_proto.field.add(
+                name=name,
+                number=number,
+                type=descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+                label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+            )
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    file_descriptor = pool.FindFileByName(PROTO_FILE)
+    classes = {
+        group: message_factory.GetMessageClass(file_descriptor.message_types_by_name[group]) for group in groups
+    }
+    schema = descriptor_pb2.FileDescriptorSet(file=[file_proto]).SerializeToString()
+    return classes, schema
+
+
+class DerivedSignalEngine:
+    """Evaluates derived signals (power, wheel slip, energy used, rolling averages...) as the
+    frames come in, and publishes them as extra protobuf channels, one per group.
+
+    Every definition is compiled once into a function over a table of current values, stateful
+    functions (integrate, lowpass, rate, delta, mean, rolling_min, rolling_max) keep their state
+    preallocated, so an update is O(1). A frame only re-evaluates the signals that depend on its
+    message, and of those the stateless ones only if one of their inputs actually changed.
+    """
+
+    def __init__(self, definitions: Iterable[tuple[str, str, str]], message_classes):
+        signals = {}
+        groups = {}
+        for group, name, expression in definitions:
+            if name in signals:
+                raise ValueError(f"derived signal {name} is defined twice")
+            if group in message_classes:
+                raise ValueError(f"derived group {group} has the name of a message")
+            signals[name] = DerivedSignal(group, name, expression, message_classes)
+            groups.setdefault(group, []).append(name)
+        for signal in signals.values():
+            unknown = signal.derived_inputs - set(signals)
+            if unknown:
+                raise ValueError(f"{signal.name} uses {', '.join(sorted(unknown))}, which is not defined")
+        self.signals = self._in_dependency_order(signals)
+        self.groups = groups
+        self.message_classes, self.schema = _build_group_classes(groups)
+
+        # what each message feeds: its fields that are read, and every signal that depends on
+        # it directly or through another derived signal, in evaluation order
+        self.input_classes = {}
+        self.message_inputs = {}
+        self.by_message = {}
+        for signal in self.signals:
+            for key, (msg_name, field_name) in signal.inputs.items():
+                self.input_classes[msg_name] = message_classes[msg_name]
+                fields = self.message_inputs.setdefault(msg_name, [])
+                if (key, field_name) not in fields:
+                    fields.append((key, field_name))
+        sources = {}
+        for signal in self.signals:
+            sources[signal.name] = {msg_name for msg_name, _ in signal.inputs.values()}.union(
+                *[sources[name] for name in signal.derived_inputs]
+            )
+            for msg_name in sources[signal.name]:
+                self.by_message.setdefault(msg_name, []).append(signal)
+
+        self.values = {key: None for signal in self.signals for key in signal.inputs}
+        self.values.update((signal.name, None) for signal in self.signals)
+        self.evaluations = registry.counter("derived_evaluations_total", "Derived signal expressions evaluated")
+        self.errors = registry.counter("derived_errors_total", "Derived signal evaluations that raised, skipped for that frame")
+
+    @staticmethod
+    def _in_dependency_order(signals: dict) -> list:
+        ordered = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"derived signals depend on each other: {' -> '.join(path + [name])}")
+            state[name] = "visiting"
+            for dependency in sorted(signals[name].derived_inputs):
+                visit(dependency, path + [name])
+            state[name] = "done"
+            ordered.append(signals[name])
+
+        for name in signals:
+            visit(name, [])
+        return ordered
+
+    def process(self, data) -> list:
+        """The derived channels data updates, as QueueData at the frame's receive time"""
+        fields = self.message_inputs.get(data.name)
+        if fields is None:
+            return []
+        pb_msg = data.pb_msg
+        if pb_msg is None:
+            if data.data is None:
+                return []
+            # frames from the bus processes only come as bytes
+            pb_msg = self.input_classes[data.name].FromString(data.data)
+        values = self.values
+        changed = set()
+        for key, field_name in fields:
+            value = getattr(pb_msg, field_name)
+            if values[key] != value:
+                values[key] = value
+                changed.add(key)
+
+        t = data.timestamp
+        updated = set()
+        for signal in self.by_message[data.name]:
+            if not signal.stateful and changed.isdisjoint(signal.depends):
+                continue
+            self.evaluations.value += 1
+            try:
+                result = signal.evaluate(values, t)
+            except (ArithmeticError, TypeError, ValueError):
+                # one odd sample or expression must not take the receiver down with it
+                self.errors.value += 1
+                continue
+            if result is None:
+                continue
+            if values[signal.name] != result:
+                values[signal.name] = result
+                changed.add(signal.name)
+            updated.add(signal.group)
+
+        outputs = []
+        for group in updated:
+            msg = self.message_classes[group]()
+            for name in self.groups[group]:
+                value = values[name]
+                if value is not None:
+                    setattr(msg, name, value)
+            outputs.append(QueueData(group, msg, timestamp=t))
+        return outputs
+
+
+class DerivedSignalBus:
+    """Sits between the receivers and the FanoutBus the sinks read, has the same put(). Every
+    item goes through as it is, followed by the derived channels it updated."""
+
+    def __init__(self, bus, engine: DerivedSignalEngine):
+        self.bus = bus
+        self.engine = engine
+
+    async def put(self, item):
+        process = self.engine.process
+        if isinstance(item, QueueDataBatch):
+            derived = QueueDataBatch()
+            # a batch iterates in receive order, stateful functions cant have time going backwards
+            for data in item:
+                for output in process(data):
+                    derived.add_queue_data(output, output.timestamp)
+            await self.bus.put(item)
+            if len(derived):
+                await self.bus.put(derived)
+            return
+        outputs = process(item)
+        await self.bus.put(item)
+        for output in outputs:
+            await self.bus.put(output)
+
+
+def load_definitions(spec: str = "", path: Optional[str] = None) -> list[tuple[str, str, str]]:
+    """Definitions from a spec string plus, if given, a file with one definition per line"""
+    definitions = parse_definitions(spec)
+    if path:
+        with open(path) as definitions_file:
+            definitions += parse_definitions(definitions_file.read())
+    return definitions
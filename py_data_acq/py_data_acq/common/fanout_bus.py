@@ -0,0 +1,148 @@
+import asyncio
+
+from .metrics import registry
+
+# what a consumer does when the producer laps it
+BLOCK = "block"  # the producer waits for the consumer, nothing gets lost
+DROP_OLDEST = "drop_oldest"  # the consumer skips the items that were overwritten
+SAMPLE = "sample"  # once the consumer falls behind it only takes every Nth item until it catches up
+
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, SAMPLE)
+
+
+class BusConsumer:
+    """One reader of a FanoutBus, has the same get() as an asyncio.Queue so sinks dont care."""
+
+    def __init__(self, bus, name: str, policy: str, sample_every: int, sample_lag: int):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {policy}, expected one of {OVERFLOW_POLICIES}")
+        self.bus = bus
+        self.name = name
+        self.policy = policy
+        self.sample_every = sample_every
+        self.sample_lag = sample_lag
+        # sequence number of the next item this consumer will read
+        self.cursor = bus.head
+        self.delivered = 0
+        self.dropped = 0
+
+    def lag(self) -> int:
+        return self.bus.head - self.cursor
+
+    async def get(self):
+        bus = self.bus
+        while self.cursor == bus.head:
+            waiter = asyncio.get_running_loop().create_future()
+            bus.data_waiters.append(waiter)
+            await waiter
+        return self._take()
+
+    def get_nowait(self):
+        if self.cursor == self.bus.head:
+            raise asyncio.QueueEmpty
+        return self._take()
+
+    def _take(self):
+        bus = self.bus
+        lag = bus.head - self.cursor
+        if lag > bus.capacity:
+            # only non blocking consumers can get lapped, the overwritten items are gone
+            self.dropped += lag - bus.capacity
+            self.cursor = bus.head - bus.capacity
+            lag = bus.capacity
+        if self.policy == SAMPLE and lag > self.sample_lag:
+            skip = min(self.sample_every, lag) - 1
+            self.dropped += skip
+            self.cursor += skip
+
+        item = bus.slots[self.cursor % bus.capacity]
+        self.cursor += 1
+        self.delivered += 1
+
+        if self.policy == BLOCK and bus.space_waiter is not None and not bus.space_waiter.done():
+            bus.space_waiter.set_result(None)
+        return item
+
+    def empty(self) -> bool:
+        return self.cursor == self.bus.head
+
+    def qsize(self) -> int:
+        return min(self.lag(), self.bus.capacity)
+
+    def metrics(self) -> dict:
+        return {
+            "policy": self.policy,
+            "lag": self.lag(),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
+
+
+class FanoutBus:
+    """Single producer, multi consumer ring buffer.
+
+    Every item is stored once in a preallocated slot and each consumer keeps its own cursor into
+    the ring, so adding a sink doesnt add a copy or a queue per frame. How a consumer that falls
+    a whole ring behind is handled is up to its overflow policy.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        # sequence number of the next item to be written
+        self.head = 0
+        self.consumers = []
+        self.blocking_consumers = []
+        self.data_waiters = []
+        self.space_waiter = None
+
+    def subscribe(self, name: str, policy: str = BLOCK, sample_every: int = 10, sample_lag: int = None) -> BusConsumer:
+        """Add a consumer that starts at the next item put on the bus."""
+        if sample_lag is None:
+            sample_lag = self.capacity // 2
+        consumer = BusConsumer(self, name, policy, sample_every, sample_lag)
+        self.consumers.append(consumer)
+        if policy == BLOCK:
+            self.blocking_consumers.append(consumer)
+        registry.gauge("bus_queue_depth", "Items each bus consumer is behind the producer", consumer.qsize, consumer=name)
+        registry.counter_callback(
+            "bus_delivered_total", "Items each bus consumer took off the bus", lambda: consumer.delivered, consumer=name
+        )
+        registry.counter_callback(
+            "bus_dropped_total", "Items each bus consumer skipped", lambda: consumer.dropped, consumer=name
+        )
+        return consumer
+
+    def unsubscribe(self, consumer: BusConsumer):
+        self.consumers.remove(consumer)
+        if consumer in self.blocking_consumers:
+            self.blocking_consumers.remove(consumer)
+        # the producer might be waiting on this one
+        if self.space_waiter is not None and not self.space_waiter.done():
+            self.space_waiter.set_result(None)
+
+    def _blocked(self) -> bool:
+        for consumer in self.blocking_consumers:
+            if self.head - consumer.cursor >= self.capacity:
+                return True
+        return False
+
+    async def put(self, item):
+        while self._blocked():
+            self.space_waiter = asyncio.get_running_loop().create_future()
+            await self.space_waiter
+        self.space_waiter = None
+
+        self.slots[self.head % self.capacity] = item
+        self.head += 1
+
+        if self.data_waiters:
+            waiters = self.data_waiters
+            self.data_waiters = []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def metrics(self) -> dict:
+        """Lag and drop counts per consumer"""
+        return {consumer.name: consumer.metrics() for consumer in self.consumers}
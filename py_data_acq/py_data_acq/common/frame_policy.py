@@ -0,0 +1,134 @@
+from typing import Callable, Iterable, Optional
+
+import cantools
+
+from .metrics import registry
+
+# what can happen to the frames of a message
+RAW = "raw"
+DECODED = "decoded"
+LIVE = "live"
+IGNORE = "ignore"
+ACTIONS = (RAW, DECODED, LIVE, IGNORE)
+
+# most filters a socketcan socket takes (CAN_RAW_FILTER_MAX), past that everything is let through
+MAX_KERNEL_FILTERS = 512
+# python-can reads no filters as no filtering, so "nothing" is a filter only extended id 0 passes
+_NOTHING = [{"can_id": 0, "can_mask": 0x1FFFFFFF, "extended": True}]
+
+
+def parse_actions(value: str) -> frozenset:
+    actions = frozenset(action.strip().lower() for action in value.split("+") if action.strip())
+    unknown = actions - set(ACTIONS)
+    if unknown:
+        raise ValueError(f"unknown frame actions {', '.join(sorted(unknown))}, expected {', '.join(ACTIONS)}")
+    return actions - {IGNORE}
+
+
+class FramePolicy:
+    """What happens to the frames of every frame ID: raw logs them to the raw capture, decoded
+    logs them to the mcap, live streams them to foxglove while somebody is subscribed to their
+    channel, ignore (or nothing) drops them.
+
+    Only frames with somewhere to go get decoded, and the frame IDs that are wanted at all are
+    handed to every listener as can_filters, so the rest never leave the kernel. The wanted set
+    changes with the foxglove subscriptions, set_live_interest() is how those come in.
+    """
+
+    def __init__(self, can_db: cantools.db.Database, rules: Optional[dict] = None, default: Iterable[str] = (DECODED, LIVE)):
+        self.default = frozenset(default) - {IGNORE}
+        # frame id -> actions, extended flag and message name (lower case) of every frame with a rule
+        self.actions = {}
+        self.extended = {}
+        self.names = {}
+        ids_by_name = {}
+        for msg in can_db.messages:
+            self.actions[msg.frame_id] = self.default
+            self.extended[msg.frame_id] = msg.is_extended_frame
+            self.names[msg.frame_id] = msg.name.lower()
+            ids_by_name[msg.name.lower()] = msg.frame_id
+        for key, actions in (rules or {}).items():
+            frame_id = ids_by_name.get(key.lower())
+            if frame_id is None:
+                try:
+                    frame_id = int(key, 0)
+                except ValueError:
+                    raise ValueError(f"{key} is neither a message in the DBC nor a frame ID") from None
+                self.extended.setdefault(frame_id, frame_id > 0x7FF)
+            self.actions[frame_id] = frozenset(actions) - {IGNORE}
+
+        # frames the DBC doesnt know can only ever be logged raw, and are when the default says so
+        self.raw_all = RAW in self.default
+        self.raw_ids = frozenset(frame_id for frame_id, actions in self.actions.items() if RAW in actions)
+        self.not_raw_ids = frozenset(self.actions) - self.raw_ids
+        # messages that go to foxglove but not into the mcap
+        self.not_logged = frozenset(
+            self.names[frame_id] for frame_id, actions in self.actions.items()
+            if frame_id in self.names and DECODED not in actions
+        )
+        self.live_names = frozenset()
+        self.decode_ids = frozenset()
+        self.filters = None
+        self.listeners = []
+        self.skipped = registry.counter("frames_not_decoded_total", "Frames nobody wanted decoded right now")
+        registry.gauge("can_filter_ids", "Frame IDs let through the kernel CAN filter, -1 for all", self._filter_count)
+        self._update()
+
+    @classmethod
+    def from_spec(cls, can_db, spec: str, default: Iterable[str] = (DECODED, LIVE)) -> "FramePolicy":
+        """From "default=decoded+live,BMS_Status=raw+decoded,0x7ff=ignore", keys are message names
+        or frame IDs"""
+        rules = {}
+        for rule in spec.split(","):
+            if "=" not in rule:
+                continue
+            key, value = rule.split("=", 1)
+            if key.strip().lower() == "default":
+                default = parse_actions(value)
+            else:
+                rules[key.strip()] = parse_actions(value)
+        return cls(can_db, rules, default)
+
+    def wants_raw(self, frame_id: int) -> bool:
+        if self.raw_all:
+            return frame_id not in self.not_raw_ids
+        return frame_id in self.raw_ids
+
+    def _filter_count(self):
+        return -1 if self.filters is None else len(self.filters)
+
+    def _update(self):
+        self.decode_ids = frozenset(
+            frame_id for frame_id, actions in self.actions.items()
+            if frame_id in self.names and (DECODED in actions or (LIVE in actions and self.names[frame_id] in self.live_names))
+        )
+        wanted = self.decode_ids | self.raw_ids
+        if self.raw_all or len(wanted) > MAX_KERNEL_FILTERS:
+            filters = None
+        elif not wanted:
+            filters = _NOTHING
+        else:
+            filters = [
+                {
+                    "can_id": frame_id,
+                    "can_mask": 0x1FFFFFFF if self.extended[frame_id] else 0x7FF,
+                    "extended": self.extended[frame_id],
+                }
+                for frame_id in sorted(wanted)
+            ]
+        if filters != self.filters:
+            self.filters = filters
+            for listener in self.listeners:
+                listener(filters)
+
+    def add_listener(self, listener: Callable[[Optional[list]], None]):
+        """listener(can_filters) gets called now and whenever the frames that are wanted change"""
+        self.listeners.append(listener)
+        listener(self.filters)
+
+    def set_live_interest(self, names: Iterable[str]):
+        """The message names foxglove clients are subscribed to right now"""
+        live_names = frozenset(name.lower() for name in names)
+        if live_names != self.live_names:
+            self.live_names = live_names
+            self._update()
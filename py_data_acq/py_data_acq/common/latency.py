@@ -0,0 +1,53 @@
+from collections import deque
+
+from .metrics import registry
+
+# stages a frame goes through, from the interface timestamp to where a sink took it
+RX_TO_DECODE = "rx_to_decode"
+DECODE_TO_WRITE = "decode_to_write"
+RX_TO_WRITE = "rx_to_write"
+
+
+class StageLatency:
+    """Recent latency samples per pipeline stage, all in ns. With a sink name the samples also
+    go into the stage_latency_seconds histograms of the metrics registry."""
+
+    def __init__(self, history: int = 4096, sink: str = None):
+        self.history = history
+        self.samples = {}
+        self.max_latency = {}
+        self.histograms = {}
+        if sink is not None:
+            for stage in (RX_TO_DECODE, DECODE_TO_WRITE, RX_TO_WRITE):
+                self.histograms[stage] = registry.histogram(
+                    "stage_latency_seconds", "Time frames spend in each pipeline stage", sink=sink, stage=stage
+                )
+
+    def record(self, stage: str, latency_ns: int):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples[stage] = deque(maxlen=self.history)
+            self.max_latency[stage] = latency_ns
+        samples.append(latency_ns)
+        histogram = self.histograms.get(stage)
+        if histogram is not None:
+            histogram.observe(latency_ns / 1e9)
+        if latency_ns > self.max_latency[stage]:
+            self.max_latency[stage] = latency_ns
+
+    def record_frame(self, rx_time: int, decode_time: int, write_time: int):
+        self.record(RX_TO_DECODE, decode_time - rx_time)
+        self.record(DECODE_TO_WRITE, write_time - decode_time)
+        self.record(RX_TO_WRITE, write_time - rx_time)
+
+    def summary(self) -> dict:
+        """p50 / p99 / max latency in milliseconds per stage over the recent samples"""
+        summary = {}
+        for stage, samples in self.samples.items():
+            ordered = sorted(samples)
+            summary[stage] = {
+                "p50_ms": ordered[len(ordered) // 2] / 1e6,
+                "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] / 1e6,
+                "max_ms": self.max_latency[stage] / 1e6,
+            }
+        return summary
@@ -0,0 +1,35 @@
+import asyncio
+from collections import deque
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps for a fixed interval.
+
+    Anything that blocks the loop (file writes, compression, long decode runs) shows up as lag.
+    """
+
+    def __init__(self, interval: float = 0.005, history: int = 4096):
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self.max_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self.samples.append(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def summary(self) -> dict:
+        """p50 / p99 / max lag in milliseconds over the recent samples"""
+        if not self.samples:
+            return {"p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+        ordered = sorted(self.samples)
+        return {
+            "p50_ms": ordered[len(ordered) // 2] * 1000,
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            "max_ms": self.max_lag * 1000,
+        }
@@ -0,0 +1,139 @@
+from bisect import bisect_left
+
+# every metric name gets this prefix in the prometheus output
+PREFIX = "data_acq_"
+
+# latency histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+def _label_text(labels: dict, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels.items()]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Counter the hot path bumps directly, created once up front"""
+
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Histogram:
+    """Fixed bucket histogram, observe() is one bisect and two adds"""
+
+    __slots__ = ("labels", "bounds", "counts", "count", "sum")
+
+    def __init__(self, labels: dict, bounds: tuple):
+        self.labels = labels
+        self.bounds = bounds
+        # one per bound plus +Inf, not cumulative until exported
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Callback:
+    """Value read when the metrics are scraped, for things that already keep their own count"""
+
+    __slots__ = ("labels", "read")
+
+    def __init__(self, labels: dict, read):
+        self.labels = labels
+        self.read = read
+
+    @property
+    def value(self):
+        return self.read()
+
+
+class MetricsRegistry:
+    """All the metrics of this process by name. Asking for a metric that exists returns it, so
+    every component can just ask for what it needs when it is built."""
+
+    def __init__(self):
+        # name -> (type, help, {label tuple: metric})
+        self.families = {}
+
+    def _get(self, kind: str, name: str, help: str, labels: dict, create):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help, {})
+        elif family[0] != kind:
+            raise ValueError(f"metric {name} is a {family[0]}, not a {kind}")
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = create()
+        return metric
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._get("counter", name, help, labels, lambda: Counter(labels))
+
+    def histogram(self, name: str, help: str, bounds: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._get("histogram", name, help, labels, lambda: Histogram(labels, bounds))
+
+    def gauge(self, name: str, help: str, read, **labels) -> Callback:
+        """read() is called on every scrape, a later gauge with the same labels replaces it"""
+        callback = self._get("gauge", name, help, labels, lambda: Callback(labels, read))
+        callback.read = read
+        return callback
+
+    def counter_callback(self, name: str, help: str, read, **labels) -> Callback:
+        """Like gauge() for a count something else keeps"""
+        callback = self._get("counter", name, help, labels, lambda: Callback(labels, read))
+        callback.read = read
+        return callback
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for name, (kind, help, metrics) in sorted(self.families.items()):
+            full_name = PREFIX + name
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for metric in metrics.values():
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.bounds + ("+Inf",), metric.counts):
+                        cumulative += count
+                        le = 'le="' + str(bound) + '"'
+                        lines.append(f"{full_name}_bucket{_label_text(metric.labels, le)} {cumulative}")
+                    lines.append(f"{full_name}_sum{_label_text(metric.labels)} {metric.sum}")
+                    lines.append(f"{full_name}_count{_label_text(metric.labels)} {metric.count}")
+                else:
+                    lines.append(f"{full_name}{_label_text(metric.labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self) -> dict:
+        result = {}
+        for name, (kind, help, metrics) in sorted(self.families.items()):
+            samples = []
+            for metric in metrics.values():
+                if kind == "histogram":
+                    samples.append({
+                        "labels": metric.labels,
+                        "buckets": dict(zip([str(bound) for bound in metric.bounds] + ["+Inf"], metric.counts)),
+                        "count": metric.count,
+                        "sum": metric.sum,
+                    })
+                else:
+                    samples.append({"labels": metric.labels, "value": metric.value})
+            result[name] = {"type": kind, "help": help, "samples": samples}
+        return result
+
+
+# one registry per process, every module registers its metrics here
+registry = MetricsRegistry()
@@ -1,9 +1,47 @@
 from hytech_np_proto_py import hytech_pb2
 import google.protobuf.message_factory
+import importlib.util
+import os
 from cantools.database import *
 
+from .metrics import registry
+
+_conversion_errors = registry.counter(
+    "decode_errors_total", "Frames that could not be decoded", reason="type_conversion"
+)
+
+# dbc_to_proto.py writes this next to hytech.proto, it ends up in the same bin dir as hytech.bin
+GENERATED_PACKERS_FILE = "hytech_pack.py"
+
+# msg name -> generated pack function, filled by load_generated_packers
+_generated_packers = {}
+
+
+def load_generated_packers(bin_path: str) -> int:
+    """Have pack_protobuf_msg use the pack functions generated along with hytech.proto, returns
+    how many messages got one. Without them every field is converted by trial and error."""
+    path = os.path.join(bin_path or "", GENERATED_PACKERS_FILE)
+    if not os.path.isfile(path):
+        print(f"no {GENERATED_PACKERS_FILE} in {bin_path}, packing protobuf messages by reflection")
+        return 0
+    spec = importlib.util.spec_from_file_location("hytech_pack", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    _generated_packers.clear()
+    _generated_packers.update(module.PACKERS)
+    return len(_generated_packers)
+
+
+# (names, classes) once hytech_pb2 has been walked, it is the same for the whole process
+_msg_names_and_classes = None
+
 
 def get_msg_names_and_classes():
+    global _msg_names_and_classes
+    if _msg_names_and_classes is not None:
+        # copies, callers are free to change theirs
+        message_names, message_classes = _msg_names_and_classes
+        return list(message_names), dict(message_classes)
     message_names = []
     message_classes = {}
     # Iterate through all attributes in the generated module
@@ -19,12 +57,16 @@ def get_msg_names_and_classes():
                     )
                 )
             )
-    return message_names, message_classes
+    _msg_names_and_classes = (message_names, message_classes)
+    return list(message_names), dict(message_classes)
 
 
 def pack_protobuf_msg(cantools_dict: dict, msg_name: str, message_classes):
     if msg_name in message_classes:
         pb_msg = message_classes[msg_name]()
+        packer = _generated_packers.get(msg_name)
+        if packer is not None:
+            return packer(cantools_dict, pb_msg)
     for key in cantools_dict.keys():
         try:
             setattr(pb_msg, key, cantools_dict[key])
@@ -37,6 +79,7 @@ def pack_protobuf_msg(cantools_dict: dict, msg_name: str, message_classes):
                 setattr(pb_msg, key, converted_value)
                 # print(f"Successfully set {key} to {converted_value}")
             except ValueError:
+                _conversion_errors.value += 1
                 print(
                     f"Unable to convert {cantools_dict[key]} to {expected_type.__name__}"
                 )
@@ -0,0 +1,218 @@
+import os
+import mmap
+import struct
+import threading
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+from .clock import wall_time_ns
+from .metrics import registry
+
+# raw logs are named <session>_<file number>.canraw
+RAW_LOG_SUFFIX = ".canraw"
+# the next file while it is preallocated, renamed to its real name once it is started
+_NEXT_SUFFIX = ".next"
+
+_MAGIC = b"HTCANRAW"
+_VERSION = 1
+# magic, version, payload bytes per record, records the file has room for, closed flag, records
+# written (only set once closed), created time in ns, padded out to HEADER_SIZE
+_FILE_HEADER = struct.Struct("<8sHHIBxxxQq")
+HEADER_SIZE = 64
+_CLOSED_OFFSET = 16
+_COUNT_OFFSET = 20
+# receive time in ns, arbitration id, payload length, flags, then the payload. A receive time of 0
+# is a record that was never written, a preallocated file reads as zeros past the last frame
+_RECORD = struct.Struct("<qIBBxx")
+
+# flags bits
+FLAG_EXTENDED = 0x01
+FLAG_REMOTE = 0x02
+FLAG_ERROR = 0x04
+FLAG_FD = 0x08
+FLAG_BRS = 0x10
+FLAG_ESI = 0x20
+# the frame had more payload than the log keeps per record
+FLAG_TRUNCATED = 0x40
+
+
+def record_dtype(payload_size: int) -> np.dtype:
+    return np.dtype([
+        ("timestamp", "<i8"),
+        ("arbitration_id", "<u4"),
+        ("dlc", "u1"),
+        ("flags", "u1"),
+        ("pad", "V2"),
+        ("payload", "u1", (payload_size,)),
+    ])
+
+
+class RawFrameLog:
+    """Append only log of raw CAN frames in fixed size records, written into a preallocated,
+    memory mapped file so a frame costs one pack_into and no syscall.
+
+    Nothing is decoded, so frames the DBC doesnt know and frames that arrive while everything
+    else is behind are all kept. Files are records_per_file records long, the next one is
+    allocated in a thread while the current one fills up so a full file is just closed and the
+    next one renamed into place. write() is only ever called from one thread at a time.
+    """
+
+    def __init__(
+        self,
+        base_path: str,
+        records_per_file: int = 1024 * 1024,
+        payload_size: int = 8,
+        session_name: Optional[str] = None,
+    ):
+        self.base_path = base_path
+        self.records_per_file = records_per_file
+        self.payload_size = payload_size
+        self.record_size = _RECORD.size + payload_size
+        self.session_name = session_name or datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + "_raw"
+        self.file_number = 0
+        self.frames = registry.counter("raw_frames_captured_total", "Frames appended to the raw capture log")
+        self.truncated = registry.counter("raw_frames_truncated_total", "Frames whose payload did not fit a raw log record")
+        self.file = None
+        self.map = None
+        # (file, map) of the next file once the thread allocating it is done
+        self.next_file = None
+        self.next_thread = None
+        self._open_file()
+
+    def _file_path(self, file_number: int) -> str:
+        return os.path.join(self.base_path, f"{self.session_name}_{file_number:03d}{RAW_LOG_SUFFIX}")
+
+    def _allocate(self, path: str):
+        size = HEADER_SIZE + self.records_per_file * self.record_size
+        raw_file = open(path, "w+b")
+        try:
+            # really allocate the blocks up front so a full disk shows up here and not as a SIGBUS
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(raw_file.fileno(), 0, size)
+            else:
+                raw_file.truncate(size)
+            return raw_file, mmap.mmap(raw_file.fileno(), size)
+        except BaseException:
+            raw_file.close()
+            raise
+
+    def _allocate_next(self, path: str):
+        try:
+            self.next_file = self._allocate(path)
+        except OSError as e:
+            # the file gets allocated when it is needed instead, and fails there if it still cant
+            print(f"could not preallocate {path}: {e}")
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _take_next(self):
+        if self.next_thread is None:
+            return None
+        # long done unless the files are tiny
+        self.next_thread.join()
+        self.next_thread = None
+        next_file = self.next_file
+        self.next_file = None
+        return next_file
+
+    def _open_file(self):
+        self.path = self._file_path(self.file_number)
+        next_file = self._take_next()
+        if next_file is None:
+            self.file, self.map = self._allocate(self.path)
+        else:
+            os.rename(self.path + _NEXT_SUFFIX, self.path)
+            self.file, self.map = next_file
+        self.map[:_FILE_HEADER.size] = _FILE_HEADER.pack(
+            _MAGIC, _VERSION, self.payload_size, self.records_per_file, 0, 0, wall_time_ns()
+        )
+        self.count = 0
+        self.offset = HEADER_SIZE
+
+        # fallocate of a whole file is too slow for the thread write() runs on
+        self.next_thread = threading.Thread(
+            target=self._allocate_next,
+            args=(self._file_path(self.file_number + 1) + _NEXT_SUFFIX,),
+            name="raw_log_allocate",
+            daemon=True,
+        )
+        self.next_thread.start()
+
+    def _close_file(self):
+        # the count and closed flag tell a reader the file is done
+        struct.pack_into("<B", self.map, _CLOSED_OFFSET, 1)
+        struct.pack_into("<Q", self.map, _COUNT_OFFSET, self.count)
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+        self.map = None
+
+    def write(self, timestamp: int, arbitration_id: int, flags: int, data):
+        dlc = len(data)
+        if dlc > self.payload_size:
+            data = data[:self.payload_size]
+            flags |= FLAG_TRUNCATED
+            self.truncated.value += 1
+        if self.count == self.records_per_file:
+            self._close_file()
+            self.file_number += 1
+            self._open_file()
+        offset = self.offset
+        payload_start = offset + _RECORD.size
+        self.map[payload_start:payload_start + len(data)] = data
+        # the timestamp goes in with the rest of the record header, after the payload
+        _RECORD.pack_into(self.map, offset, timestamp, arbitration_id, dlc, flags)
+        self.offset = offset + self.record_size
+        self.count += 1
+        self.frames.value += 1
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        # only once whatever calls write() has stopped
+        if self.map is not None:
+            self._close_file()
+        next_file = self._take_next()
+        if next_file is not None:
+            raw_file, raw_map = next_file
+            raw_map.close()
+            raw_file.close()
+            os.remove(self._file_path(self.file_number + 1) + _NEXT_SUFFIX)
+
+
+def read_header(path: str) -> dict:
+    with open(path, "rb") as raw_file:
+        header = raw_file.read(_FILE_HEADER.size)
+    if len(header) < _FILE_HEADER.size:
+        raise ValueError(f"{os.path.basename(path)} is too short to be a raw log")
+    magic, version, payload_size, capacity, closed, count, created = _FILE_HEADER.unpack(header)
+    if magic != _MAGIC:
+        raise ValueError(f"{os.path.basename(path)} is not a raw log")
+    if version != _VERSION:
+        raise ValueError(f"{os.path.basename(path)} is raw log version {version}, expected {_VERSION}")
+    return {
+        "payload_size": payload_size,
+        "capacity": capacity,
+        "closed": bool(closed),
+        "count": count if closed else None,
+        "created": created,
+    }
+
+
+def read_raw_log(path: str) -> np.ndarray:
+    """Every frame in a raw log as a structured array (timestamp, arbitration_id, dlc, flags,
+    payload), read through a memory map. A file that was never closed, say after a power cut,
+    ends at the first record that was never written."""
+    header = read_header(path)
+    records = np.memmap(
+        path, dtype=record_dtype(header["payload_size"]), mode="r", offset=HEADER_SIZE, shape=(header["capacity"],)
+    )
+    count = header["count"]
+    if count is None:
+        unwritten = np.flatnonzero(records["timestamp"] == 0)
+        count = int(unwritten[0]) if len(unwritten) else header["capacity"]
+    return records[:count]
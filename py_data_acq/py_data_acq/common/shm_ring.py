@@ -0,0 +1,92 @@
+import struct
+import time
+from multiprocessing import shared_memory
+
+# write position (bytes ever written) then read position (bytes ever read), each only ever
+# changed by one side
+_HEADER = struct.Struct("<QQ")
+# payload length, timestamp in ns, index of the message name
+_RECORD = struct.Struct("<IqH")
+
+
+class SharedFrameRing:
+    """Single producer, single consumer byte ring in shared memory for decoded frames.
+
+    A bus process appends (timestamp, message index, serialized protobuf) records and publishes
+    how far it got, the main process copies out everything up to there and hands the space back.
+    The producer tells the consumer about new data over a pipe, which is also what orders the
+    writes into the ring before the consumer's reads out of it.
+    """
+
+    def __init__(self, name: str = None, size: int = 4 * 1024 * 1024, notify=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + size)
+            _HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = self.shm.size - _HEADER.size
+        # the producer's position, only published with publish()
+        self.write_pos = _HEADER.unpack_from(self.buf, 0)[0]
+        self.published_pos = self.write_pos
+        # called after every publish to wake the consumer up
+        self.notify = notify
+        self.full_waits = 0
+
+    def _copy_in(self, pos, data):
+        start = _HEADER.size + pos % self.capacity
+        first = min(len(data), _HEADER.size + self.capacity - start)
+        self.buf[start:start + first] = data[:first]
+        if first < len(data):
+            self.buf[_HEADER.size:_HEADER.size + len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, length):
+        start = _HEADER.size + pos % self.capacity
+        first = min(length, _HEADER.size + self.capacity - start)
+        if first == length:
+            return bytes(self.buf[start:start + length])
+        return bytes(self.buf[start:start + first]) + bytes(self.buf[_HEADER.size:_HEADER.size + length - first])
+
+    def write(self, timestamp: int, name_index: int, payload: bytes):
+        """Append one record, waits for the consumer while the ring is full"""
+        record_length = _RECORD.size + len(payload)
+        if record_length > self.capacity:
+            raise ValueError(f"record of {record_length} bytes does not fit a {self.capacity} byte ring")
+        while self.write_pos + record_length - self.read_pos() > self.capacity:
+            # the consumer can only free what it was told about
+            if self.published_pos != self.write_pos:
+                self.publish()
+            self.full_waits += 1
+            time.sleep(0.0005)
+        self._copy_in(self.write_pos, _RECORD.pack(len(payload), timestamp, name_index))
+        self._copy_in(self.write_pos + _RECORD.size, payload)
+        self.write_pos += record_length
+
+    def publish(self):
+        if self.published_pos == self.write_pos:
+            return
+        struct.pack_into("<Q", self.buf, 0, self.write_pos)
+        self.published_pos = self.write_pos
+        if self.notify is not None:
+            self.notify()
+
+    def read_pos(self) -> int:
+        return struct.unpack_from("<Q", self.buf, 8)[0]
+
+    def read_all(self) -> list:
+        """Copy out every published record as (timestamp, message index, payload) and free the space"""
+        write_pos, read_pos = _HEADER.unpack_from(self.buf, 0)
+        records = []
+        while read_pos < write_pos:
+            length, timestamp, name_index = _RECORD.unpack(self._copy_out(read_pos, _RECORD.size))
+            records.append((timestamp, name_index, self._copy_out(read_pos + _RECORD.size, length)))
+            read_pos += _RECORD.size + length
+        struct.pack_into("<Q", self.buf, 8, read_pos)
+        return records
+
+    def close(self, unlink: bool = False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
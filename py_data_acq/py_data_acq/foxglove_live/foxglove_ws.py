@@ -1,48 +1,182 @@
 import asyncio
 
-from py_data_acq.common.common_types import QueueData
-from typing import Any
+from py_data_acq.common.common_types import QueueData, QueueDataBatch, channel_topic
+from typing import Any, Optional
 
 from foxglove_websocket import run_cancellable
 
-from foxglove_websocket.server import FoxgloveServer
+from foxglove_websocket.server import FoxgloveServer, FoxgloveServerListener
 
 from base64 import standard_b64encode
 import time
+from py_data_acq.common.clock import wall_time_ns
+from py_data_acq.common.latency import StageLatency
+from py_data_acq.common.metrics import registry
+
+
+# keeps track of which channels at least one client is subscribed to, the foxglove server only
+# tells the listener about the first subscribe and the last unsubscribe of a channel
+class SubscriptionTracker(FoxgloveServerListener):
+    def __init__(self, foxglove_server: "HTProtobufFoxgloveServer"):
+        self.foxglove_server = foxglove_server
+
+    def on_subscribe(self, server: FoxgloveServer, channel_id):
+        self.foxglove_server.subscribed_channels.add(channel_id)
+        self.foxglove_server.subscriptions_changed()
+
+    def on_unsubscribe(self, server: FoxgloveServer, channel_id):
+        self.foxglove_server.subscribed_channels.discard(channel_id)
+        self.foxglove_server.latest.pop(channel_id, None)
+        self.foxglove_server.subscriptions_changed()
 
 
 # what I want to do with this class is extend the foxglove server to make it where it creates a protobuf schema
 # based foxglove server that serves data from an asyncio queue.
 class HTProtobufFoxgloveServer(FoxgloveServer):
-    def __init__(self, host: str, port: int, name: str, pb_bin_file_path: str, schema_names: list[str]):
-        super().__init__(host, port, name)
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        name: str,
+        pb_bin_file_path: str,
+        schema_names: list[str],
+        max_rate_hz: Optional[float] = None,
+        channel_rates: Optional[dict[str, float]] = None,
+        bus_names: Optional[list[str]] = None,
+        capabilities: Optional[list[str]] = None,
+        extra_schemas: Optional[dict[str, bytes]] = None,
+    ):
+        super().__init__(host, port, name, capabilities=capabilities or [])
         self.path = pb_bin_file_path
         self.schema_names = schema_names
         self.schema = standard_b64encode(open(pb_bin_file_path, "rb").read()).decode("ascii")
         self.chan_id_dict = {}
-        
+        # with several buses every message gets a channel per bus
+        self.bus_names = bus_names or [None]
+        # messages that dont come off a bus (derived signals), name -> serialized FileDescriptorSet
+        self.extra_schemas = {
+            name: standard_b64encode(schema).decode("ascii") for name, schema in (extra_schemas or {}).items()
+        }
+
+        # only channels somebody is subscribed to get sent at all
+        self.subscribed_channels = set()
+        self.set_listener(SubscriptionTracker(self))
+        # called with the set of subscribed message names every time it changes
+        self.subscription_listeners = []
+
+        # with a rate limit set, frames only replace the latest value of their channel and a flush
+        # task sends whatever is newest per channel at that channel's rate, so the websocket
+        # bandwidth is bounded by the rates and not by how busy the bus is
+        self.max_rate_hz = max_rate_hz
+        self.channel_rates = channel_rates or {}
+        self.rate_limited = max_rate_hz is not None or len(self.channel_rates) > 0
+        self.latest = {}
+        self.send_intervals = {}
+        self.next_send = {}
+        self.flush_task = None
+        self.latency = StageLatency(sink="foxglove")
+        self.messages_sent = registry.counter("messages_written_total", "Messages handed to each sink", sink="foxglove")
+        self.payload_bytes = registry.counter("payload_bytes_written_total", "Serialized message bytes handed to each sink", sink="foxglove")
+        self.unsubscribed_drops = registry.counter(
+            "foxglove_skipped_total", "Frames the live view did not send", reason="unsubscribed"
+        )
+        self.coalesced = registry.counter(
+            "foxglove_skipped_total", "Frames the live view did not send", reason="coalesced"
+        )
+        registry.gauge("foxglove_subscribed_channels", "Channels with at least one subscriber", lambda: len(self.subscribed_channels))
+
     # this is run when we use this in a with statement for context management
-    async def __aenter__(self): 
+    async def __aenter__(self):
         await super().__aenter__()
         # TODO add channels for all of the msgs that are in the protobuf schema
-        for name in self.schema_names:
-            self.chan_id_dict[name] = await super().add_channel(
-            {
-                "topic": name +"_data",
-                "encoding": "protobuf",
-                "schemaName": name,
-                "schema": self.schema,
-            }
-        )
+        for bus in self.bus_names:
+            for name in self.schema_names:
+                chan_id = await super().add_channel(
+                {
+                    "topic": channel_topic(name, bus),
+                    "encoding": "protobuf",
+                    "schemaName": name,
+                    "schema": self.schema,
+                }
+            )
+                self.chan_id_dict[(bus, name)] = chan_id
+                rate = self.channel_rates.get(name, self.max_rate_hz)
+                self.send_intervals[chan_id] = 0.0 if not rate else 1.0 / rate
+        for name, schema in self.extra_schemas.items():
+            chan_id = await super().add_channel(
+                {
+                    "topic": channel_topic(name),
+                    "encoding": "protobuf",
+                    "schemaName": name,
+                    "schema": schema,
+                }
+            )
+            self.chan_id_dict[(None, name)] = chan_id
+            rate = self.channel_rates.get(name, self.max_rate_hz)
+            self.send_intervals[chan_id] = 0.0 if not rate else 1.0 / rate
+        if self.rate_limited:
+            self.flush_task = asyncio.create_task(self.flush_latest())
         return self
 
+    def subscriptions_changed(self):
+        names = {name for (bus, name), chan_id in self.chan_id_dict.items() if chan_id in self.subscribed_channels}
+        for listener in self.subscription_listeners:
+            listener(names)
+
     async def __aexit__(self, exc_type: Any, exc_val: Any, traceback: Any):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
         return await super().__aexit__(exc_type, exc_val, traceback)
 
+    async def flush_latest(self):
+        # wake up at the fastest configured rate and send every channel that is due
+        rates = [rate for rate in list(self.channel_rates.values()) + [self.max_rate_hz] if rate]
+        tick = 1.0 / max(rates) if rates else 0.01
+        while True:
+            await asyncio.sleep(tick)
+            if not self.latest:
+                continue
+            now = time.monotonic()
+            due = [
+                chan_id for chan_id in self.latest
+                if now >= self.next_send.get(chan_id, 0.0)
+            ]
+            for chan_id in due:
+                data = self.latest.pop(chan_id)
+                self.next_send[chan_id] = now + self.send_intervals.get(chan_id, 0.0)
+                await self.send_timestamped(chan_id, data)
+
+    async def send_timestamped(self, chan_id, data: QueueData):
+        payload = data.data
+        if payload is None:
+            # could not be built, already counted as a decode error
+            return
+        # shown at the time the frame was received, same as in the mcap
+        self.latency.record_frame(data.timestamp, data.decoded, wall_time_ns())
+        self.messages_sent.value += 1
+        self.payload_bytes.value += len(payload)
+        await super().send_message(chan_id, data.timestamp, payload)
+
+    async def send_data(self, data: QueueData):
+        chan_id = self.chan_id_dict.get((data.bus, data.name))
+        if chan_id not in self.subscribed_channels:
+            self.unsubscribed_drops.value += 1
+            return
+        if self.rate_limited:
+            # latest value wins, the flush task does the sending
+            if chan_id in self.latest:
+                self.coalesced.value += 1
+            self.latest[chan_id] = data
+        else:
+            await self.send_timestamped(chan_id, data)
+
     async def send_msgs_from_queue(self, queue: asyncio.Queue[QueueData]):
         try:
             data = await queue.get()
-            if data is not None:
-                await super().send_message(self.chan_id_dict[data.name], time.time_ns(), data.data)
+            if isinstance(data, QueueDataBatch):
+                for msg in data:
+                    await self.send_data(msg)
+            elif data is not None:
+                await self.send_data(data)
         except asyncio.CancelledError:
             pass
@@ -0,0 +1,149 @@
+import asyncio
+from typing import List, Optional
+
+from foxglove_websocket.server import FoxgloveServer
+
+from py_data_acq.common.common_types import QueueData, parse_channel_topic
+from py_data_acq.foxglove_live.foxglove_ws import HTProtobufFoxgloveServer, SubscriptionTracker
+from py_data_acq.mcap_writer.recordings import RecordingReader
+
+# what the replay server has to tell foxglove it can do
+REPLAY_CAPABILITIES = ["parameters", "parametersSubscribe", "time"]
+
+# how often foxglove gets told the playback time, in seconds
+TIME_BROADCAST_INTERVAL = 0.05
+# how often subscribed clients get the replay parameters, mostly for replay_time
+PARAMETER_UPDATE_INTERVAL = 1.0
+# as fast as possible still lets everything else run after this many messages
+MAX_SPEED_YIELD = 256
+
+
+class ReplayPlayer:
+    """Plays a recording into a HTProtobufFoxgloveServer.
+
+    Messages go out on the same channels the live data uses at speed times real time, 0 sends them
+    as fast as the server takes them. seek, speed and pause changes apply from the next message.
+    """
+
+    def __init__(self, reader: RecordingReader, server: HTProtobufFoxgloveServer, speed: float = 1.0):
+        self.reader = reader
+        self.server = server
+        self.speed = speed
+        self.paused = False
+        # log time of the last message sent
+        self.position = reader.start_time
+        self.seek_to = reader.start_time
+        self.changed = asyncio.Event()
+        self.channel_names = {
+            channel_id: parse_channel_topic(channel.topic) for channel_id, channel in reader.channels.items()
+        }
+
+    def seek(self, log_time: int):
+        self.seek_to = min(max(log_time, self.reader.start_time), self.reader.end_time)
+        self.changed.set()
+
+    def set_speed(self, speed: float):
+        self.speed = max(speed, 0.0)
+        self.changed.set()
+
+    def set_paused(self, paused: bool):
+        self.paused = paused
+        self.changed.set()
+
+    def parameters(self) -> list:
+        return [
+            {"name": "replay_time", "value": (self.position - self.reader.start_time) / 1e9, "type": "float64"},
+            {"name": "replay_speed", "value": self.speed, "type": "float64"},
+            {"name": "replay_paused", "value": self.paused},
+        ]
+
+    async def _wait_until_due(self, log_time: int, anchor) -> Optional[tuple]:
+        """Waits until log_time is due or a seek comes in, returns the (log time, loop time)
+        playback is timed from"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.seek_to is not None:
+                return None
+            if self.paused:
+                self.changed.clear()
+                await self.changed.wait()
+                anchor = (self.position, loop.time())
+                continue
+            if self.speed <= 0:
+                return anchor
+            if anchor is None:
+                anchor = (log_time, loop.time())
+            delay = anchor[1] + (log_time - anchor[0]) / 1e9 / self.speed - loop.time()
+            if delay <= 0:
+                return anchor
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+                # speed changed, carry on from where playback is at the new speed
+                anchor = (self.position, loop.time())
+            except asyncio.TimeoutError:
+                return anchor
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start, self.seek_to = self.seek_to, None
+            self.position = start
+            anchor = None
+            last_time_broadcast = 0.0
+            sent = 0
+            for message in self.reader.messages(start):
+                anchor = await self._wait_until_due(message.log_time, anchor)
+                if self.seek_to is not None:
+                    break
+                name, bus = self.channel_names[message.channel_id]
+                await self.server.send_data(
+                    QueueData(name, None, bus=bus, data=message.data, timestamp=message.log_time)
+                )
+                self.position = message.log_time
+                now = loop.time()
+                if now - last_time_broadcast >= TIME_BROADCAST_INTERVAL:
+                    last_time_broadcast = now
+                    await self.server.broadcast_time(message.log_time)
+                sent += 1
+                if self.speed <= 0 and sent % MAX_SPEED_YIELD == 0:
+                    await asyncio.sleep(0)
+            else:
+                # end of the recording, hold there until somebody seeks
+                print("end of recording, seek to play again")
+                while self.seek_to is None:
+                    self.changed.clear()
+                    await self.changed.wait()
+
+    async def publish_parameters(self):
+        while True:
+            await asyncio.sleep(PARAMETER_UPDATE_INTERVAL)
+            await self.server.update_parameters(self.parameters())
+
+
+class ReplayControl(SubscriptionTracker):
+    """Seek, speed and pause from foxglove's parameters panel: replay_time is seconds from the
+    start of the recording, replay_speed 0 plays as fast as possible"""
+
+    def __init__(self, foxglove_server: HTProtobufFoxgloveServer, player: ReplayPlayer):
+        super().__init__(foxglove_server)
+        self.player = player
+
+    async def on_get_parameters(self, server: FoxgloveServer, param_names: List[str], request_id: Optional[str]):
+        return [param for param in self.player.parameters() if not param_names or param["name"] in param_names]
+
+    async def on_set_parameters(self, server: FoxgloveServer, params: list, request_id: Optional[str]):
+        for param in params:
+            value = param.get("value")
+            if value is None:
+                continue
+            if param["name"] == "replay_time":
+                self.player.seek(self.player.reader.start_time + int(float(value) * 1e9))
+            elif param["name"] == "replay_speed":
+                self.player.set_speed(float(value))
+            elif param["name"] == "replay_paused":
+                self.player.set_paused(bool(value))
+        return self.player.parameters()
+
+    async def on_parameters_subscribe(self, server: FoxgloveServer, param_names: List[str], subscribe: bool):
+        pass
@@ -1,9 +1,14 @@
 import os
 import can
 import asyncio
-import cantools
-from ..common import protobuf_helpers
 from ..common.common_types import QueueData
+from ..common.decode_plan import DecodePlan
+from ..common.fanout_bus import FanoutBus
+from ..common.batch_decode import BatchDecoder
+from ..common.clock import rx_timestamp_ns
+from ..common.metrics import registry
+from ..common.frame_policy import FramePolicy
+from ..common.raw_log import RawFrameLog, FLAG_EXTENDED, FLAG_REMOTE, FLAG_ERROR, FLAG_FD, FLAG_BRS, FLAG_ESI
 from can.interfaces.udp_multicast import UdpMulticastBus
 
 can_methods = {
@@ -44,32 +49,160 @@ def init_can():
     return bus
 
 
-async def can_receiver(can_msg_decoder: cantools.db.Database, message_classes, q1, q2):
-    # Get bus
-    can_bus = init_can()
+class RawCaptureListener(can.Listener):
+    """Appends every frame to a raw log straight from the notifier's thread, before anything is
+    decoded, so the log has every frame however far behind the rest of the pipeline is"""
+
+    def __init__(self, raw_log: RawFrameLog, policy: FramePolicy = None):
+        self.raw_log = raw_log
+        self.policy = policy
+
+    def on_message_received(self, msg: can.Message):
+        if self.policy is not None and not self.policy.wants_raw(msg.arbitration_id):
+            return
+        flags = 0
+        if msg.is_extended_id:
+            flags |= FLAG_EXTENDED
+        if msg.is_remote_frame:
+            flags |= FLAG_REMOTE
+        if msg.is_error_frame:
+            flags |= FLAG_ERROR
+        if msg.is_fd:
+            flags |= FLAG_FD
+            if msg.bitrate_switch:
+                flags |= FLAG_BRS
+            if msg.error_state_indicator:
+                flags |= FLAG_ESI
+        self.raw_log.write(rx_timestamp_ns(msg.timestamp), msg.arbitration_id, flags, msg.data)
+
+
+async def drain_can_messages(reader: can.AsyncBufferedReader, batch_size: int, batch_timeout: float):
+    # Wait for the first frame then take everything that is already buffered, and whatever
+    # shows up before the deadline, until the batch is full
+    loop = asyncio.get_running_loop()
+    buffer = reader.buffer
+    msg = await reader.get_message()
+    frames = [(msg.arbitration_id, rx_timestamp_ns(msg.timestamp), msg.data)]
+    deadline = loop.time() + batch_timeout
+
+    while len(frames) < batch_size:
+        if buffer.empty():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                msg = await asyncio.wait_for(buffer.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+        else:
+            msg = buffer.get_nowait()
+        frames.append((msg.arbitration_id, rx_timestamp_ns(msg.timestamp), msg.data))
+    return frames
+
+
+class EarlyFrameReader:
+    """Opens the bus and starts buffering frames right away, before the DBC and the protobuf
+    classes are loaded, so the frames of the first seconds after power on make it into the
+    recording. With a raw log those frames go into it from the start too, all of them until
+    can_receiver hands the listener its policy. can_receiver(early_reader=...) takes over the
+    buffer and the bus."""
+
+    def __init__(self, can_bus: can.BusABC = None, raw_log: RawFrameLog = None):
+        self.can_bus = init_can() if can_bus is None else can_bus
+        self.reader = can.AsyncBufferedReader()
+        listeners = [self.reader]
+        self.raw_listener = None
+        if raw_log is not None:
+            self.raw_listener = RawCaptureListener(raw_log)
+            listeners.append(self.raw_listener)
+        self.notifier = can.Notifier(self.can_bus, listeners, loop=asyncio.get_running_loop())
+
+
+async def can_receiver(
+    decode_plan: DecodePlan,
+    bus: FanoutBus,
+    batch_size: int = 0,
+    batch_timeout: float = 0.01,
+    can_bus: can.BusABC = None,
+    raw_log: RawFrameLog = None,
+    policy: FramePolicy = None,
+    early_reader: "EarlyFrameReader" = None,
+):
+    # Get bus, unless the caller already has one
+    if early_reader is not None:
+        can_bus = early_reader.can_bus
+    if can_bus is None:
+        can_bus = init_can()
+    # frames nobody wants are filtered out in the kernel, the rest only get decoded if they go
+    # somewhere other than the raw log
+    if policy is not None:
+        policy.add_listener(can_bus.set_filters)
 
     # Set some asyncio vars
     loop = asyncio.get_event_loop()
-    reader = can.AsyncBufferedReader()
-    notifier = can.Notifier(can_bus, [reader], loop=loop)
+    if early_reader is not None:
+        # carries on with the frames that came in while everything else was being set up
+        reader = early_reader.reader
+        notifier = early_reader.notifier
+        if early_reader.raw_listener is not None:
+            early_reader.raw_listener.policy = policy
+        elif raw_log is not None:
+            notifier.add_listener(RawCaptureListener(raw_log, policy))
+    else:
+        reader = can.AsyncBufferedReader()
+        listeners = [reader]
+        if raw_log is not None:
+            listeners.append(RawCaptureListener(raw_log, policy))
+        notifier = can.Notifier(can_bus, listeners, loop=loop)
+    frames_received = registry.counter("frames_received_total", "Frames read off each receiver", source="can")
 
-    while True:
-        # Wait for the next message from the buffer
-        msg = await reader.get_message()
-        try:
-            decoded_msg = can_msg_decoder.decode_message(
-                msg.arbitration_id, msg.data, decode_containers=True
-            )
-            msg = can_msg_decoder.get_message_by_frame_id(msg.arbitration_id)
-            msg = protobuf_helpers.pack_protobuf_msg(
-                decoded_msg, msg.name.lower(), message_classes
-            )
-            data = QueueData(msg.DESCRIPTOR.name, msg)
-            # await asyncio.sleep(1)
-            await q1.put(data)
-            await q2.put(data)
-        except:
-            pass
-
-    # Don't forget to stop the notifier to clean up resources.
-    notifier.stop()
+    try:
+        # Batch mode, hands every frame that is available (up to batch_size) downstream as one item
+        if batch_size > 0:
+            batch_decoder = BatchDecoder(decode_plan)
+            while True:
+                frames = await drain_can_messages(reader, batch_size, batch_timeout)
+                frames_received.value += len(frames)
+                if policy is not None:
+                    decode_ids = policy.decode_ids
+                    wanted = [frame for frame in frames if frame[0] in decode_ids]
+                    policy.skipped.value += len(frames) - len(wanted)
+                    frames = wanted
+                batch = batch_decoder.decode(frames)
+                if len(batch) == 0:
+                    continue
+                await bus.put(batch)
+
+        while True:
+            # Wait for the next message from the buffer
+            msg = await reader.get_message()
+            frames_received.value += 1
+            if policy is not None and msg.arbitration_id not in policy.decode_ids:
+                policy.skipped.value += 1
+                continue
+            pb_msg = decode_plan.pack(msg.arbitration_id, msg.data)
+            if pb_msg is None:
+                continue
+            data = QueueData(pb_msg.DESCRIPTOR.name, pb_msg, timestamp=rx_timestamp_ns(msg.timestamp))
+            await bus.put(data)
+    finally:
+        # Don't forget to stop the notifier to clean up resources.
+        notifier.stop()
+        if raw_log is not None:
+            raw_log.close()
+
+
+async def raw_capture_receiver(raw_log: RawFrameLog, can_bus: can.BusABC = None, policy: FramePolicy = None):
+    """Only appends frames to the raw log, decoding is left to raw-convert.py or the background
+    converter"""
+    if can_bus is None:
+        can_bus = init_can()
+    if policy is not None:
+        policy.add_listener(can_bus.set_filters)
+    notifier = can.Notifier(can_bus, [RawCaptureListener(raw_log, policy)], loop=asyncio.get_running_loop())
+    try:
+        # the notifier's thread does all the work
+        await asyncio.Event().wait()
+    finally:
+        notifier.stop()
+        raw_log.close()
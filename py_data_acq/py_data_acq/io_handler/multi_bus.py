@@ -0,0 +1,235 @@
+import heapq
+import asyncio
+import multiprocessing
+from collections import deque
+from typing import Optional
+
+import can
+import serial
+
+from ..common.common_types import QueueData, QueueDataBatch
+from ..common.decode_plan import DecodePlan
+from ..common.compiled_registry import load_registry
+from ..common.fanout_bus import FanoutBus
+from ..common.shm_ring import SharedFrameRing
+from ..common.clock import wall_time_ns, rx_timestamp_ns
+from ..common.metrics import registry
+from .can_handle import can_methods
+from .serial_handle import SerialFramer, serial_frame_lengths, READ_SIZE
+
+# most frames a bus process takes off its bus before publishing them
+MAX_READ_BATCH = 256
+
+
+class BusSpec:
+    """One bus to read, name is the prefix its topics get"""
+
+    def __init__(self, name: str, interface: str, channel):
+        if not name or "/" in name:
+            raise ValueError(f"bad bus name {name!r}")
+        self.name = name
+        self.interface = interface
+        self.channel = channel
+
+    def __repr__(self):
+        return f"BusSpec({self.name!r}, {self.interface!r}, {self.channel!r})"
+
+
+def parse_bus_specs(value: str) -> list[BusSpec]:
+    """Parse "name=interface:channel,..." e.g. "inverter=socketcan:can0,dash=serial:/dev/ttyACM0".
+    Instead of interface:channel an entry can name one of can_methods, e.g. "sim=debug"."""
+    specs = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, sep, source = entry.partition("=")
+        if not sep:
+            raise ValueError(f"bus {entry!r} is not name=interface:channel")
+        if source in can_methods:
+            channel, interface = can_methods[source]
+        else:
+            # udp multicast channels are ipv6 addresses, only the first : separates
+            interface, _, channel = source.partition(":")
+            if channel.isdigit():
+                channel = int(channel)
+        specs.append(BusSpec(name.strip(), interface, channel))
+    return specs
+
+
+def read_can_frames(spec: BusSpec, decode_plan: DecodePlan):
+    can_bus = can.Bus(interface=spec.interface, channel=spec.channel)
+    while True:
+        msg = can_bus.recv(timeout=0.1)
+        if msg is None:
+            continue
+        frames = []
+        while msg is not None and len(frames) < MAX_READ_BATCH:
+            # kernel receive timestamp when the interface has one
+            frames.append((msg.arbitration_id, rx_timestamp_ns(msg.timestamp), msg.data))
+            msg = can_bus.recv(timeout=0)
+        yield frames
+
+
+def read_serial_frames(spec: BusSpec, decode_plan: DecodePlan):
+    port = serial.Serial(spec.channel, baudrate=115200, timeout=0.1)
+    framer = SerialFramer(serial_frame_lengths(decode_plan))
+    while True:
+        data = port.read(min(max(port.in_waiting, 1), READ_SIZE))
+        if not data:
+            continue
+        rx_time = wall_time_ns()
+        yield [(frame_id, rx_time, bytes(payload)) for frame_id, payload in framer.feed(data)]
+
+
+def bus_worker(spec: BusSpec, dbc_path: str, msg_names: list[str], ring_name: str, conn, bin_path=None):
+    """Runs in the bus process, decodes everything off one bus into the shared ring"""
+    decode_plan = load_registry(dbc_path, bin_path).decode_plan
+    name_indexes = {name: index for index, name in enumerate(msg_names)}
+    ring = SharedFrameRing(ring_name, notify=lambda: conn.send_bytes(b""))
+
+    read_frames = read_serial_frames if spec.interface == "serial" else read_can_frames
+    print(f"bus {spec.name} reading {spec.interface} {spec.channel}")
+    for frames in read_frames(spec, decode_plan):
+        for frame_id, timestamp, payload in frames:
+            msg = decode_plan.pack(frame_id, payload)
+            if msg is None:
+                continue
+            ring.write(timestamp, name_indexes[msg.DESCRIPTOR.name], msg.SerializeToString())
+        ring.publish()
+
+
+class FrameMerger:
+    """Merges the per bus streams into one in timestamp order.
+
+    A frame is let out once every bus has sent something at least as new, or once it is
+    merge_delay old, so a quiet bus holds the others up by at most merge_delay.
+    """
+
+    def __init__(self, bus_count: int, merge_delay: float):
+        self.pending = [deque() for _ in range(bus_count)]
+        self.newest = [None] * bus_count
+        self.merge_delay_ns = int(merge_delay * 1e9)
+
+    def add(self, bus_index: int, records: list):
+        self.pending[bus_index].extend(records)
+        self.newest[bus_index] = records[-1][0]
+
+    def has_pending(self) -> bool:
+        return any(self.pending)
+
+    def pop_ready(self, now_ns: int) -> list:
+        """(timestamp, bus index, message index, payload) of every frame that can go out, oldest first"""
+        seen = [newest for newest in self.newest if newest is not None]
+        watermark = now_ns - self.merge_delay_ns
+        if len(seen) == len(self.newest):
+            watermark = max(watermark, min(seen))
+        ready = []
+        for bus_index, pending in enumerate(self.pending):
+            frames = []
+            while pending and pending[0][0] <= watermark:
+                timestamp, name_index, payload = pending.popleft()
+                frames.append((timestamp, bus_index, name_index, payload))
+            if frames:
+                ready.append(frames)
+        if len(ready) == 1:
+            return ready[0]
+        return list(heapq.merge(*ready, key=lambda frame: frame[0]))
+
+
+async def multi_bus_receiver(
+    specs: list[BusSpec],
+    dbc_path: str,
+    msg_names: list[str],
+    bus: FanoutBus,
+    merge_delay: float = 0.02,
+    ring_size: int = 4 * 1024 * 1024,
+    bin_path: Optional[str] = None,
+    msg_classes: Optional[dict] = None,
+):
+    """Read and decode every bus in its own process and put one merged stream on the bus.
+
+    Bus processes write serialized frames into a shared memory ring each and poke this process
+    over a pipe, here they only get copied out, merged by timestamp and tagged with their bus.
+    bin_path is where the bus processes find the generated protobuf packers. With msg_classes
+    the frames can be parsed again by consumers that need their signals (deadband, derived
+    signals), without them those only ever see the bytes.
+    """
+    loop = asyncio.get_running_loop()
+    classes = [msg_classes.get(name) for name in msg_names] if msg_classes else [None] * len(msg_names)
+    # spawn so the bus processes dont inherit this event loop
+    context = multiprocessing.get_context("spawn")
+    merger = FrameMerger(len(specs), merge_delay)
+    data_ready = asyncio.Event()
+    workers = []
+    # the bus processes have registries of their own, frames are counted here as they come out
+    frame_counters = [
+        [
+            registry.counter("bus_frames_total", "Frames merged per bus and message", bus=spec.name, message=name)
+            for name in msg_names
+        ]
+        for spec in specs
+    ]
+    for spec, pending in zip(specs, merger.pending):
+        registry.gauge(
+            "merge_pending_frames", "Frames held back by the merge per bus", lambda pending=pending: len(pending), bus=spec.name
+        )
+
+    def on_readable(bus_index):
+        spec, process, ring, conn = workers[bus_index]
+        try:
+            while conn.poll():
+                conn.recv_bytes()
+        except EOFError:
+            loop.remove_reader(conn.fileno())
+            print(f"bus process {spec.name} stopped")
+        records = ring.read_all()
+        if records:
+            merger.add(bus_index, records)
+            data_ready.set()
+
+    try:
+        for bus_index, spec in enumerate(specs):
+            ring = SharedFrameRing(size=ring_size)
+            conn, worker_conn = context.Pipe(duplex=False)
+            process = context.Process(
+                target=bus_worker,
+                args=(spec, dbc_path, msg_names, ring.name, worker_conn, bin_path),
+                name=f"bus_{spec.name}",
+                daemon=True,
+            )
+            process.start()
+            worker_conn.close()
+            workers.append((spec, process, ring, conn))
+            loop.add_reader(conn.fileno(), on_readable, bus_index)
+
+        while True:
+            try:
+                # with frames held back wake up in time to let them go once they are old enough
+                await asyncio.wait_for(data_ready.wait(), merge_delay if merger.has_pending() else None)
+            except asyncio.TimeoutError:
+                pass
+            data_ready.clear()
+            ready = merger.pop_ready(wall_time_ns())
+            if not ready:
+                continue
+            batch = QueueDataBatch()
+            for timestamp, bus_index, name_index, payload in ready:
+                frame_counters[bus_index][name_index].value += 1
+                data = QueueData(
+                    msg_names[name_index],
+                    None,
+                    bus=specs[bus_index].name,
+                    data=payload,
+                    timestamp=timestamp,
+                    msg_class=classes[name_index],
+                )
+                batch.add_queue_data(data, timestamp)
+            await bus.put(batch)
+    finally:
+        for spec, process, ring, conn in workers:
+            loop.remove_reader(conn.fileno())
+            process.terminate()
+            process.join(1)
+            conn.close()
+            ring.close(unlink=True)
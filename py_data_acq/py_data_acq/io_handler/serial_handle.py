@@ -1,39 +1,219 @@
+import asyncio
 import serial_asyncio
-import cantools
-from ..common import protobuf_helpers
 from ..common.common_types import QueueData
+from ..common.decode_plan import DecodePlan
+from ..common.fanout_bus import FanoutBus
+from ..common.batch_decode import BatchDecoder
+from ..common.clock import wall_time_ns
+from ..common.metrics import registry
 
+SYNC_SEQUENCE = b'\n\xff\n'
 
-async def serial_reciever(can_db: cantools.db.Database, message_classes, q1, q2):
+# how much is asked of the serial port per read
+READ_SIZE = 4096
+
+
+class SerialFramer:
+    """Splits the serial stream into frames without copying it around.
+
+    A frame on the wire is the frame id (2 bytes, little endian), the payload and SYNC_SEQUENCE.
+    Reads are copied into one preallocated buffer and frames are found in place, the payload
+    length comes from the DBC so a sync sequence inside a payload doesnt cut the frame. When the
+    sync sequence isnt where the DBC length says it should be (a dropped or corrupted byte) the
+    framer drops back to searching for the next sync sequence and carries on from there.
+
+    The wire format has no CRC or sequence number, the counters are how link errors show up.
+    """
+
+    def __init__(self, frame_lengths: dict[int, int], buffer_size: int = 65536):
+        self.frame_lengths = frame_lengths
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # unread bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # nothing before the first sync sequence can be trusted to be the start of a frame
+        self.in_sync = False
+
+        self.frames = 0
+        self.bytes = 0
+        self.resyncs = 0
+        self.length_errors = 0
+        self.unknown_ids = 0
+        self.discarded_bytes = 0
+
+    def feed(self, data):
+        """Yield (frame id, payload) for every complete frame once data is added. The payload is a
+        memoryview into the buffer, only valid until the generator is resumed."""
+        self.bytes += len(data)
+        offset = 0
+        while offset < len(data):
+            if self.start > 0:
+                # move what is left of a partial frame to the front, same size so the views
+                # handed out before stay legal
+                remaining = self.end - self.start
+                self.buffer[:remaining] = self.view[self.start:self.end]
+                self.start = 0
+                self.end = remaining
+            count = min(len(data) - offset, len(self.buffer) - self.end)
+            if count == 0:
+                # a buffer full of bytes that never made a frame, throw it away and resync
+                self.discarded_bytes += self.end
+                self.start = self.end = 0
+                self.in_sync = False
+                continue
+            self.buffer[self.end:self.end + count] = data[offset:offset + count]
+            self.end += count
+            offset += count
+            yield from self._scan()
+
+    def _lose_sync(self):
+        self.in_sync = False
+        self.resyncs += 1
+
+    def _scan(self):
+        buffer = self.buffer
+        view = self.view
+        frame_lengths = self.frame_lengths
+        sync_length = len(SYNC_SEQUENCE)
+        end = self.end
+        while True:
+            start = self.start
+            if not self.in_sync:
+                sync_at = buffer.find(SYNC_SEQUENCE, start, end)
+                if sync_at < 0:
+                    # keep a possible partial sync sequence at the end
+                    keep_from = max(start, end - (sync_length - 1))
+                    self.discarded_bytes += keep_from - start
+                    self.start = keep_from
+                    return
+                self.discarded_bytes += sync_at - start
+                self.start = sync_at + sync_length
+                self.in_sync = True
+                continue
+
+            if end - start < 2:
+                return
+            frame_id = buffer[start] | (buffer[start + 1] << 8)
+            length = frame_lengths.get(frame_id)
+            if length is None:
+                # either an id the DBC doesnt know or we are not where we think we are, in both
+                # cases the next sync sequence is the next place a frame starts
+                self.unknown_ids += 1
+                self._lose_sync()
+                continue
+            frame_end = start + 2 + length
+            if end - frame_end < sync_length:
+                return
+            if buffer[frame_end:frame_end + sync_length] != SYNC_SEQUENCE:
+                self.length_errors += 1
+                self._lose_sync()
+                self.start = start + 1
+                continue
+            self.start = frame_end + sync_length
+            self.frames += 1
+            yield frame_id, view[start + 2:frame_end]
+
+    def metrics(self) -> dict:
+        return {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "resyncs": self.resyncs,
+            "length_errors": self.length_errors,
+            "unknown_ids": self.unknown_ids,
+            "discarded_bytes": self.discarded_bytes,
+        }
+
+
+def serial_frame_lengths(decode_plan: DecodePlan) -> dict[int, int]:
+    return {frame_id: frame.length for frame_id, frame in decode_plan.frames.items()}
+
+
+def register_framer_metrics(framer: SerialFramer):
+    # the framer keeps its own counts, these just read them when scraped
+    registry.counter_callback(
+        "frames_received_total", "Frames read off each receiver", lambda: framer.frames, source="serial"
+    )
+    registry.counter_callback(
+        "serial_bytes_received_total", "Bytes read off the serial port", lambda: framer.bytes
+    )
+    for event in ("resyncs", "length_errors", "unknown_ids", "discarded_bytes"):
+        registry.counter_callback(
+            "serial_framing_errors_total",
+            "Serial framing problems, resyncs and the bytes they threw away",
+            lambda event=event: getattr(framer, event),
+            kind=event,
+        )
+
+
+async def drain_serial_frames(reader: asyncio.StreamReader, framer: SerialFramer, batch_size: int, batch_timeout: float):
+    # Wait for the first read then keep reading until the batch is full or the deadline passes,
+    # a read that gets cancelled doesnt take anything out of the stream
+    loop = asyncio.get_running_loop()
+    frames = []
+    deadline = None
+
+    while len(frames) < batch_size:
+        if deadline is None:
+            data = await reader.read(READ_SIZE)
+            deadline = loop.time() + batch_timeout
+        else:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                data = await asyncio.wait_for(reader.read(READ_SIZE), remaining)
+            except asyncio.TimeoutError:
+                break
+        if not data:
+            raise ConnectionError("serial port closed")
+        # the port has no timestamps of its own, everything in one read arrived by now
+        rx_time = wall_time_ns()
+        # the payloads outlive the framer's buffer here so they get copied
+        for frame_id, payload in framer.feed(data):
+            frames.append((frame_id, rx_time, bytes(payload)))
+    return frames
+
+
+async def serial_reciever(
+    decode_plan: DecodePlan,
+    bus: FanoutBus,
+    batch_size: int = 0,
+    batch_timeout: float = 0.01,
+    url: str = "/dev/xboi",
+    baudrate: int = 115200,
+):
     # Start asyncio on the port
     reader, writer = await serial_asyncio.open_serial_connection(
-        url="/dev/xboi", baudrate=115200
+        url=url, baudrate=baudrate
     )
+    framer = SerialFramer(serial_frame_lengths(decode_plan))
+    register_framer_metrics(framer)
+
+    # Batch mode, hands every frame that is available (up to batch_size) downstream as one item
+    if batch_size > 0:
+        batch_decoder = BatchDecoder(decode_plan)
+        while True:
+            frames = await drain_serial_frames(reader, framer, batch_size, batch_timeout)
+            batch = batch_decoder.decode(frames)
+            if len(batch) == 0:
+                continue
+            await bus.put(batch)
 
     while True:
-        try:
-            # if check_sync_byte(reader):
-            # Wait for the next message from the buffer, then break it into parts using the byte value for ","
-            decoded_msg = None
-            sync_msg = await reader.readuntil(b'\n\xff\n')
-            frameid = int.from_bytes(sync_msg[0:2], byteorder="little")
-            msg = can_db.get_message_by_frame_id(frameid)
-            payload = sync_msg[2:-3]
-            # Break down message
-            decoded_msg = can_db.decode_message(
-                frameid, payload, decode_containers=True, decode_choices=True
-            )
-            # Package as protobuf guy
-            msg = protobuf_helpers.pack_protobuf_msg(
-                decoded_msg, msg.name.lower(), message_classes
-            )
-            data = QueueData(msg.DESCRIPTOR.name, msg)
-            # Throw data into queues and start again
-            await q1.put(data)
-            await q2.put(data)
-
-        except (KeyError, TypeError, ValueError, IndexError) as e:
-            print(f"Error decoding frame, error : {e}")
-            if decoded_msg:
-                print(f"error msg: {decoded_msg}")
-            continue
+        # Read whatever the port has and pull every complete frame out of it
+        data = await reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionError("serial port closed")
+        rx_time = wall_time_ns()
+        decoded = []
+        for frameid, payload in framer.feed(data):
+            # Break down message and package as protobuf guy
+            msg = decode_plan.pack(frameid, payload)
+            if msg is None:
+                print(f"Error decoding frame, id: {frameid} payload: {payload.hex()}")
+                continue
+            decoded.append(QueueData(msg.DESCRIPTOR.name, msg, timestamp=rx_time))
+        # Throw data onto the bus and start again
+        for queue_data in decoded:
+            await bus.put(queue_data)
@@ -0,0 +1,168 @@
+import operator
+from typing import Optional
+
+from py_data_acq.common.metrics import registry
+from py_data_acq.mcap_writer.signal_summary import _NUMERIC_TYPES, _is_repeated
+
+# a threshold of this means write on any change at all
+CHANGE = 0.0
+
+_SECOND = 1_000_000_000
+
+
+class _ChannelState:
+    """Last written value of one channel plus the newest frame that was held back since. The
+    value is either the serialized bytes or a tuple of the compared signals"""
+
+    __slots__ = ("compiled", "last_time", "last_data", "last_values", "held")
+
+    def __init__(self):
+        self.compiled = None
+        self.last_time = None
+        self.last_data = None
+        self.last_values = None
+        self.held = None
+
+
+class _MessageRule:
+    """Thresholds of one message, compiled to the fields that get compared"""
+
+    def __init__(self, default: float, signals: dict):
+        self.default = default
+        self.signals = signals
+        # per message class: (getter, thresholds), None when the bytes can just be compared
+        self.compiled = {}
+
+    def compile(self, msg_class):
+        compiled = self.compiled.get(msg_class, False)
+        if compiled is not False:
+            return compiled
+        fields = []
+        thresholds = []
+        for field in msg_class.DESCRIPTOR.fields:
+            threshold = self.signals.get(field.name.lower(), self.default)
+            if field.cpp_type not in _NUMERIC_TYPES or _is_repeated(field):
+                # strings and the like only ever go on change
+                threshold = None
+            fields.append(field.name)
+            thresholds.append(threshold)
+        if all(threshold in (None, CHANGE) for threshold in thresholds):
+            # change only on every field, the serialized bytes say the same thing for free
+            compiled = None
+        else:
+            getter = operator.attrgetter(*fields)
+            get_values = (lambda msg: (getter(msg),)) if len(fields) == 1 else getter
+            compiled = (get_values, tuple(thresholds))
+        self.compiled[msg_class] = compiled
+        return compiled
+
+
+class DeadbandFilter:
+    """Change only / deadband logging. A message with a rule is only written when one of its
+    signals moved past its threshold since the last time it was written, everything else is
+    written as always.
+
+    Every channel is still written at least every keyframe_interval seconds so a recording can
+    be picked up anywhere, and when a change is written after frames were held back the last
+    held frame goes in first, so a plot holds the old value up to the change instead of ramping
+    from it.
+    """
+
+    def __init__(self, rules: dict, keyframe_interval: float = 1.0):
+        # message name (lower case) -> _MessageRule
+        self.rules = rules
+        self.keyframe_interval = int(keyframe_interval * _SECOND)
+        # (bus, name) -> _ChannelState
+        self.channels = {}
+        self.suppressed = registry.counter("messages_deadbanded_total", "Messages not written because their signals did not change enough")
+
+    @classmethod
+    def from_spec(cls, spec: str, keyframe_interval: float = 1.0) -> Optional["DeadbandFilter"]:
+        """From "BMS_Status=change,Wheel_Speeds=0.5,BMS_Status.Cell_Temp_Max=1", a message sets
+        the threshold of all its signals, message.signal just the one and the message's other
+        signals go on any change. None without any rules."""
+        thresholds = {}
+        for rule in spec.split(","):
+            if "=" not in rule:
+                continue
+            key, value = rule.split("=", 1)
+            value = value.strip().lower()
+            threshold = CHANGE if value == "change" else float(value)
+            if threshold < 0:
+                raise ValueError(f"deadband of {key.strip()} is negative")
+            name, _, signal = key.strip().lower().partition(".")
+            thresholds.setdefault(name, {})[signal or None] = threshold
+        if not thresholds:
+            return None
+        rules = {}
+        for name, signals in thresholds.items():
+            default = signals.pop(None, CHANGE)
+            rules[name] = _MessageRule(default, signals)
+        return cls(rules, keyframe_interval)
+
+    def flush(self) -> list:
+        """The frames still held back, for when nothing more is coming"""
+        held = [state.held for state in self.channels.values() if state.held is not None]
+        for state in self.channels.values():
+            state.held = None
+        return held
+
+    def reset(self):
+        # a new segment starts with every channel written once
+        self.channels.clear()
+
+    def filter(self, data) -> list:
+        """The frames to write for data: none while its signals stay inside the deadband, data
+        itself otherwise, preceded by the last frame held back if there was one"""
+        rule = self.rules.get(data.name.lower())
+        if rule is None:
+            return [data]
+        key = (data.bus, data.name)
+        state = self.channels.get(key)
+        if state is None:
+            state = self.channels[key] = _ChannelState()
+            pb_msg = data.pb_msg
+            # frames that only ever came as bytes can only be compared as bytes
+            state.compiled = None if pb_msg is None else rule.compile(type(pb_msg))
+            if pb_msg is None and any(threshold != CHANGE for threshold in (rule.default, *rule.signals.values())):
+                print(f"{data.name} only comes as bytes, its deadband is change only")
+
+        compiled = state.compiled
+        if state.last_time is None:
+            changed = True
+        elif compiled is None:
+            changed = data.data != state.last_data
+        else:
+            changed = self._moved(compiled, data.pb_msg, state.last_values)
+        keyframe = state.last_time is None or data.timestamp - state.last_time >= self.keyframe_interval
+        if not changed and not keyframe:
+            if state.held is not None:
+                self.suppressed.value += 1
+            state.held = data
+            return []
+
+        if compiled is None:
+            state.last_data = data.data
+        else:
+            state.last_values = compiled[0](data.pb_msg)
+        state.last_time = data.timestamp
+        held = state.held
+        state.held = None
+        if held is None:
+            return [data]
+        if not changed:
+            # a keyframe of the same value, the held frame adds nothing to it
+            self.suppressed.value += 1
+            return [data]
+        return [held, data]
+
+    @staticmethod
+    def _moved(compiled, pb_msg, last_values) -> bool:
+        get_values, thresholds = compiled
+        for value, last, threshold in zip(get_values(pb_msg), last_values, thresholds):
+            if threshold is None or threshold == CHANGE:
+                if value != last:
+                    return True
+            elif abs(value - last) > threshold:
+                return True
+        return False
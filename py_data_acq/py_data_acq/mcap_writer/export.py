@@ -0,0 +1,244 @@
+import os
+import math
+import operator
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from google.protobuf.descriptor import FieldDescriptor
+from mcap.reader import SeekingReader
+from mcap.records import Schema
+from mcap_protobuf.decoder import DecoderFactory
+
+from py_data_acq.common.common_types import parse_channel_topic
+from py_data_acq.mcap_writer.recordings import _read_chunk_messages
+from py_data_acq.mcap_writer.signal_summary import _is_repeated
+
+# arrow column type of every protobuf scalar type
+_ARROW_TYPES = {
+    FieldDescriptor.CPPTYPE_DOUBLE: pa.float64(),
+    FieldDescriptor.CPPTYPE_FLOAT: pa.float32(),
+    FieldDescriptor.CPPTYPE_INT32: pa.int32(),
+    FieldDescriptor.CPPTYPE_INT64: pa.int64(),
+    FieldDescriptor.CPPTYPE_UINT32: pa.uint32(),
+    FieldDescriptor.CPPTYPE_UINT64: pa.uint64(),
+    FieldDescriptor.CPPTYPE_BOOL: pa.bool_(),
+    FieldDescriptor.CPPTYPE_ENUM: pa.int32(),
+    FieldDescriptor.CPPTYPE_STRING: pa.string(),
+}
+
+TIME_COLUMN = "log_time"
+BUS_COLUMN = "bus"
+
+# rows of a message type that are collected before they are written out as one row group
+ROW_GROUP_ROWS = 64 * 1024
+# chunks handed to the pool ahead of the one being written, per worker
+JOBS_AHEAD = 2
+
+# per worker process: the open recording and a decoder per schema id
+_worker_state = {}
+
+
+def arrow_schema(descriptor, with_bus: bool) -> pa.Schema:
+    """Columns of a message type: the time index, the bus if there are several, then every scalar
+    field with the type its protobuf field has. Repeated and nested fields are left out."""
+    columns = [pa.field(TIME_COLUMN, pa.timestamp("ns", tz="UTC"))]
+    if with_bus:
+        columns.append(pa.field(BUS_COLUMN, pa.string()))
+    for field in descriptor.fields:
+        arrow_type = _ARROW_TYPES.get(field.cpp_type)
+        if arrow_type is None or _is_repeated(field):
+            continue
+        columns.append(pa.field(field.name, arrow_type))
+    return pa.schema(columns)
+
+
+def _worker_recording(path: str):
+    if _worker_state.get("path") != path:
+        if "recording" in _worker_state:
+            _worker_state["recording"].close()
+        _worker_state["path"] = path
+        _worker_state["recording"] = open(path, "rb")
+        _worker_state["factory"] = DecoderFactory()
+        _worker_state["decoders"] = {}
+    return _worker_state["recording"]
+
+
+def _worker_decoder(schemas: dict, schema_id: int):
+    decoder = _worker_state["decoders"].get(schema_id)
+    if decoder is None:
+        name, encoding, data = schemas[schema_id]
+        schema = Schema(id=schema_id, name=name, encoding=encoding, data=data)
+        decoder = _worker_state["decoders"][schema_id] = _worker_state["factory"].decoder_for("protobuf", schema)
+    return decoder
+
+
+def decode_chunk(path, chunk_index, channels, schemas, start_time, end_time, with_bus) -> dict:
+    """Runs in a pool worker, one table per message type of everything in one chunk.
+
+    channels is channel id -> (schema id, message name, bus) of the channels being exported,
+    schemas is schema id -> (name, encoding, data).
+    """
+    # message name -> (times, buses, messages)
+    rows = {}
+    for message in _read_chunk_messages(_worker_recording(path), chunk_index):
+        channel = channels.get(message.channel_id)
+        if channel is None:
+            continue
+        if start_time is not None and message.log_time < start_time:
+            continue
+        if end_time is not None and message.log_time >= end_time:
+            continue
+        schema_id, name, bus = channel
+        pb_msg = _worker_decoder(schemas, schema_id)(message.data)
+        columns = rows.get(name)
+        if columns is None:
+            columns = rows[name] = ([], [], [])
+        columns[0].append(message.log_time)
+        columns[1].append(bus)
+        columns[2].append(pb_msg)
+
+    tables = {}
+    for name, (times, buses, pb_msgs) in rows.items():
+        schema = arrow_schema(pb_msgs[0].DESCRIPTOR, with_bus)
+        field_names = schema.names[2 if with_bus else 1:]
+        arrays = [pa.array(times, schema.field(TIME_COLUMN).type)]
+        if with_bus:
+            arrays.append(pa.array(buses, pa.string()))
+        if field_names:
+            # one tuple per message, transposed into one list per field
+            get_fields = operator.attrgetter(*field_names)
+            values = [get_fields(pb_msg) for pb_msg in pb_msgs]
+            if len(field_names) == 1:
+                values = [(value,) for value in values]
+            for field_name, column in zip(field_names, zip(*values)):
+                arrays.append(pa.array(column, schema.field(field_name).type))
+        tables[name] = pa.Table.from_arrays(arrays, schema=schema)
+    return tables
+
+
+class _SortedTableWriter:
+    """Writes one message type's rows in time order. Chunks can overlap a little in time, so rows
+    are only written once no later chunk can have anything older, and in row groups of at least
+    ROW_GROUP_ROWS."""
+
+    def __init__(self, path: str, schema: pa.Schema, file_format: str):
+        self.pending = None
+        self.rows = 0
+        self.sink = None
+        if file_format == "parquet":
+            self.writer = pq.ParquetWriter(path, schema, compression="zstd")
+        else:
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = pa.ipc.new_file(self.sink, schema)
+
+    def add(self, table: Optional[pa.Table], flush_before: float):
+        if table is not None:
+            table = table if self.pending is None else pa.concat_tables([self.pending, table])
+            self.pending = table.sort_by(TIME_COLUMN)
+        if self.pending is None or self.pending.num_rows == 0:
+            return
+        if math.isinf(flush_before):
+            ready = self.pending.num_rows
+        else:
+            older = pc.less(self.pending[TIME_COLUMN].cast(pa.int64()), int(flush_before))
+            ready = pc.sum(older).as_py() or 0
+            if ready < ROW_GROUP_ROWS:
+                return
+        self.writer.write_table(self.pending.slice(0, ready))
+        self.rows += ready
+        self.pending = self.pending.slice(ready)
+
+    def close(self):
+        self.add(None, math.inf)
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+def export_recording(
+    path: str,
+    out_dir: str,
+    topics: Optional[Iterable[str]] = None,
+    start_time: Optional[int] = None,
+    end_time: Optional[int] = None,
+    file_format: str = "parquet",
+    workers: Optional[int] = None,
+) -> dict:
+    """Write one table per message type of a recording to out_dir as <message>.parquet (or
+    .arrow), returns the row count per message type.
+
+    topics can be topics or message names, in any case. Chunks that are outside [start_time, end_time) or
+    hold none of the topics are skipped with the chunk index, without reading them. The rest are
+    decoded in a process pool and written in log_time order, the column to use as the index.
+    """
+    if file_format not in ("parquet", "arrow"):
+        raise ValueError(f"unknown format {file_format}, expected parquet or arrow")
+    if topics is not None:
+        topics = {topic.lower() for topic in topics}
+
+    with open(path, "rb") as recording:
+        summary = SeekingReader(recording).get_summary()
+    if summary is None:
+        raise ValueError(f"{os.path.basename(path)} has no summary, recover it first")
+
+    channels = {}
+    for channel_id, channel in summary.channels.items():
+        name, bus = parse_channel_topic(channel.topic)
+        if topics is not None and channel.topic.lower() not in topics and name.lower() not in topics:
+            continue
+        if channel.schema_id == 0 or channel.message_encoding != "protobuf":
+            continue
+        channels[channel_id] = (channel.schema_id, name, bus)
+    schemas = {
+        schema_id: (schema.name, schema.encoding, schema.data)
+        for schema_id, schema in summary.schemas.items()
+    }
+    with_bus = any(bus is not None for _, _, bus in channels.values())
+
+    chunk_indexes = []
+    for chunk_index in summary.chunk_indexes:
+        if start_time is not None and chunk_index.message_end_time < start_time:
+            continue
+        if end_time is not None and chunk_index.message_start_time >= end_time:
+            continue
+        if chunk_index.message_index_offsets and channels.keys().isdisjoint(chunk_index.message_index_offsets):
+            continue
+        chunk_indexes.append(chunk_index)
+    chunk_indexes.sort(key=lambda chunk_index: chunk_index.message_start_time)
+
+    os.makedirs(out_dir, exist_ok=True)
+    writers = {}
+
+    def write(tables, flush_before):
+        for name, table in tables.items():
+            if name not in writers:
+                writers[name] = _SortedTableWriter(
+                    os.path.join(out_dir, f"{name}.{file_format}"), table.schema, file_format
+                )
+        for name, writer in writers.items():
+            writer.add(tables.get(name), flush_before)
+
+    workers = workers or os.cpu_count() or 1
+    # spawn so the workers dont inherit whatever threads the caller has running
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        in_flight = deque()
+        for position, chunk_index in enumerate(chunk_indexes):
+            in_flight.append(pool.submit(
+                decode_chunk, path, chunk_index, channels, schemas, start_time, end_time, with_bus
+            ))
+            if len(in_flight) > workers * JOBS_AHEAD:
+                done = position - len(in_flight) + 1
+                write(in_flight.popleft().result(), chunk_indexes[done + 1].message_start_time)
+        while in_flight:
+            done = len(chunk_indexes) - len(in_flight)
+            flush_before = chunk_indexes[done + 1].message_start_time if done + 1 < len(chunk_indexes) else math.inf
+            write(in_flight.popleft().result(), flush_before)
+
+    for writer in writers.values():
+        writer.close()
+    return {name: writer.rows for name, writer in writers.items()}
@@ -0,0 +1,125 @@
+import os
+import glob
+import time
+import multiprocessing
+from typing import Optional
+
+from py_data_acq.common.batch_decode import BatchDecoder
+from py_data_acq.common.decode_plan import DecodePlan
+from py_data_acq.common.compiled_registry import load_registry
+from py_data_acq.common.raw_log import RAW_LOG_SUFFIX, FLAG_ERROR, FLAG_REMOTE, read_header, read_raw_log
+from py_data_acq.mcap_writer.writer import HTPBMcapWriter, PARTIAL_SUFFIX
+
+# frames decoded at a time, big enough for the vectorized decode to pay off
+DECODE_BATCH = 4096
+
+
+def raw_log_session(path: str) -> str:
+    """Session name of the recording a raw log converts into"""
+    return os.path.basename(path).removesuffix(RAW_LOG_SUFFIX)
+
+
+def is_converted(path: str, out_dir: str) -> bool:
+    # the writer only leaves .part files behind if it didnt get to finish
+    prefix = os.path.join(out_dir, glob.escape(raw_log_session(path)))
+    return bool(glob.glob(prefix + "_*.mcap")) and not glob.glob(prefix + "_*.mcap" + PARTIAL_SUFFIX)
+
+
+def convert_raw_log(
+    path: str,
+    out_dir: str,
+    decode_plan: DecodePlan,
+    msg_names: list[str],
+    msg_classes,
+    max_segment_bytes: Optional[int] = 1024 * 1024 * 1024,
+) -> dict:
+    """Decode a raw log into a recording in out_dir, named after the raw log and written exactly
+    like a live one. Returns how many frames were written and how many were left out."""
+    records = read_raw_log(path)
+    writer = HTPBMcapWriter(
+        out_dir,
+        msg_names,
+        msg_classes,
+        max_segment_bytes=max_segment_bytes,
+        session_name=raw_log_session(path),
+    )
+    batch_decoder = BatchDecoder(decode_plan)
+    result = {"frames": len(records), "written": 0, "skipped": 0, "undecoded": 0}
+    with writer:
+        for start in range(0, len(records), DECODE_BATCH):
+            chunk = records[start:start + DECODE_BATCH]
+            frames = []
+            for timestamp, arbitration_id, dlc, flags, payload in zip(
+                chunk["timestamp"].tolist(),
+                chunk["arbitration_id"].tolist(),
+                chunk["dlc"].tolist(),
+                chunk["flags"].tolist(),
+                chunk["payload"],
+            ):
+                # error and remote frames have no signals to decode
+                if flags & (FLAG_ERROR | FLAG_REMOTE):
+                    result["skipped"] += 1
+                    continue
+                frames.append((arbitration_id, timestamp, payload[:dlc].tobytes()))
+            batch = batch_decoder.decode(frames)
+            result["undecoded"] += len(frames) - len(batch)
+            for data in batch:
+                writer.write_serialized(data)
+                result["written"] += 1
+            writer.rotate_if_due()
+    return result
+
+
+def _lower_priority():
+    os.nice(19)
+    # idle scheduling only runs this when nothing else wants the cpu, where the kernel has it
+    if hasattr(os, "sched_setscheduler") and hasattr(os, "SCHED_IDLE"):
+        try:
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+        except OSError:
+            pass
+
+
+def convert_in_background(
+    raw_dir: str,
+    out_dir: str,
+    dbc_path: str,
+    bin_path: str,
+    active_session: Optional[str] = None,
+    poll_interval: float = 10.0,
+):
+    """Runs in its own process at the lowest priority, converts every raw log in raw_dir that
+    has not been converted yet. Files of active_session are left alone until they are closed,
+    files of any other session are converted as they are, say after a power cut."""
+    _lower_priority()
+    compiled = load_registry(dbc_path, bin_path)
+    msg_names, msg_classes, decode_plan = compiled.msg_names, compiled.msg_classes, compiled.decode_plan
+    while True:
+        for path in sorted(glob.glob(os.path.join(glob.escape(raw_dir), "*" + RAW_LOG_SUFFIX))):
+            if is_converted(path, out_dir):
+                continue
+            try:
+                header = read_header(path)
+                if not header["closed"] and active_session and os.path.basename(path).startswith(active_session):
+                    continue
+                result = convert_raw_log(path, out_dir, decode_plan, msg_names, msg_classes)
+            except Exception as e:
+                print(f"could not convert {os.path.basename(path)}: {e}")
+                continue
+            print(f"converted {os.path.basename(path)}: {result}")
+        time.sleep(poll_interval)
+
+
+def start_background_converter(
+    raw_dir: str, out_dir: str, dbc_path: str, bin_path: str, active_session: Optional[str] = None
+) -> multiprocessing.Process:
+    # spawn so the converter doesnt inherit the event loop or the capture's open files
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(
+        target=convert_in_background,
+        args=(raw_dir, out_dir, dbc_path, bin_path, active_session),
+        name="raw_log_converter",
+        daemon=True,
+    )
+    process.start()
+    return process
@@ -0,0 +1,256 @@
+import io
+import os
+import heapq
+from typing import Iterable, Iterator, Optional
+
+from mcap.data_stream import ReadDataStream
+from mcap.reader import SeekingReader
+from mcap.records import Chunk, Message
+from mcap.stream_reader import breakup_chunk
+from mcap.writer import CompressionType, Writer
+
+from py_data_acq.mcap_writer.writer import PARTIAL_SUFFIX
+
+# size of the pieces files are sent in, big enough for the socket, small enough to not matter
+READ_SIZE = 64 * 1024
+
+# summaries keyed by file name, only re-read when a file's size or mtime changed
+_summary_cache = {}
+
+
+def recording_path(base_path: str, name: str) -> Optional[str]:
+    """Path of a recording in base_path, or None if name isnt a recording there. Only bare file
+    names are accepted so a request cant walk out of the recordings directory."""
+    if name != os.path.basename(name) or name.startswith("."):
+        return None
+    if not (name.endswith(".mcap") or name.endswith(".mcap" + PARTIAL_SUFFIX)):
+        return None
+    path = os.path.join(base_path, name)
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def recording_info(path: str) -> dict:
+    """Size, time range and message counts per topic of one recording, read from its summary"""
+    stat = os.stat(path)
+    name = os.path.basename(path)
+    cached = _summary_cache.get(name)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+
+    info = {
+        "name": name,
+        "bytes": stat.st_size,
+        # a .part file is still being written or was cut off, it has no summary to read
+        "complete": not name.endswith(PARTIAL_SUFFIX),
+        "start_time": None,
+        "end_time": None,
+        "message_count": None,
+        "topics": {},
+    }
+    if info["complete"]:
+        try:
+            with open(path, "rb") as mcap_file:
+                summary = SeekingReader(mcap_file).get_summary()
+        except Exception as e:
+            print(f"could not read summary of {name}: {e}")
+            summary = None
+        if summary is not None and summary.statistics is not None:
+            statistics = summary.statistics
+            info["start_time"] = statistics.message_start_time
+            info["end_time"] = statistics.message_end_time
+            info["message_count"] = statistics.message_count
+            info["topics"] = {
+                channel.topic: statistics.channel_message_counts.get(channel_id, 0)
+                for channel_id, channel in summary.channels.items()
+            }
+    _summary_cache[name] = ((stat.st_size, stat.st_mtime_ns), info)
+    return info
+
+
+def list_recordings(base_path: str) -> list[dict]:
+    """Every recording in base_path, newest first"""
+    recordings = []
+    for name in os.listdir(base_path):
+        path = recording_path(base_path, name)
+        if path is not None:
+            recordings.append(recording_info(path))
+    # drop cache entries for files that were deleted
+    names = {recording["name"] for recording in recordings}
+    for name in list(_summary_cache):
+        if name not in names:
+            del _summary_cache[name]
+    recordings.sort(key=lambda recording: recording["name"], reverse=True)
+    return recordings
+
+
+def iter_file(path: str, start: int = 0, length: Optional[int] = None) -> Iterator[bytes]:
+    """Yield length bytes of a file starting at start (to the end if length is None), one
+    READ_SIZE piece at a time"""
+    with open(path, "rb") as recording:
+        recording.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = READ_SIZE if remaining is None else min(READ_SIZE, remaining)
+            data = recording.read(size)
+            if not data:
+                return
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+
+class _PieceBuffer:
+    """File-like sink for the mcap writer that hands out what was written so far in pieces"""
+
+    def __init__(self):
+        self.pieces = []
+        self.offset = 0
+
+    def write(self, data):
+        self.pieces.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.pieces)
+        self.pieces = []
+        return data
+
+
+def _read_chunk_messages(recording, chunk_index) -> list:
+    # skip the opcode and record length
+    recording.seek(chunk_index.chunk_start_offset + 1 + 8, io.SEEK_SET)
+    chunk = Chunk.read(ReadDataStream(recording))
+    return [record for record in breakup_chunk(chunk) if isinstance(record, Message)]
+
+
+def iter_extract(
+    path: str,
+    start_time: Optional[int] = None,
+    end_time: Optional[int] = None,
+    topics: Optional[Iterable[str]] = None,
+) -> Iterator[bytes]:
+    """Yield a new MCAP with only the messages of path in [start_time, end_time) on the given
+    topics, without writing it anywhere.
+
+    Chunks are picked with the chunk index in the summary, so only the chunks that overlap the
+    time range and hold one of the topics are read and decompressed. Output comes out one source
+    chunk at a time.
+    """
+    if topics is not None:
+        topics = set(topics)
+    with open(path, "rb") as recording:
+        reader = SeekingReader(recording)
+        summary = reader.get_summary()
+        if summary is None:
+            raise ValueError(f"{os.path.basename(path)} has no summary, recover it first")
+        profile = reader.get_header().profile
+
+        wanted_channels = {
+            channel_id for channel_id, channel in summary.channels.items()
+            if topics is None or channel.topic in topics
+        }
+
+        output = _PieceBuffer()
+        writer = Writer(output, compression=CompressionType.ZSTD)
+        writer.start(profile=profile)
+        schema_ids = {}
+        channel_ids = {}
+        for channel_id in sorted(wanted_channels):
+            channel = summary.channels[channel_id]
+            if channel.schema_id != 0 and channel.schema_id not in schema_ids:
+                schema = summary.schemas[channel.schema_id]
+                schema_ids[channel.schema_id] = writer.register_schema(
+                    name=schema.name, encoding=schema.encoding, data=schema.data
+                )
+            channel_ids[channel_id] = writer.register_channel(
+                topic=channel.topic,
+                message_encoding=channel.message_encoding,
+                schema_id=schema_ids.get(channel.schema_id, 0),
+                metadata=channel.metadata,
+            )
+        yield output.take()
+
+        for chunk_index in summary.chunk_indexes:
+            if start_time is not None and chunk_index.message_end_time < start_time:
+                continue
+            if end_time is not None and chunk_index.message_start_time >= end_time:
+                continue
+            if chunk_index.message_index_offsets and wanted_channels.isdisjoint(chunk_index.message_index_offsets):
+                continue
+            for record in _read_chunk_messages(recording, chunk_index):
+                if record.channel_id not in wanted_channels:
+                    continue
+                if start_time is not None and record.log_time < start_time:
+                    continue
+                if end_time is not None and record.log_time >= end_time:
+                    continue
+                writer.add_message(
+                    channel_id=channel_ids[record.channel_id],
+                    log_time=record.log_time,
+                    data=record.data,
+                    publish_time=record.publish_time,
+                    sequence=record.sequence,
+                )
+            data = output.take()
+            if data:
+                yield data
+
+        writer.finish()
+        yield output.take()
+
+
+class RecordingReader:
+    """Messages of a finished recording in log time order, read a chunk at a time.
+
+    A chunk is only read and decompressed once playback gets to it and only the chunks that
+    overlap in time are held at once, so memory goes with the chunk size and not the file size.
+    Any point of the recording can be started from with the chunk index.
+    """
+
+    def __init__(self, path: str):
+        self.recording = open(path, "rb")
+        summary = SeekingReader(self.recording).get_summary()
+        if summary is None:
+            self.recording.close()
+            raise ValueError(f"{os.path.basename(path)} has no summary, recover it first")
+        self.schemas = summary.schemas
+        self.channels = summary.channels
+        # chunks from different buses or writer batches overlap a little in time
+        self.chunk_indexes = sorted(summary.chunk_indexes, key=lambda chunk_index: chunk_index.message_start_time)
+        self.start_time = min((chunk_index.message_start_time for chunk_index in self.chunk_indexes), default=0)
+        self.end_time = max((chunk_index.message_end_time for chunk_index in self.chunk_indexes), default=0)
+
+    def messages(self, start_time: Optional[int] = None) -> Iterator[Message]:
+        """Every message from start_time on, oldest first"""
+        chunk_indexes = [
+            chunk_index for chunk_index in self.chunk_indexes
+            if start_time is None or chunk_index.message_end_time >= start_time
+        ]
+        # (log time, read order, message) of the chunks read so far
+        pending = []
+        read_order = 0
+        next_chunk = 0
+        while next_chunk < len(chunk_indexes) or pending:
+            # read every chunk that could hold something older than the oldest pending message
+            while next_chunk < len(chunk_indexes) and (
+                not pending or chunk_indexes[next_chunk].message_start_time <= pending[0][0]
+            ):
+                for message in _read_chunk_messages(self.recording, chunk_indexes[next_chunk]):
+                    if start_time is None or message.log_time >= start_time:
+                        heapq.heappush(pending, (message.log_time, read_order, message))
+                        read_order += 1
+                next_chunk += 1
+            if pending:
+                yield heapq.heappop(pending)[2]
+
+    def close(self):
+        self.recording.close()
@@ -0,0 +1,314 @@
+import os
+import struct
+import zlib
+from io import BytesIO
+
+from mcap.data_stream import ReadDataStream, RecordBuilder
+from mcap.opcode import Opcode
+from mcap.records import (
+    AttachmentIndex,
+    Channel,
+    Chunk,
+    ChunkIndex,
+    DataEnd,
+    Footer,
+    MessageIndex,
+    MetadataIndex,
+    Schema,
+    Statistics,
+    SummaryOffset,
+)
+from mcap.stream_reader import get_chunk_data_stream
+from mcap.writer import MCAP0_MAGIC
+
+# opcode + record length that start every record
+_RECORD_HEADER = struct.Struct("<BQ")
+# channel id, sequence, log time, publish time at the start of a message record
+_MESSAGE_HEADER = struct.Struct("<HIQQ")
+# attachment log time and create time
+_ATTACHMENT_TIMES = struct.Struct("<QQ")
+
+
+def _read_records(input_file):
+    """Yield (offset, opcode, raw record bytes) until the end of the file or the first record
+    that is cut short. Only one record is ever held in memory."""
+    offset = len(MCAP0_MAGIC)
+    file_size = input_file.seek(0, os.SEEK_END)
+    input_file.seek(offset)
+    while True:
+        header = input_file.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            return
+        opcode, length = _RECORD_HEADER.unpack(header)
+        if opcode == 0:
+            # not a record, zeroes from preallocation or a filesystem that lost the tail
+            return
+        if length > file_size - offset - _RECORD_HEADER.size:
+            # cut short, or a garbage length that would otherwise be read into memory
+            return
+        body = input_file.read(length)
+        if len(body) < length:
+            return
+        yield offset, opcode, header + body
+        offset += _RECORD_HEADER.size + length
+
+
+def _chunk_contents(chunk: Chunk):
+    """Decompress a chunk and pull out its schemas, channels and (channel, log time, offset) of
+    every message, the offsets are what the message index records point at."""
+    stream, stream_length = get_chunk_data_stream(chunk, validate_crc=True)
+    data = stream.read(stream_length)
+    schemas = []
+    channels = []
+    messages = []
+    offset = 0
+    while offset < stream_length:
+        opcode, length = _RECORD_HEADER.unpack_from(data, offset)
+        body_start = offset + _RECORD_HEADER.size
+        if body_start + length > stream_length:
+            raise ValueError("chunk record runs past the end of the chunk")
+        if opcode == Opcode.MESSAGE:
+            channel_id, _, log_time, _ = _MESSAGE_HEADER.unpack_from(data, body_start)
+            messages.append((channel_id, log_time, offset))
+        elif opcode == Opcode.SCHEMA:
+            schemas.append(Schema.read(ReadDataStream(BytesIO(data[body_start:body_start + length]))))
+        elif opcode == Opcode.CHANNEL:
+            channels.append(Channel.read(ReadDataStream(BytesIO(data[body_start:body_start + length]))))
+        offset = body_start + length
+    return schemas, channels, messages
+
+
+class _IndexedMcapOutput:
+    """Writes records copied from a recording and builds the indexes and summary for them."""
+
+    def __init__(self, output_file):
+        self.output = output_file
+        self.offset = 0
+        self.schemas = {}
+        self.channels = {}
+        self.chunk_indexes = []
+        self.attachment_indexes = []
+        self.metadata_indexes = []
+        self.channel_message_counts = {}
+        self.message_count = 0
+        self.message_start_time = None
+        self.message_end_time = 0
+        self.attachment_count = 0
+        self.metadata_count = 0
+        self._write(MCAP0_MAGIC)
+
+    def _write(self, data):
+        self.output.write(data)
+        self.offset += len(data)
+
+    def _count_message(self, channel_id, log_time):
+        self.message_count += 1
+        self.channel_message_counts[channel_id] = self.channel_message_counts.get(channel_id, 0) + 1
+        if self.message_start_time is None or log_time < self.message_start_time:
+            self.message_start_time = log_time
+        if log_time > self.message_end_time:
+            self.message_end_time = log_time
+
+    def copy_record(self, raw):
+        self._write(raw)
+
+    def add_schema(self, schema: Schema, raw=None):
+        self.schemas.setdefault(schema.id, schema)
+        if raw is not None:
+            self._write(raw)
+
+    def add_channel(self, channel: Channel, raw=None):
+        self.channels.setdefault(channel.id, channel)
+        if raw is not None:
+            self._write(raw)
+
+    def add_message(self, raw):
+        channel_id, _, log_time, _ = _MESSAGE_HEADER.unpack_from(raw, _RECORD_HEADER.size)
+        self._count_message(channel_id, log_time)
+        self._write(raw)
+
+    def add_chunk(self, raw, chunk: Chunk):
+        # decode everything before writing anything so a bad chunk leaves the output untouched
+        schemas, channels, messages = _chunk_contents(chunk)
+        for schema in schemas:
+            self.add_schema(schema)
+        for channel in channels:
+            self.add_channel(channel)
+
+        chunk_start_offset = self.offset
+        self._write(raw)
+
+        message_indexes = {}
+        for channel_id, log_time, offset in messages:
+            message_indexes.setdefault(channel_id, []).append((log_time, offset))
+            self._count_message(channel_id, log_time)
+
+        builder = RecordBuilder()
+        message_index_start = self.offset
+        message_index_offsets = {}
+        for channel_id, records in message_indexes.items():
+            message_index_offsets[channel_id] = message_index_start + builder.count
+            records.sort()
+            MessageIndex(channel_id=channel_id, records=records).write(builder)
+        message_index_data = builder.end()
+        self._write(message_index_data)
+
+        self.chunk_indexes.append(
+            ChunkIndex(
+                message_start_time=chunk.message_start_time,
+                message_end_time=chunk.message_end_time,
+                chunk_start_offset=chunk_start_offset,
+                chunk_length=len(raw),
+                message_index_offsets=message_index_offsets,
+                message_index_length=len(message_index_data),
+                compression=chunk.compression,
+                compressed_size=len(chunk.data),
+                uncompressed_size=chunk.uncompressed_size,
+            )
+        )
+
+    def add_attachment(self, raw):
+        body = raw[_RECORD_HEADER.size:]
+        log_time, create_time = _ATTACHMENT_TIMES.unpack_from(body, 0)
+        stream = ReadDataStream(BytesIO(body[_ATTACHMENT_TIMES.size:]))
+        name = stream.read_prefixed_string()
+        media_type = stream.read_prefixed_string()
+        data_size = stream.read8()
+        self.attachment_indexes.append(
+            AttachmentIndex(
+                offset=self.offset,
+                length=len(raw),
+                log_time=log_time,
+                create_time=create_time,
+                data_size=data_size,
+                name=name,
+                media_type=media_type,
+            )
+        )
+        self.attachment_count += 1
+        self._write(raw)
+
+    def add_metadata(self, raw):
+        stream = ReadDataStream(BytesIO(raw[_RECORD_HEADER.size:]))
+        self.metadata_indexes.append(
+            MetadataIndex(offset=self.offset, length=len(raw), name=stream.read_prefixed_string())
+        )
+        self.metadata_count += 1
+        self._write(raw)
+
+    def finish(self):
+        # same summary layout the mcap writer produces
+        builder = RecordBuilder()
+        DataEnd(data_section_crc=0).write(builder)
+        self._write(builder.end())
+
+        summary_start = self.offset
+        summary_offsets = []
+
+        def write_group(opcode, records):
+            group_start = builder.count
+            for record in records:
+                record.write(builder)
+            summary_offsets.append(
+                SummaryOffset(
+                    group_opcode=opcode,
+                    group_start=summary_start + group_start,
+                    group_length=builder.count - group_start,
+                )
+            )
+
+        write_group(Opcode.SCHEMA, self.schemas.values())
+        write_group(Opcode.CHANNEL, self.channels.values())
+        write_group(
+            Opcode.STATISTICS,
+            [
+                Statistics(
+                    message_count=self.message_count,
+                    schema_count=len(self.schemas),
+                    channel_count=len(self.channels),
+                    attachment_count=self.attachment_count,
+                    metadata_count=self.metadata_count,
+                    chunk_count=len(self.chunk_indexes),
+                    message_start_time=self.message_start_time or 0,
+                    message_end_time=self.message_end_time,
+                    channel_message_counts=self.channel_message_counts,
+                )
+            ],
+        )
+        write_group(Opcode.CHUNK_INDEX, self.chunk_indexes)
+        write_group(Opcode.ATTACHMENT_INDEX, self.attachment_indexes)
+        write_group(Opcode.METADATA_INDEX, self.metadata_indexes)
+
+        summary_offset_start = summary_start + builder.count
+        for summary_offset in summary_offsets:
+            summary_offset.write(builder)
+        summary_data = builder.end()
+
+        summary_crc = zlib.crc32(summary_data)
+        summary_crc = zlib.crc32(
+            struct.pack("<BQQQ", Opcode.FOOTER, 8 + 8 + 4, summary_start, summary_offset_start),
+            summary_crc,
+        )
+        self._write(summary_data)
+        Footer(
+            summary_start=summary_start,
+            summary_offset_start=summary_offset_start,
+            summary_crc=summary_crc,
+        ).write(builder)
+        self._write(builder.end())
+        self._write(MCAP0_MAGIC)
+
+
+def recover_mcap(input_path: str, output_path: str) -> dict:
+    """Rebuild a valid, indexed MCAP from a recording that was cut off (no footer / summary).
+
+    The input is read in one streaming pass, one record at a time. Chunks are copied as they are,
+    only decompressed to rebuild their message indexes, so this runs at about disk speed. Reading
+    stops at the first record that is truncated or fails its CRC, everything before it ends up in
+    the output.
+    """
+    with open(input_path, "rb") as input_file, open(output_path, "wb") as output_file:
+        if input_file.read(len(MCAP0_MAGIC)) != MCAP0_MAGIC:
+            raise ValueError(f"{input_path} is not an MCAP file")
+
+        output = _IndexedMcapOutput(output_file)
+        recovered_up_to = len(MCAP0_MAGIC)
+        complete = False
+        for offset, opcode, raw in _read_records(input_file):
+            body_stream = ReadDataStream(BytesIO(raw[_RECORD_HEADER.size:]))
+            try:
+                if opcode == Opcode.HEADER:
+                    output.copy_record(raw)
+                elif opcode == Opcode.CHUNK:
+                    output.add_chunk(raw, Chunk.read(body_stream))
+                elif opcode == Opcode.MESSAGE:
+                    output.add_message(raw)
+                elif opcode == Opcode.SCHEMA:
+                    output.add_schema(Schema.read(body_stream), raw)
+                elif opcode == Opcode.CHANNEL:
+                    output.add_channel(Channel.read(body_stream), raw)
+                elif opcode == Opcode.ATTACHMENT:
+                    output.add_attachment(raw)
+                elif opcode == Opcode.METADATA:
+                    output.add_metadata(raw)
+                elif opcode in (Opcode.DATA_END, Opcode.FOOTER):
+                    # the data section made it to disk in full
+                    complete = True
+                    break
+                # message indexes get rebuilt, anything else in the data section is dropped
+            except Exception:
+                # a record that was overwritten or only partly flushed, the error depends on where
+                # it broke (struct, crc, zstd / lz4 frame errors) and all of them mean stop here
+                break
+            recovered_up_to = offset + len(raw)
+
+        output.finish()
+
+    return {
+        "messages": output.message_count,
+        "chunks": len(output.chunk_indexes),
+        "channels": len(output.channels),
+        "complete": complete,
+        # everything in the input before this byte offset made it into the output
+        "recovered_bytes": recovered_up_to,
+    }
@@ -0,0 +1,231 @@
+import io
+import operator
+from typing import Iterable, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from google.protobuf.descriptor import FieldDescriptor
+from mcap.reader import SeekingReader
+
+# bucket widths in seconds, the coarser ones are rolled up from the 1 s buckets
+RESOLUTIONS = (1, 10, 60)
+
+# every segment carries its summary as an mcap attachment of this name
+ATTACHMENT_NAME = "signal_summary.arrow"
+MEDIA_TYPE = "application/vnd.apache.arrow.file"
+
+_NUMERIC_TYPES = {
+    FieldDescriptor.CPPTYPE_DOUBLE,
+    FieldDescriptor.CPPTYPE_FLOAT,
+    FieldDescriptor.CPPTYPE_INT32,
+    FieldDescriptor.CPPTYPE_INT64,
+    FieldDescriptor.CPPTYPE_UINT32,
+    FieldDescriptor.CPPTYPE_UINT64,
+    FieldDescriptor.CPPTYPE_BOOL,
+    FieldDescriptor.CPPTYPE_ENUM,
+}
+
+# one row per topic, signal, resolution and bucket. topic and signal repeat a lot so they are
+# dictionary encoded, start_time is the bucket start in ns
+SCHEMA = pa.schema([
+    pa.field("topic", pa.dictionary(pa.int32(), pa.string())),
+    pa.field("signal", pa.dictionary(pa.int32(), pa.string())),
+    pa.field("resolution", pa.uint16()),
+    pa.field("start_time", pa.int64()),
+    pa.field("count", pa.uint32()),
+    pa.field("min", pa.float64()),
+    pa.field("max", pa.float64()),
+    pa.field("mean", pa.float64()),
+])
+
+_SECOND = 1_000_000_000
+
+
+def _is_repeated(field) -> bool:
+    # newer protobuf releases dropped label
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+    return field.label == FieldDescriptor.LABEL_REPEATED
+
+
+class _ChannelSummary:
+    """1 s buckets of one channel. Values of the current second are only collected, they get
+    reduced with numpy once the channel moves on to the next second."""
+
+    def __init__(self, topic: str, msg_class):
+        self.topic = topic
+        self.msg_class = msg_class
+        self.signals = [
+            field.name for field in msg_class.DESCRIPTOR.fields
+            if field.cpp_type in _NUMERIC_TYPES and not _is_repeated(field)
+        ]
+        getter = operator.attrgetter(*self.signals) if self.signals else None
+        if len(self.signals) == 1:
+            self.get_values = lambda pb_msg: (getter(pb_msg),)
+        else:
+            self.get_values = getter
+        self.second = None
+        self.rows = []
+        # second -> [count, min, max, sum], the last three one value per signal
+        self.buckets = {}
+
+    def add(self, log_time: int, pb_msg):
+        second = log_time // _SECOND
+        if second != self.second:
+            self.close_second()
+            self.second = second
+        self.rows.append(self.get_values(pb_msg))
+
+    def close_second(self):
+        if not self.rows:
+            return
+        values = np.array(self.rows, dtype=np.float64)
+        self.rows = []
+        bucket = self.buckets.get(self.second)
+        if bucket is None:
+            self.buckets[self.second] = [len(values), values.min(0), values.max(0), values.sum(0)]
+        else:
+            # a late frame for a second the channel had already moved on from
+            bucket[0] += len(values)
+            bucket[1] = np.minimum(bucket[1], values.min(0))
+            bucket[2] = np.maximum(bucket[2], values.max(0))
+            bucket[3] = bucket[3] + values.sum(0)
+
+    def tables(self) -> list:
+        self.close_second()
+        if not self.buckets or not self.signals:
+            return []
+        seconds = np.array(sorted(self.buckets), dtype=np.int64)
+        buckets = [self.buckets[second] for second in seconds]
+        counts = np.array([bucket[0] for bucket in buckets], dtype=np.int64)
+        mins = np.stack([bucket[1] for bucket in buckets])
+        maxs = np.stack([bucket[2] for bucket in buckets])
+        sums = np.stack([bucket[3] for bucket in buckets])
+
+        tables = []
+        for resolution in RESOLUTIONS:
+            starts = seconds // resolution
+            # index of the first 1 s bucket of every coarser bucket
+            firsts = np.flatnonzero(np.diff(starts, prepend=starts[0] - 1))
+            bucket_counts = np.add.reduceat(counts, firsts)
+            bucket_mins = np.minimum.reduceat(mins, firsts)
+            bucket_maxs = np.maximum.reduceat(maxs, firsts)
+            bucket_means = np.add.reduceat(sums, firsts) / bucket_counts[:, None]
+            rows = len(firsts)
+            # signal major, so each signal's buckets end up next to each other
+            tables.append(pa.table({
+                "topic": pa.array([self.topic] * rows * len(self.signals)),
+                "signal": pa.array(np.repeat(self.signals, rows)),
+                "resolution": pa.array(np.full(rows * len(self.signals), resolution), pa.uint16()),
+                "start_time": np.tile(starts[firsts] * resolution * _SECOND, len(self.signals)),
+                "count": pa.array(np.tile(bucket_counts, len(self.signals)), pa.uint32()),
+                "min": bucket_mins.T.ravel(),
+                "max": bucket_maxs.T.ravel(),
+                "mean": bucket_means.T.ravel(),
+            }))
+        return tables
+
+
+class SignalSummary:
+    """Min, max, mean and count of every numeric signal in 1 s, 10 s and 60 s buckets, built up
+    while a segment is written so an overview of a recording never has to decode it.
+
+    Buckets are aligned to whole seconds of log time. to_bytes() is an arrow ipc file, which the
+    writer attaches to the segment when it is finished.
+    """
+
+    def __init__(self):
+        self.channels = {}
+
+    def add_channel(self, channel_id: int, topic: str, msg_class):
+        self.channels[channel_id] = _ChannelSummary(topic, msg_class)
+
+    def add(self, channel_id: int, log_time: int, pb_msg):
+        channel = self.channels.get(channel_id)
+        if channel is not None and channel.signals:
+            channel.add(log_time, pb_msg)
+
+    def add_serialized(self, channel_id: int, log_time: int, data: bytes):
+        channel = self.channels.get(channel_id)
+        if channel is not None and channel.signals:
+            channel.add(log_time, channel.msg_class.FromString(data))
+
+    def table(self) -> pa.Table:
+        tables = [table for channel in self.channels.values() for table in channel.tables()]
+        if not tables:
+            return SCHEMA.empty_table()
+        # one chunk so the ipc file gets a single dictionary per column
+        return pa.concat_tables(tables).combine_chunks().cast(SCHEMA)
+
+    def to_bytes(self) -> bytes:
+        sink = pa.BufferOutputStream()
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        with pa.ipc.new_file(sink, SCHEMA, options=options) as writer:
+            writer.write_table(self.table())
+        return sink.getvalue().to_pybytes()
+
+
+def _merge_segments(table: pa.Table) -> pa.Table:
+    # a bucket that straddles a segment rotation shows up once in each segment
+    table = table.append_column("sum", pc.multiply(table["mean"], table["count"].cast(pa.float64())))
+    merged = table.group_by(["topic", "signal", "resolution", "start_time"], use_threads=False).aggregate(
+        [("count", "sum"), ("min", "min"), ("max", "max"), ("sum", "sum")]
+    )
+    return pa.table({
+        "topic": merged["topic"],
+        "signal": merged["signal"],
+        "resolution": merged["resolution"],
+        "start_time": merged["start_time"],
+        "count": merged["count_sum"].cast(pa.uint32()),
+        "min": merged["min_min"],
+        "max": merged["max_max"],
+        "mean": pc.divide(merged["sum_sum"], merged["count_sum"].cast(pa.float64())),
+    })
+
+
+def read_signal_summary(
+    paths: Iterable[str],
+    resolution: Optional[int] = None,
+    topics: Optional[Iterable[str]] = None,
+    signals: Optional[Iterable[str]] = None,
+) -> Optional[pa.Table]:
+    """The summaries of one or more segments as one table sorted by topic, signal, resolution and
+    start time, or None if none of them have one.
+
+    Only the attachment is read, found through the summary section. topics and signals filter
+    case insensitively.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    tables = []
+    for path in paths:
+        with open(path, "rb") as recording:
+            reader = SeekingReader(recording)
+            summary = reader.get_summary()
+            if summary is None:
+                continue
+            for attachment_index in summary.attachment_indexes:
+                if attachment_index.name != ATTACHMENT_NAME:
+                    continue
+                # the data is the last field of the record, right before its crc
+                recording.seek(attachment_index.offset + attachment_index.length - 4 - attachment_index.data_size)
+                data = recording.read(attachment_index.data_size)
+                tables.append(pa.ipc.open_file(io.BytesIO(data)).read_all())
+    if not tables:
+        return None
+    # plain strings again, the dictionaries only keep the attachment small
+    table = pa.concat_tables(tables)
+    for column in ("topic", "signal"):
+        table = table.set_column(table.schema.get_field_index(column), column, table[column].cast(pa.string()))
+    if resolution is not None:
+        table = table.filter(pc.equal(table["resolution"], resolution))
+    if topics is not None:
+        topics = [topic.lower() for topic in topics]
+        table = table.filter(pc.is_in(pc.utf8_lower(table["topic"]), pa.array(topics)))
+    if signals is not None:
+        signals = [signal.lower() for signal in signals]
+        table = table.filter(pc.is_in(pc.utf8_lower(table["signal"]), pa.array(signals)))
+    if len(tables) > 1:
+        table = _merge_segments(table)
+    return table.sort_by([("topic", "ascending"), ("signal", "ascending"), ("resolution", "ascending"), ("start_time", "ascending")])
@@ -1,7 +1,12 @@
 import asyncio
 
 import time
+import threading
+from queue import Queue, Full
 from mcap_protobuf.writer import Writer
+from mcap_protobuf.schema import register_schema
+from mcap.well_known import MessageEncoding
+from mcap.writer import CompressionType
 from datetime import datetime
 from typing import (
     Any,
@@ -9,17 +14,218 @@ from typing import (
     Set
 )
 import os
+import json
+from py_data_acq.common.common_types import QueueDataBatch, channel_topic
+from py_data_acq.common.clock import wall_time_ns
+from py_data_acq.common.latency import StageLatency
+from py_data_acq.common.metrics import registry
+from py_data_acq.mcap_writer.signal_summary import SignalSummary, ATTACHMENT_NAME, MEDIA_TYPE
+from py_data_acq.mcap_writer.deadband import DeadbandFilter
+
+COMPRESSION_TYPES = {
+    "zstd": CompressionType.ZSTD,
+    "lz4": CompressionType.LZ4,
+    "none": CompressionType.NONE,
+}
+
+# segments are written under this suffix and only renamed to .mcap once they have a full summary,
+# so a .mcap file is always complete and a .part file is what was being written at a power cut
+PARTIAL_SUFFIX = ".part"
+
 
 class HTPBMcapWriter(Writer):
-    def __init__(self, mcap_base_path, msg_names: list[str], msg_classes):
+    def __init__(
+        self,
+        mcap_base_path,
+        msg_names: list[str],
+        msg_classes,
+        threaded: bool = False,
+        compression: str = "zstd",
+        chunk_size: int = 1024 * 1024,
+        handoff_size: int = 512,
+        max_pending_batches: int = 64,
+        max_segment_duration: Optional[float] = None,
+        max_segment_bytes: Optional[int] = None,
+        bus_names: Optional[list[str]] = None,
+        signal_summary: bool = True,
+        session_name: Optional[str] = None,
+        not_logged: Optional[Set[str]] = None,
+        deadband: Optional[DeadbandFilter] = None,
+        extra_classes: Optional[dict] = None,
+    ):
         self.base_path = mcap_base_path
         messages = msg_names
         self.message_classes = msg_classes
-        now = datetime.now()
-        date_time_filename = now.strftime("%m_%d_%Y_%H_%M_%S"+".mcap")
-        self.actual_path = os.path.join(mcap_base_path, date_time_filename)
-        self.writing_file = open(self.actual_path, "wb")
-        super().__init__(self.writing_file)
+        self.chunk_size = chunk_size
+        self.compression = COMPRESSION_TYPES[compression]
+
+        # one recording session is a set of segments plus a side index listing them, a new segment
+        # is started once the current one is max_segment_duration seconds or max_segment_bytes long
+        self.session_name = session_name or datetime.now().strftime("%m_%d_%Y_%H_%M_%S")
+        self.index_path = os.path.join(mcap_base_path, self.session_name + ".segments.json")
+        self.max_segment_duration = max_segment_duration
+        self.max_segment_bytes = max_segment_bytes
+        self.segment_number = 0
+        self.segments = []
+        self.index_lock = threading.Lock()
+        self.finalizers = []
+        self.finished_bytes = 0
+        # messages that are only decoded for the live view and never written
+        self.not_logged = not_logged or frozenset()
+        # messages that are only written when their signals change, see DeadbandFilter
+        self.deadband = deadband
+        self.deadband_segment = 0
+        # per signal min / max / mean / count buckets, attached to every segment as it is finished
+        self.keep_signal_summary = signal_summary
+        # with several buses every message gets a channel per bus
+        self.topics = [
+            (bus, name, msg_classes[name]) for bus in (bus_names or [None]) for name in messages
+        ]
+        # messages that dont come off a bus (derived signals), name -> class, never bus prefixed
+        self.topics += [(None, name, msg_class) for name, msg_class in (extra_classes or {}).items()]
+        self._open_segment()
+
+        # in threaded mode the event loop only collects (channel id, time, bytes, message) records
+        # and hands them over in batches, chunk building, compression and file writes all happen
+        # in the writer thread. The handoff queue is bounded so a writer that cant keep up makes
+        # write_data wait instead of growing memory, backpressure_waits counts how often
+        self.threaded = threaded
+        self.handoff_size = handoff_size
+        self.pending = []
+        self.backpressure_waits = 0
+        # set once finish() starts, anything written after that is dropped. The runner keeps
+        # feeding this writer after /stop, and a joined writer thread would never drain the handoff
+        self.stopped = False
+        self.latency = StageLatency(sink="mcap")
+        self.messages_written = registry.counter("messages_written_total", "Messages handed to each sink", sink="mcap")
+        self.payload_bytes = registry.counter("payload_bytes_written_total", "Serialized message bytes handed to each sink", sink="mcap")
+        registry.counter_callback("mcap_file_bytes_total", "Bytes written to mcap files", self._file_bytes)
+        registry.counter_callback(
+            "mcap_backpressure_waits_total", "Times the event loop waited on the mcap writer thread", lambda: self.backpressure_waits
+        )
+        self.writer_thread = None
+        if threaded:
+            self.handoff = Queue(maxsize=max_pending_batches)
+            self.writer_thread = threading.Thread(
+                target=self._write_batches, name="mcap_writer", daemon=True
+            )
+            self.writer_thread.start()
+            registry.gauge("mcap_handoff_depth", "Batches waiting for the mcap writer thread", self.handoff.qsize)
+
+    def _register_topic(self, bus, name, msg_class, schema_ids, signal_summary):
+        topic = channel_topic(name, bus)
+        # one schema per message type no matter how many buses carry it
+        schema_id = schema_ids.get(msg_class)
+        if schema_id is None:
+            schema_id = register_schema(self._writer, msg_class)
+            schema_ids[msg_class] = schema_id
+        channel_id = self._writer.register_channel(
+            topic=topic,
+            message_encoding=MessageEncoding.Protobuf,
+            schema_id=schema_id,
+        )
+        # keep the protobuf writer's own bookkeeping in sync so write_message reuses these channels
+        self._schemas[topic] = (schema_id, msg_class.DESCRIPTOR.full_name)
+        self._channels[topic] = channel_id
+        if signal_summary is not None:
+            signal_summary.add_channel(channel_id, topic, msg_class)
+        return channel_id
+
+    def _open_segment(self):
+        self.actual_path = os.path.join(
+            self.base_path, f"{self.session_name}_{self.segment_number:03d}.mcap"
+        )
+        self.writing_file = open(self.actual_path + PARTIAL_SUFFIX, "wb")
+        # the protobuf writer's init starts a fresh mcap writer (header and all) on the new file
+        super().__init__(
+            self.writing_file,
+            chunk_size=self.chunk_size,
+            compression=self.compression,
+        )
+
+        # register every schema and channel up front so writing a message is just a channel id
+        # lookup and the already serialized bytes from QueueData go straight into the mcap writer.
+        # the event loop keeps reading channel_ids while the writer thread rotates, so the new
+        # segment's are built on the side and swapped in whole
+        schema_ids = {}
+        channel_ids = {}
+        signal_summary = SignalSummary() if self.keep_signal_summary else None
+        for bus, name, msg_class in self.topics:
+            channel_ids[(bus, name)] = self._register_topic(bus, name, msg_class, schema_ids, signal_summary)
+        self.schema_ids = schema_ids
+        self.channel_ids = channel_ids
+        self.signal_summary = signal_summary
+
+        self.segment_opened = time.monotonic()
+        self.segment_start_time = None
+        self.segment_end_time = None
+        self.segment_message_count = 0
+
+    def _should_rotate(self):
+        if self.segment_message_count == 0:
+            return False
+        if self.max_segment_duration is not None and time.monotonic() - self.segment_opened >= self.max_segment_duration:
+            return True
+        # tell() only counts finished chunks, which is plenty close for deciding on a rotation
+        if self.max_segment_bytes is not None and self.writing_file.tell() >= self.max_segment_bytes:
+            return True
+        return False
+
+    def _file_bytes(self):
+        # tell() of the open segment lags by whatever is still in the current chunk
+        if self.writing_file.closed:
+            return self.finished_bytes
+        return self.finished_bytes + self.writing_file.tell()
+
+    def _segment_entry(self):
+        return {
+            "file": os.path.basename(self.actual_path),
+            "segment": self.segment_number,
+            "start_time": self.segment_start_time,
+            "end_time": self.segment_end_time,
+            "message_count": self.segment_message_count,
+        }
+
+    def _rotate(self):
+        # swapping in the new segment is just opening a file and writing its header and schemas,
+        # the old segment's last chunk and summary get written by a finalizer thread
+        old_segment = (self._writer, self.writing_file, self.actual_path, self._segment_entry(), self.signal_summary)
+        self.segment_number += 1
+        self._open_segment()
+        finalizer = threading.Thread(
+            target=self._finalize_segment, args=old_segment, name="mcap_finalizer"
+        )
+        finalizer.start()
+        self.finalizers.append(finalizer)
+
+    def _finalize_segment(self, mcap_writer, segment_file, path, entry, signal_summary=None):
+        if signal_summary is not None:
+            # a segment without its summary is still a good segment
+            try:
+                mcap_writer.add_attachment(
+                    create_time=wall_time_ns(), log_time=entry["end_time"] or 0, name=ATTACHMENT_NAME,
+                    media_type=MEDIA_TYPE, data=signal_summary.to_bytes(),
+                )
+            except Exception as e:
+                print(f"could not write the signal summary of {os.path.basename(path)}: {e}")
+        mcap_writer.finish()
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+        segment_file.close()
+        os.replace(path + PARTIAL_SUFFIX, path)
+        entry["bytes"] = os.path.getsize(path)
+        self.finished_bytes += entry["bytes"]
+
+        with self.index_lock:
+            self.segments.append(entry)
+            self.segments.sort(key=lambda segment: segment["segment"])
+            index = {"session": self.session_name, "segments": self.segments}
+            index_tmp_path = self.index_path + ".tmp"
+            with open(index_tmp_path, "w") as index_file:
+                json.dump(index, index_file, indent=2)
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            os.replace(index_tmp_path, self.index_path)
 
     def __await__(self):
         async def closure():
@@ -29,21 +235,170 @@ class HTPBMcapWriter(Writer):
     def __enter__(self):
         return self
     def __exit__(self, exc_, exc_type_, tb_):
-        super().finish()
+        self.finish()
     def __aenter__(self):
         return self
     async def __aexit__(self, exc_type: Any, exc_val: Any, traceback: Any):
-        return super().finish()
-    
+        if self.threaded:
+            # joining the writer thread can take a while, dont block the loop on it
+            return await asyncio.get_running_loop().run_in_executor(None, self.finish)
+        return self.finish()
+
+    def finish(self):
+        if self._finished:
+            return
+        self.stopped = True
+        if self.deadband is not None:
+            # the last values of anything that was held back
+            for held in self.deadband.flush():
+                self._write_one(held)
+        if self.writer_thread is not None:
+            self.handoff.put(self.pending)
+            self.pending = []
+            self.handoff.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+        self._finished = True
+        self._finalize_segment(
+            self._writer, self.writing_file, self.actual_path, self._segment_entry(), self.signal_summary
+        )
+        for finalizer in self.finalizers:
+            finalizer.join()
+
+    def _write_batches(self):
+        # runs in the writer thread, which owns the mcap writer until finish() joins it
+        while True:
+            batch = self.handoff.get()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            add_message = self._writer.add_message
+            for channel_id, log_time, data, pb_msg in batch:
+                add_message(channel_id=channel_id, log_time=log_time, data=data, publish_time=log_time)
+            if self.signal_summary is not None:
+                # the message the sinks already built where there is one, only bytes get parsed
+                add_to_summary = self.signal_summary.add
+                add_serialized = self.signal_summary.add_serialized
+                for channel_id, log_time, data, pb_msg in batch:
+                    if pb_msg is not None:
+                        add_to_summary(channel_id, log_time, pb_msg)
+                    else:
+                        add_serialized(channel_id, log_time, data)
+            # receive times from different buses / batches are only roughly in order
+            start_time = min(record[1] for record in batch)
+            end_time = max(record[1] for record in batch)
+            if self.segment_start_time is None or start_time < self.segment_start_time:
+                self.segment_start_time = start_time
+            if self.segment_end_time is None or end_time > self.segment_end_time:
+                self.segment_end_time = end_time
+            self.segment_message_count += len(batch)
+            if self._should_rotate():
+                self._rotate()
+
+    async def _hand_off(self):
+        batch = self.pending
+        self.pending = []
+        if self.stopped:
+            return
+        try:
+            self.handoff.put_nowait(batch)
+        except Full:
+            self.backpressure_waits += 1
+            await asyncio.get_running_loop().run_in_executor(None, self._put_until_stopped, batch)
+
+    def _put_until_stopped(self, batch):
+        # finish() can stop the writer thread while this waits for room
+        while not self.stopped:
+            try:
+                self.handoff.put(batch, timeout=0.5)
+                return
+            except Full:
+                pass
+
     async def write_msg(self, msg):
-        
-        super().write_message(topic=msg.DESCRIPTOR.name+"_data", message=msg, log_time=int(time.time_ns()), publish_time=int(time.time_ns()))
+        now = wall_time_ns()
+        super().write_message(topic=msg.DESCRIPTOR.name+"_data", message=msg, log_time=now, publish_time=now)
         return True
 
+    def rotate_if_due(self) -> bool:
+        """Start a new segment if the open one is past its size or duration limit. For writers
+        without a writer thread, that one rotates by itself after every batch"""
+        if self.threaded or not self._should_rotate():
+            return False
+        self._rotate()
+        return True
+
+    def write_serialized(self, data, write_time: int = None):
+        if self.stopped:
+            return
+        if data.name in self.not_logged or data.data is None:
+            # a frame that could not be built was already counted as a decode error
+            return
+        if self.deadband is None:
+            return self._write_one(data, write_time)
+        if self.deadband_segment != self.segment_number:
+            # every segment starts with every channel's current value
+            for held in self.deadband.flush():
+                self._write_one(held, write_time)
+            self.deadband.reset()
+            self.deadband_segment = self.segment_number
+        for kept in self.deadband.filter(data):
+            self._write_one(kept, write_time)
+
+    def _write_one(self, data, write_time: int = None):
+        channel_id = self.channel_ids.get((data.bus, data.name))
+        if channel_id is None:
+            if self.threaded or data.pb_msg is None:
+                # the writer thread owns the mcap writer so channels cant be added from here
+                print(f"no channel registered for {channel_topic(data.name, data.bus)}, dropping message")
+                return
+            # not a message we knew about at startup, later segments register it up front too
+            self.topics.append((data.bus, data.name, type(data.pb_msg)))
+            channel_id = self._register_topic(
+                data.bus, data.name, type(data.pb_msg), self.schema_ids, self.signal_summary
+            )
+            self.channel_ids[(data.bus, data.name)] = channel_id
+        # logged at the time the frame was received, not whenever it made it through the queues
+        log_time = data.timestamp
+        self.latency.record_frame(log_time, data.decoded, wall_time_ns() if write_time is None else write_time)
+        self.messages_written.value += 1
+        self.payload_bytes.value += len(data.data)
+        if self.threaded:
+            self.pending.append((channel_id, log_time, data.data, data.pb_msg))
+            return
+        self._writer.add_message(
+            channel_id=channel_id, log_time=log_time, data=data.data, publish_time=log_time
+        )
+        if self.signal_summary is not None:
+            if data.pb_msg is not None:
+                self.signal_summary.add(channel_id, log_time, data.pb_msg)
+            else:
+                self.signal_summary.add_serialized(channel_id, log_time, data.data)
+        if self.segment_start_time is None or log_time < self.segment_start_time:
+            self.segment_start_time = log_time
+        if self.segment_end_time is None or log_time > self.segment_end_time:
+            self.segment_end_time = log_time
+        self.segment_message_count += 1
+
     async def write_data(self, queue):
         msg = await queue.get()
-        if msg is not None:
-            return await self.write_msg(msg.pb_msg)
-            
-    
-                
+        if self.stopped:
+            # still taking frames off the queue so the bus doesnt back up behind a stopped writer
+            return msg is not None
+        write_time = wall_time_ns()
+        if isinstance(msg, QueueDataBatch):
+            for data in msg:
+                self.write_serialized(data, write_time)
+        elif msg is not None:
+            self.write_serialized(msg, write_time)
+        else:
+            return None
+
+        # hand the batch over once it is big enough, or whenever the sink has caught up so
+        # nothing sits in the batch while the bus is quiet
+        if self.threaded and self.pending and (len(self.pending) >= self.handoff_size or queue.empty()):
+            await self._hand_off()
+        else:
+            self.rotate_if_due()
+        return True
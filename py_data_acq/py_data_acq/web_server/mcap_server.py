@@ -1,16 +1,51 @@
 import socket
 import asyncio
 import json
+import os
+from urllib.parse import urlsplit, parse_qs, unquote
 from py_data_acq.mcap_writer.writer import HTPBMcapWriter
+from py_data_acq.mcap_writer.recordings import recording_path, list_recordings, iter_file, iter_extract
+from py_data_acq.mcap_writer.signal_summary import read_signal_summary, RESOLUTIONS
 import py_data_acq.common.protobuf_helpers as pb_helpers
+from py_data_acq.common.compiled_registry import shared_registry
+from py_data_acq.common.metrics import registry
 from typing import Any
 
+# longest request line plus headers a client can send
+MAX_HEADER_BYTES = 16 * 1024
+
+
+class HTTPRequest:
+    def __init__(self, method, target, version, headers, body=b""):
+        self.method = method
+        self.target = target
+        self.url = urlsplit(target)
+        self.version = version
+        self.headers = headers
+        self.body = body
+        # 1.1 keeps the connection open unless told otherwise, 1.0 closes it unless told otherwise
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            self.keep_alive = connection == "keep-alive"
+        else:
+            self.keep_alive = connection != "close"
+
+
 class MCAPServer:
-    def __init__(self, host='0.0.0.0', port=6969, mcap_writer=None,path='.'):
+    def __init__(self, host='0.0.0.0', port=6969, mcap_writer=None,path='.', max_connections=64, keepalive_timeout=30.0):
         self.host = host
         self.port = port
         self.mcap_writer = mcap_writer
         self.path = path
+        # every open connection is one coroutine, idle keep-alive ones are closed after
+        # keepalive_timeout and past max_connections new ones get a 503 straight away
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.connections = 0
+        registry.gauge("http_connections", "Open connections to the recording server", lambda: self.connections)
+        # status streams wait on these, set_status wakes them all up
+        self.status_version = 0
+        self.status_waiters = []
         if mcap_writer is not None:
             self.mcap_status_message = f"An MCAP file is being written: {self.mcap_writer.writing_file.name}"
         else:
@@ -27,24 +62,43 @@ class MCAPServer:
             .then(response => response.text())
             .then(data => {
                 alert(data);
-                setTimeout(updateStatus, 1000)
+                setTimeout(updateRecordings, 1000)
             })
             .catch((error) => {
                 console.error('Error:', error);
                 alert('Error sending command: ' + command);
             });
         }
-        function updateStatus() {
-            fetch('/status') // Assume '/status' endpoint returns the current MCAP status
+        function watchStatus() {
+            // one long lived connection, the server pushes an event whenever the status changes
+            const status = new EventSource('/status');
+            status.onmessage = function(event) {
+                const data = JSON.parse(event.data);
+                document.getElementById('mcapStatus').innerText = data.statusMessage;
+                document.getElementById('startBtn').disabled = data.isRecording;
+                document.getElementById('stopBtn').disabled = !data.isRecording;
+            };
+        }
+        function updateRecordings() {
+            fetch('/recordings')
                 .then(response => response.json())
                 .then(data => {
-                    document.getElementById('mcapStatus').innerText = data.statusMessage;
-                    document.getElementById('startBtn').disabled = data.isRecording;
-                    document.getElementById('stopBtn').disabled = !data.isRecording;
+                    const list = document.getElementById('recordings');
+                    list.innerHTML = '';
+                    for (const recording of data) {
+                        const item = document.createElement('li');
+                        const link = document.createElement('a');
+                        link.href = '/recordings/' + encodeURIComponent(recording.name);
+                        link.innerText = recording.name;
+                        item.appendChild(link);
+                        item.appendChild(document.createTextNode(' ' + (recording.bytes / 1e6).toFixed(1) + ' MB'));
+                        list.appendChild(item);
+                    }
                 });
         }
         document.addEventListener('DOMContentLoaded', function() {
-            updateStatus();
+            watchStatus();
+            updateRecordings();
         }, false);
     </script>
 </head>
@@ -53,6 +107,8 @@ class MCAPServer:
     <button id="startBtn" onclick="sendCommand('start')">Start</button>
     <button id="stopBtn" onclick="sendCommand('stop')">Stop</button>
     <div id="mcapStatus">{{mcap_status}}</div>
+    <h2>Recordings</h2>
+    <ul id="recordings"></ul>
 </body>
 </html>"""
 
@@ -71,21 +127,40 @@ class MCAPServer:
     
     # Creates page from inline html and updates with mcap_status
     async def serve_file(self):
-        current_html_content = self.html_content.replace(b'{{mcap_status}}', self.mcap_status_message.encode())
-        header = b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n"
-        return header + current_html_content
+        return self.html_content.replace(b'{{mcap_status}}', self.mcap_status_message.encode())
         
+    def status(self):
+        return {
+            "statusMessage": self.mcap_status_message,
+            "isRecording": self.mcap_writer is not None,
+            "version": self.status_version,
+        }
+
+    def set_status(self, message):
+        self.mcap_status_message = message
+        self.status_version += 1
+        waiters = self.status_waiters
+        self.status_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
     async def start_mcap_generation(self):
         if self.mcap_writer is None:
-            list_of_msg_names, msg_pb_classes = pb_helpers.get_msg_names_and_classes()
+            # whatever the runner already loaded, no walking hytech_pb2 again
+            compiled = shared_registry()
+            if compiled is not None:
+                list_of_msg_names, msg_pb_classes = compiled.msg_names, compiled.msg_classes
+            else:
+                list_of_msg_names, msg_pb_classes = pb_helpers.get_msg_names_and_classes()
             self.mcap_writer = HTPBMcapWriter(self.path, list_of_msg_names, msg_pb_classes)
-        self.mcap_status_message = f"An MCAP file is being written: {self.mcap_writer.writing_file.name}"
+        self.set_status(f"An MCAP file is being written: {self.mcap_writer.writing_file.name}")
 
     async def stop_mcap_generation(self):
         if self.mcap_writer is not None:
             await self.mcap_writer.__aexit__(None, None, None)
-            self.mcap_status_message = "No MCAP file is being written."
             self.mcap_writer = None
+            self.set_status("No MCAP file is being written.")
 
     def handle_command(self, command):
         if command == '/start':
@@ -98,40 +173,305 @@ class MCAPServer:
             return "Command not recognized."
 
 
+    def response_head(self, request, status, content_type, extra_headers):
+        headers = [f"HTTP/1.1 {status}", f"Content-Type: {content_type}"]
+        headers.append("Connection: keep-alive" if request.keep_alive else "Connection: close")
+        headers += extra_headers or []
+        return ("\r\n".join(headers) + "\r\n\r\n").encode('utf-8')
+
+    async def send_response(self, request, writer, status, content_type, body: bytes, extra_headers=None):
+        extra_headers = [f"Content-Length: {len(body)}"] + (extra_headers or [])
+        writer.write(self.response_head(request, status, content_type, extra_headers) + body)
+        await writer.drain()
+
+    async def send_pieces(self, request, writer, status, content_type, pieces, length=None, extra_headers=None):
+        # pieces is a plain iterator that does file io, every piece is pulled in the executor so
+        # a big download never blocks the loop or sits in memory. Without a known length the body
+        # goes out with chunked transfer encoding
+        if length is None:
+            extra_headers = ["Transfer-Encoding: chunked"] + (extra_headers or [])
+        else:
+            extra_headers = [f"Content-Length: {length}"] + (extra_headers or [])
+        writer.write(self.response_head(request, status, content_type, extra_headers))
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                piece = await loop.run_in_executor(None, next, pieces, None)
+            except Exception as e:
+                # the head is already out so there is no error status to send, leave the body
+                # unfinished and close the connection so the client sees a cut off download
+                print(f"error streaming {request.url.path}: {e}")
+                request.keep_alive = False
+                return
+            if piece is None:
+                break
+            if not piece:
+                continue
+            if length is None:
+                writer.write(f"{len(piece):x}\r\n".encode('utf-8') + piece + b"\r\n")
+            else:
+                writer.write(piece)
+            await writer.drain()
+        if length is None:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+
+    def parse_range(self, range_header, size):
+        # only single ranges, "bytes=start-end", "bytes=start-" and "bytes=-suffix"
+        if not range_header.startswith("bytes=") or "," in range_header:
+            return None
+        first, _, last = range_header[len("bytes="):].strip().partition("-")
+        try:
+            if first == "":
+                start = max(size - int(last), 0)
+                end = size - 1
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if start > end or start >= size:
+            return None
+        return start, end
+
+    async def serve_recording(self, request, writer, path):
+        size = os.path.getsize(path)
+        name = os.path.basename(path)
+        disposition = f'Content-Disposition: attachment; filename="{name}"'
+        range_header = request.headers.get("range")
+        if range_header is None:
+            await self.send_pieces(
+                request, writer, "200 OK", "application/octet-stream", iter_file(path),
+                extra_headers=["Accept-Ranges: bytes", disposition],
+            )
+            return
+        byte_range = self.parse_range(range_header, size)
+        if byte_range is None:
+            await self.send_response(
+                request, writer, "416 Range Not Satisfiable", "text/plain", b"Invalid range",
+                extra_headers=[f"Content-Range: bytes */{size}"],
+            )
+            return
+        start, end = byte_range
+        await self.send_pieces(
+            request, writer, "206 Partial Content", "application/octet-stream",
+            iter_file(path, start, end - start + 1), length=end - start + 1,
+            extra_headers=["Accept-Ranges: bytes", f"Content-Range: bytes {start}-{end}/{size}", disposition],
+        )
+
+    async def serve_extract(self, request, writer, path):
+        # /recordings/<name>/extract?start=<ns>&end=<ns>&topics=<topic>,<topic>
+        query = parse_qs(request.url.query)
+        try:
+            start_time = int(query["start"][0]) if "start" in query else None
+            end_time = int(query["end"][0]) if "end" in query else None
+        except ValueError:
+            await self.send_response(request, writer, "400 Bad Request", "text/plain", b"start and end are nanosecond timestamps")
+            return
+        topics = None
+        if "topics" in query:
+            topics = [topic for topic in query["topics"][0].split(",") if topic]
+        pieces = iter_extract(path, start_time, end_time, topics)
+        # the first piece is the header and schemas, getting it also checks the file has a summary
+        try:
+            first_piece = await asyncio.get_running_loop().run_in_executor(None, next, pieces)
+        except Exception as e:
+            await self.send_response(request, writer, "422 Unprocessable Entity", "text/plain", str(e).encode('utf-8'))
+            return
+
+        def all_pieces():
+            yield first_piece
+            yield from pieces
+
+        name = os.path.basename(path).split(".mcap")[0] + "_extract.mcap"
+        await self.send_pieces(
+            request, writer, "200 OK", "application/octet-stream", all_pieces(),
+            extra_headers=[f'Content-Disposition: attachment; filename="{name}"'],
+        )
+
+    async def serve_signal_summary(self, request, writer, path):
+        # /recordings/<name>/summary?resolution=<seconds>&topics=<topic>,<topic>&signals=<signal>,<signal>
+        query = parse_qs(request.url.query)
+        try:
+            resolution = int(query["resolution"][0]) if "resolution" in query else RESOLUTIONS[-1]
+        except ValueError:
+            resolution = None
+        if resolution not in RESOLUTIONS:
+            await self.send_response(
+                request, writer, "400 Bad Request", "text/plain",
+                f"resolution is one of {', '.join(str(r) for r in RESOLUTIONS)} seconds".encode('utf-8'),
+            )
+            return
+        topics = [topic for topic in query["topics"][0].split(",") if topic] if "topics" in query else None
+        signals = [signal for signal in query["signals"][0].split(",") if signal] if "signals" in query else None
+        try:
+            table = await asyncio.get_running_loop().run_in_executor(
+                None, read_signal_summary, path, resolution, topics, signals
+            )
+        except Exception as e:
+            await self.send_response(request, writer, "422 Unprocessable Entity", "text/plain", str(e).encode('utf-8'))
+            return
+        if table is None:
+            await self.send_response(request, writer, "404 Not Found", "text/plain", b"Recording has no signal summary")
+            return
+
+        # topic -> signal -> one list per column, ready to plot
+        result = {}
+        for batch in table.to_batches():
+            columns = batch.to_pydict()
+            for i, (topic, signal) in enumerate(zip(columns["topic"], columns["signal"])):
+                series = result.setdefault(topic, {}).get(signal)
+                if series is None:
+                    series = result[topic][signal] = {"start_time": [], "count": [], "min": [], "max": [], "mean": []}
+                for key, values in series.items():
+                    values.append(columns[key][i])
+        body = json.dumps({"resolution": resolution, "topics": result}).encode('utf-8')
+        await self.send_response(request, writer, "200 OK", "application/json", body)
+
+    async def handle_recordings(self, request, writer):
+        parts = [unquote(part) for part in request.url.path.split("/") if part]
+        if len(parts) == 1:
+            recordings = await asyncio.get_running_loop().run_in_executor(None, list_recordings, self.path)
+            await self.send_response(request, writer, "200 OK", "application/json", json.dumps(recordings).encode('utf-8'))
+            return
+        path = recording_path(self.path, parts[1])
+        if path is None or len(parts) > 3 or (len(parts) == 3 and parts[2] not in ("extract", "summary")):
+            await self.send_response(request, writer, "404 Not Found", "text/plain", b"No such recording")
+        elif len(parts) == 3 and parts[2] == "summary":
+            await self.serve_signal_summary(request, writer, path)
+        elif len(parts) == 3:
+            await self.serve_extract(request, writer, path)
+        else:
+            await self.serve_recording(request, writer, path)
+
+    async def serve_status_stream(self, request, writer):
+        # server sent events, one event now and one every time the status changes. The stream has
+        # no length so this connection ends with it
+        request.keep_alive = False
+        writer.write(self.response_head(request, "200 OK", "text/event-stream", ["Cache-Control: no-cache"]))
+        version = None
+        while True:
+            if version != self.status_version:
+                version = self.status_version
+                writer.write(f"data: {json.dumps(self.status())}\n\n".encode('utf-8'))
+            else:
+                # comment line so proxies and dead clients are noticed
+                writer.write(b": keepalive\n\n")
+            await writer.drain()
+            waiter = asyncio.get_running_loop().create_future()
+            self.status_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, 15)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                # a status change already took it off the list, a timeout or a closed client didnt
+                if waiter in self.status_waiters:
+                    self.status_waiters.remove(waiter)
+
+    async def read_request(self, reader):
+        """Next request on the connection, None once the client closed it"""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise ValueError("connection closed in the middle of a request")
+            return None
+        except asyncio.LimitOverrunError:
+            raise ValueError("request head too large")
+
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        parts = request_line.split(' ')
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise ValueError(f"bad request line {request_line!r}")
+        method, target, version = parts
+        headers = {}
+        for line in header_lines:
+            if not line:
+                continue
+            key, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError(f"bad header line {line!r}")
+            headers[key.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise ValueError("chunked request bodies are not supported")
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise ValueError("bad content-length")
+        if length < 0 or length > MAX_HEADER_BYTES:
+            raise ValueError("bad content-length")
+        body = await reader.readexactly(length) if length else b""
+        return HTTPRequest(method, target, version, headers, body)
+
+    async def handle_request(self, request, writer):
+        path = request.url.path
+        if request.method == 'POST':
+            response_text = self.handle_command(path)
+            await self.send_response(request, writer, "200 OK", "text/plain", response_text.encode('utf-8'))
+        elif path == '/status':
+            if "text/event-stream" in request.headers.get("accept", ""):
+                await self.serve_status_stream(request, writer)
+            else:
+                await self.send_response(request, writer, "200 OK", "application/json", json.dumps(self.status()).encode('utf-8'))
+        elif path == '/metrics':
+            # prometheus text format, /metrics.json has the same numbers for anything else
+            await self.send_response(request, writer, "200 OK", "text/plain; version=0.0.4", registry.prometheus_text().encode('utf-8'))
+        elif path == '/metrics.json':
+            await self.send_response(request, writer, "200 OK", "application/json", json.dumps(registry.as_dict()).encode('utf-8'))
+        elif path == '/recordings' or path.startswith('/recordings/'):
+            await self.handle_recordings(request, writer)
+        else:
+            await self.send_response(request, writer, "200 OK", "text/html", await self.serve_file())
+
     # Checks if client connected and updates them on different actions
     async def handle_client(self, reader, writer):
         addr = writer.get_extra_info('peername')
         print(f"Connected with {addr}")
-        
-        data = await reader.read(1024)
-        request = data.decode('utf-8').strip()
-        method, url, _ = request.split(' ', 2)
-
-        if method == 'POST':
-            response_text = self.handle_command(url)
-            response = (f"HTTP/1.1 200 OK\r\n"
-                        f"Content-Type: text/plain\r\n\r\n"
-                        f"{response_text}").encode('utf-8')
-        elif url == '/status':
-            status_response = {
-                "statusMessage": self.mcap_status_message,
-                "isRecording": self.mcap_writer is not None
-            }
-            response_bytes = json.dumps(status_response).encode('utf-8')
-            response = (f"HTTP/1.1 200 OK\r\n"
-                        f"Content-Type: application/json\r\n\r\n").encode('utf-8') + response_bytes
-        else:
-            response = await self.serve_file()
 
-        writer.write(response)
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        
+        if self.connections >= self.max_connections:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+
+        self.connections += 1
+        try:
+            # keep serving requests on this connection until the client is done with it
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except ValueError as e:
+                    writer.write(
+                        b"HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\nConnection: close\r\n"
+                        + f"Content-Length: {len(str(e))}\r\n\r\n{e}".encode('utf-8')
+                    )
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                await self.handle_request(request, writer)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # client went away mid request or mid download
+            pass
+        except Exception as e:
+            print(f"error serving {addr}: {e}")
+        finally:
+            self.connections -= 1
+            writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
     async def start_server(self):
         url = f"http://{self.host}:{self.port}"
         print(f"MCAP Server started on {url}")
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, limit=MAX_HEADER_BYTES)
 
         async with server:
             await server.serve_forever()
\ No newline at end of file
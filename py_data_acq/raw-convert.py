@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import os
+import time
+import argparse
+
+from py_data_acq.common.compiled_registry import load_registry
+from py_data_acq.mcap_writer.raw_convert import convert_raw_log, is_converted, _lower_priority
+
+
+# usage: raw-convert.py <raw log>... [--out dir] [--nice] [--force]
+# decodes raw CAN logs from RAW_CAPTURE into protobuf mcap recordings with the same DBC and
+# protobuf classes runner.py uses, DBC_PATH and BIN_PATH are the same as for runner.py
+def main():
+    parser = argparse.ArgumentParser(description="Convert raw CAN capture logs to mcap recordings")
+    parser.add_argument("raw_logs", nargs="+")
+    parser.add_argument("--out", help="output directory, next to each raw log by default")
+    parser.add_argument("--nice", action="store_true", help="run at the lowest cpu priority")
+    parser.add_argument("--force", action="store_true", help="convert logs that already have a recording again")
+    args = parser.parse_args()
+
+    if args.nice:
+        _lower_priority()
+    # the cached DBC runner.py already parsed, so converting by hand doesnt parse it again either
+    compiled = load_registry(os.path.join(os.environ.get("DBC_PATH", "."), "car.dbc"), os.environ.get("BIN_PATH", ""))
+
+    for path in args.raw_logs:
+        out_dir = args.out or os.path.dirname(os.path.abspath(path))
+        if not args.force and is_converted(path, out_dir):
+            print(f"{path} is already converted, --force converts it again")
+            continue
+        started = time.perf_counter()
+        result = convert_raw_log(path, out_dir, compiled.decode_plan, compiled.msg_names, compiled.msg_classes)
+        elapsed = time.perf_counter() - started
+        print(
+            f"{path}: wrote {result['written']} of {result['frames']} frames in {elapsed:.1f} s, "
+            f"{result['undecoded']} not in the DBC or bad, {result['skipped']} error / remote frames"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,26 @@ import asyncio
 
 from py_data_acq.foxglove_live.foxglove_ws import HTProtobufFoxgloveServer
 from py_data_acq.mcap_writer.writer import HTPBMcapWriter
-import py_data_acq.common.protobuf_helpers as pb_helpers
+from py_data_acq.mcap_writer.deadband import DeadbandFilter
+from py_data_acq.common.fanout_bus import FanoutBus, BLOCK, DROP_OLDEST
+from py_data_acq.common.loop_monitor import LoopLagMonitor
+from py_data_acq.common.metrics import registry
 from py_data_acq.web_server.mcap_server import MCAPServer
-from py_data_acq.io_handler.can_handle import can_receiver
+from py_data_acq.io_handler.can_handle import can_receiver, raw_capture_receiver, EarlyFrameReader
+from py_data_acq.common.compiled_registry import load_registry
+from py_data_acq.common.derived_signals import DerivedSignalEngine, DerivedSignalBus, load_definitions
+from py_data_acq.common.raw_log import RawFrameLog
+from py_data_acq.common.frame_policy import FramePolicy, RAW, DECODED, LIVE
+from py_data_acq.mcap_writer.raw_convert import start_background_converter
 from py_data_acq.io_handler.serial_handle import serial_reciever
+from py_data_acq.io_handler.multi_bus import multi_bus_receiver, parse_bus_specs
 
 # from py_data_acq.io_handler.serial_handle import
 import sys
 import os
-import cantools
 import logging
 
 # TODO we may want to have a config file handling to set params such as:
-#      - file save interval for MCAP file
 #      - foxglove server port
 #      - foxglove server ip
 #      - protobuf binary schema file location and file name
@@ -34,10 +41,20 @@ async def fxglv_websocket_consume_data(queue, foxglove_server):
             await fz.send_msgs_from_queue(queue)
 
 
+async def log_latency(logger, mcap_writer, foxglove_server, interval):
+    # receive -> decode -> write latency of both sinks, in ms
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"mcap latency {mcap_writer.latency.summary()}")
+        logger.info(f"foxglove latency {foxglove_server.latency.summary()}")
+
+
 async def run(logger):
-    # Init some bois
-    queue1 = asyncio.Queue()
-    queue2 = asyncio.Queue()
+    # Init some bois, every sink reads the same bus with its own cursor. The MCAP writer must not
+    # lose frames, the live view would rather skip frames than fall further and further behind
+    data_bus = FanoutBus(capacity=int(os.environ.get("BUS_CAPACITY", "4096")))
+    fx_queue = data_bus.subscribe("foxglove", policy=DROP_OLDEST)
+    mcap_queue = data_bus.subscribe("mcap", policy=BLOCK)
     path_to_bin = ""
     path_to_dbc = ""
 
@@ -49,50 +66,188 @@ async def run(logger):
         path_to_bin = os.environ.get("BIN_PATH")
         path_to_dbc = os.environ.get("DBC_PATH")
 
-    # Load everything
+    # CAN_BUSES="inverter=socketcan:can0,bms=socketcan:can1,dash=serial:/dev/ttyACM0" reads every
+    # bus in its own process and prefixes each bus's topics with its name, unset reads one bus
+    bus_specs = parse_bus_specs(os.environ.get("CAN_BUSES", ""))
+    bus_names = [spec.name for spec in bus_specs] or None
+    raw_capture = os.environ.get("RAW_CAPTURE", "")
+
     fp_proto = os.path.join(path_to_bin, "hytech.bin")
     fp_dbc = os.path.join(path_to_dbc, "car.dbc")
-    db = cantools.db.load_file(fp_dbc)
-
-    # Start foxglove websocket and send message list
-    list_of_msg_names, msg_pb_classes = pb_helpers.get_msg_names_and_classes()
-    fx_s = HTProtobufFoxgloveServer(
-        "0.0.0.0", 8765, "asdf", fp_proto, list_of_msg_names
-    )
 
     # Set output path of mcap files, and if on nixos save to a predefined path
     path_to_mcap = "."
     if os.path.exists("/etc/nixos"):
         logger.info("detected running on nixos")
         path_to_mcap = "/home/nixos/recordings"
-    mcap_writer = HTPBMcapWriter(path_to_mcap, list_of_msg_names, True)
+
+    # RAW_CAPTURE=1 also appends every CAN frame to a preallocated raw log as it comes off the bus,
+    # RAW_CAPTURE=only does nothing but that. RAW_CONVERT=1 turns raw logs into recordings next
+    # to the live ones in a low priority background process, raw-convert.py does it by hand.
+    # Opened before the bus so the frames the early reader buffers are captured too
+    raw_log = None
+    if raw_capture:
+        raw_path = os.environ.get("RAW_CAPTURE_PATH", path_to_mcap)
+        raw_log = RawFrameLog(
+            raw_path,
+            records_per_file=int(os.environ.get("RAW_CAPTURE_RECORDS", str(1024 * 1024))),
+            payload_size=int(os.environ.get("RAW_CAPTURE_PAYLOAD", "8")),
+        )
+        logger.info(f"capturing raw frames to {raw_log.path}")
+        if bus_specs or os.environ.get("SOCKET_CAN") == "SERIAL":
+            logger.warning("raw capture only covers the single python-can receiver")
+        if os.environ.get("RAW_CONVERT", "0") == "1":
+            start_background_converter(raw_path, path_to_mcap, fp_dbc, path_to_bin, raw_log.session_name)
+
+    # the single python-can receiver starts buffering frames before anything else is loaded
+    early_reader = None
+    if not bus_specs and raw_capture != "only" and os.environ.get("SOCKET_CAN") != "SERIAL":
+        early_reader = EarlyFrameReader(raw_log=raw_log)
+
+    # Load everything, the parsed DBC comes out of a cache keyed by the content of car.dbc and
+    # hytech.bin (REGISTRY_CACHE_DIR, empty turns it off). Loaded in a thread so the early
+    # reader keeps buffering
+    compiled = await asyncio.to_thread(load_registry, fp_dbc, path_to_bin)
+    logger.info(f"loaded {len(compiled.db.messages)} messages{' from the registry cache' if compiled.from_cache else ''}")
+    db = compiled.db
+    list_of_msg_names, msg_pb_classes = compiled.msg_names, compiled.msg_classes
+    decode_plan = compiled.decode_plan
+
+    # DERIVED_SIGNALS="power=BMS_Status.Pack_Voltage*BMS_Status.Pack_Current/1000;energy_kwh=integrate(power)/3600"
+    # and / or a DERIVED_SIGNALS_FILE with one definition per line are computed as frames come in
+    # and published on extra channels, "group.name = ..." picks the channel (default derived_signals)
+    derived = None
+    receiver_bus = data_bus
+    definitions = load_definitions(os.environ.get("DERIVED_SIGNALS", ""), os.environ.get("DERIVED_SIGNALS_FILE"))
+    if definitions:
+        derived = DerivedSignalEngine(definitions, msg_pb_classes)
+        receiver_bus = DerivedSignalBus(data_bus, derived)
+        logger.info(f"computing {len(derived.signals)} derived signals on {', '.join(derived.groups)}")
+
+    # The live view only gets the newest value of each channel at FOXGLOVE_MAX_HZ (0 sends every
+    # frame), FOXGLOVE_CHANNEL_HZ overrides that per message, e.g. "BMS_Status=5,Wheel_Speeds=50"
+    foxglove_max_hz = float(os.environ.get("FOXGLOVE_MAX_HZ", "30"))
+    foxglove_channel_hz = {}
+    for channel_rate in os.environ.get("FOXGLOVE_CHANNEL_HZ", "").split(","):
+        if "=" in channel_rate:
+            name, rate = channel_rate.split("=", 1)
+            foxglove_channel_hz[name.strip()] = float(rate)
+    fx_s = HTProtobufFoxgloveServer(
+        "0.0.0.0",
+        8765,
+        "asdf",
+        fp_proto,
+        list_of_msg_names,
+        max_rate_hz=foxglove_max_hz if foxglove_max_hz > 0 else None,
+        channel_rates=foxglove_channel_hz,
+        bus_names=bus_names,
+        extra_schemas={name: derived.schema for name in derived.groups} if derived else None,
+    )
+
+    # FRAME_POLICY says per message what happens to its frames, e.g.
+    # "default=decoded+live,BMS_Status=raw+decoded,Dash_Buttons=live,0x7ff=ignore". live frames are
+    # only decoded while a foxglove client is subscribed to them, and frame IDs nothing wants
+    # are filtered out in the kernel. raw only applies with RAW_CAPTURE
+    frame_policy = FramePolicy.from_spec(
+        db,
+        os.environ.get("FRAME_POLICY", ""),
+        default=(RAW, DECODED, LIVE) if raw_capture else (DECODED, LIVE),
+    )
+    fx_s.subscription_listeners.append(frame_policy.set_live_interest)
+
+    # MCAP_DEADBAND only writes the listed messages when their signals change, e.g.
+    # "BMS_Status=change,Wheel_Speeds=0.5,BMS_Status.Cell_Temp_Max=1" (message.signal for a single
+    # signal), every one of them still gets written every MCAP_KEYFRAME_SECONDS
+    deadband = DeadbandFilter.from_spec(
+        os.environ.get("MCAP_DEADBAND", ""),
+        keyframe_interval=float(os.environ.get("MCAP_KEYFRAME_SECONDS", "1")),
+    )
+    # MCAP_WRITER_THREAD moves chunk building, compression and file writes off the event loop
+    mcap_writer = HTPBMcapWriter(
+        path_to_mcap,
+        list_of_msg_names,
+        msg_pb_classes,
+        threaded=os.environ.get("MCAP_WRITER_THREAD", "1") == "1",
+        compression=os.environ.get("MCAP_COMPRESSION", "zstd"),
+        # start a new file every MCAP_SEGMENT_SECONDS or MCAP_SEGMENT_MB, whichever comes first
+        max_segment_duration=float(os.environ.get("MCAP_SEGMENT_SECONDS", "600")),
+        max_segment_bytes=int(os.environ.get("MCAP_SEGMENT_MB", "1024")) * 1024 * 1024,
+        bus_names=bus_names,
+        # min / max / mean / count of every signal per 1 s, 10 s and 60 s attached to each segment
+        signal_summary=os.environ.get("MCAP_SIGNAL_SUMMARY", "1") == "1",
+        not_logged=frame_policy.not_logged,
+        deadband=deadband,
+        extra_classes=derived.message_classes if derived else None,
+    )
     mcap_server = MCAPServer(mcap_writer=mcap_writer, path=path_to_mcap)
 
     # Set data source enviroment variable
     os.environ["D_SOURCE"] = "KVASER"
 
+    if os.environ.get("FRAME_POLICY") and (bus_specs or os.environ.get("SOCKET_CAN") == "SERIAL"):
+        logger.warning("FRAME_POLICY only covers the single python-can receiver")
+
+    # Receivers hand frames downstream in batches of up to this many frames when set
+    rx_batch_size = int(os.environ.get("RX_BATCH_SIZE", "0"))
+
     # Set the receiver_task to said D_SOURCE's io_handler script
     match os.environ.get("SOCKET_CAN"):
+        case _ if raw_capture == "only":
+            receiver_task = asyncio.create_task(raw_capture_receiver(raw_log, policy=frame_policy))
+        case _ if bus_specs:
+            receiver_task = asyncio.create_task(
+                multi_bus_receiver(
+                    bus_specs, fp_dbc, list_of_msg_names, receiver_bus, bin_path=path_to_bin, msg_classes=msg_pb_classes
+                )
+            )
         case "SERIAL":
             receiver_task = asyncio.create_task(
-                serial_reciever(db, msg_pb_classes, queue1, queue2)
+                serial_reciever(decode_plan, receiver_bus, batch_size=rx_batch_size)
             )
         case "SOCKET_CAN":
             receiver_task = asyncio.create_task(
-                can_receiver(db, msg_pb_classes, queue1, queue2)
+                can_receiver(
+                    decode_plan,
+                    receiver_bus,
+                    batch_size=rx_batch_size,
+                    raw_log=raw_log,
+                    policy=frame_policy,
+                    early_reader=early_reader,
+                )
             )
         case _:
             receiver_task = asyncio.create_task(
-                can_receiver(db, msg_pb_classes, queue1, queue2)
+                can_receiver(
+                    decode_plan,
+                    receiver_bus,
+                    batch_size=rx_batch_size,
+                    raw_log=raw_log,
+                    policy=frame_policy,
+                    early_reader=early_reader,
+                )
             )
 
     # Setup other guys to respective asyncio tasks
-    fx_task = asyncio.create_task(fxglv_websocket_consume_data(queue1, fx_s))
-    mcap_task = asyncio.create_task(write_data_to_mcap(queue2, mcap_writer))
+    fx_task = asyncio.create_task(fxglv_websocket_consume_data(fx_queue, fx_s))
+    mcap_task = asyncio.create_task(write_data_to_mcap(mcap_queue, mcap_writer))
     srv_task = asyncio.create_task(mcap_server.start_server())
+    latency_task = asyncio.create_task(
+        log_latency(logger, mcap_writer, fx_s, float(os.environ.get("LATENCY_LOG_SECONDS", "60")))
+    )
+
+    # how late the event loop runs things, shows up on /metrics next to everything else
+    loop_monitor = LoopLagMonitor()
+    for quantile, key in (("0.5", "p50_ms"), ("0.99", "p99_ms"), ("max", "max_ms")):
+        registry.gauge(
+            "event_loop_lag_seconds",
+            "How late the event loop wakes up a sleeping task",
+            lambda key=key: loop_monitor.summary()[key] / 1000,
+            quantile=quantile,
+        )
+    loop_monitor_task = asyncio.create_task(loop_monitor.run())
     logger.info("created tasks")
 
-    await asyncio.gather(receiver_task, fx_task, mcap_task, srv_task)
+    await asyncio.gather(receiver_task, fx_task, mcap_task, srv_task, latency_task, loop_monitor_task)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+import os
+import sys
+import pty
+import time
+import tty
+import random
+import asyncio
+import threading
+import cantools
+import serial_asyncio
+
+import py_data_acq.common.protobuf_helpers as pb_helpers
+from py_data_acq.common.decode_plan import DecodePlan
+from py_data_acq.io_handler.serial_handle import (
+    SYNC_SEQUENCE,
+    READ_SIZE,
+    SerialFramer,
+    serial_frame_lengths,
+)
+
+# how many synthetic frames to push through the in memory comparison
+NUM_FRAMES = 200000
+# one byte in this many gets flipped in the corrupted runs
+CORRUPT_EVERY = 5000
+# how long each pty run lasts
+PTY_DURATION = 3.0
+
+
+def make_stream(decode_plan, num_frames, corrupt_every=None):
+    random.seed(0)
+    frame_ids = list(decode_plan.frames.keys())
+    lengths = serial_frame_lengths(decode_plan)
+    stream = bytearray()
+    for i in range(num_frames):
+        frame_id = random.choice(frame_ids)
+        payload = bytearray(random.getrandbits(8) for _ in range(lengths[frame_id]))
+        # some payloads carry the sync sequence, which the delimiter only parser cuts in the wrong place
+        if i % 50 == 0 and len(payload) >= len(SYNC_SEQUENCE):
+            payload[:len(SYNC_SEQUENCE)] = SYNC_SEQUENCE
+        stream += frame_id.to_bytes(2, "little") + payload + SYNC_SEQUENCE
+    if corrupt_every:
+        for i in range(corrupt_every // 2, len(stream), corrupt_every):
+            stream[i] ^= 0xFF
+    return bytes(stream)
+
+
+# what serial_reciever did per frame before the framer
+async def readuntil_path(stream, decode_plan):
+    reader = asyncio.StreamReader(limit=len(stream) + 1)
+    reader.feed_data(stream)
+    reader.feed_eof()
+    good = 0
+    while True:
+        try:
+            sync_msg = await reader.readuntil(SYNC_SEQUENCE)
+        except asyncio.IncompleteReadError:
+            return good
+        if decode_plan.pack(int.from_bytes(sync_msg[0:2], byteorder="little"), sync_msg[2:-3]) is not None:
+            good += 1
+
+
+def framer_path(stream, decode_plan):
+    framer = SerialFramer(serial_frame_lengths(decode_plan))
+    good = 0
+    for offset in range(0, len(stream), READ_SIZE):
+        for frame_id, payload in framer.feed(stream[offset:offset + READ_SIZE]):
+            if decode_plan.pack(frame_id, payload) is not None:
+                good += 1
+    return good, framer.metrics()
+
+
+def in_memory(decode_plan):
+    for corrupt_every in (None, CORRUPT_EVERY):
+        stream = make_stream(decode_plan, NUM_FRAMES, corrupt_every)
+        label = "clean" if corrupt_every is None else f"1 bad byte / {corrupt_every}"
+
+        start = time.perf_counter()
+        good = asyncio.run(readuntil_path(stream, decode_plan))
+        elapsed = time.perf_counter() - start
+        print(f"{label:>20} readuntil: {NUM_FRAMES / elapsed:>10,.0f} frames/sec, {good} of {NUM_FRAMES} decoded")
+
+        start = time.perf_counter()
+        good, metrics = framer_path(stream, decode_plan)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>20}    framer: {NUM_FRAMES / elapsed:>10,.0f} frames/sec, {good} of {NUM_FRAMES} decoded {metrics}")
+
+
+def pty_writer(fd, stream, baudrate, stop):
+    # 10 bits per byte on the wire, write in 1 ms slices to hold the rate
+    bytes_per_sec = baudrate / 10 if baudrate else None
+    offset = 0
+    started = time.perf_counter()
+    while not stop.is_set():
+        if bytes_per_sec is None:
+            count = READ_SIZE
+        else:
+            count = int((time.perf_counter() - started) * bytes_per_sec) - offset
+            if count <= 0:
+                time.sleep(0.001)
+                continue
+        piece = stream[offset % len(stream):offset % len(stream) + count]
+        try:
+            offset += os.write(fd, piece)
+        except BlockingIOError:
+            # the reader is behind, the pty buffer is full
+            time.sleep(0.001)
+
+
+async def pty_reader(port_name, decode_plan, duration):
+    reader, _ = await serial_asyncio.open_serial_connection(url=port_name, baudrate=115200)
+    framer = SerialFramer(serial_frame_lengths(decode_plan))
+    good = 0
+    deadline = asyncio.get_running_loop().time() + duration
+    while True:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            break
+        try:
+            data = await asyncio.wait_for(reader.read(READ_SIZE), remaining)
+        except asyncio.TimeoutError:
+            break
+        for frame_id, payload in framer.feed(data):
+            if decode_plan.pack(frame_id, payload) is not None:
+                good += 1
+    return good, framer.metrics()
+
+
+def over_pty(decode_plan):
+    stream = make_stream(decode_plan, 20000)
+    # 0 is as fast as the pty takes it
+    for baudrate in (115200, 1000000, 0):
+        controller, port = pty.openpty()
+        tty.setraw(port)
+        os.set_blocking(controller, False)
+        stop = threading.Event()
+        writer = threading.Thread(target=pty_writer, args=(controller, stream, baudrate, stop), daemon=True)
+        cpu_start = time.process_time()
+        writer.start()
+        good, metrics = asyncio.run(pty_reader(os.ttyname(port), decode_plan, PTY_DURATION))
+        stop.set()
+        writer.join()
+        cpu = (time.process_time() - cpu_start) / PTY_DURATION
+        os.close(controller)
+        os.close(port)
+        label = f"{baudrate} baud" if baudrate else "unthrottled"
+        print(f"{label:>14} pty: {good / PTY_DURATION:>10,.0f} frames/sec decoded, {cpu * 100:.0f}% cpu (reader + writer), {metrics}")
+
+
+def main():
+    # Same DBC as test.py / runner.py
+    if len(sys.argv) > 1:
+        path_to_dbc = sys.argv[1]
+    else:
+        path_to_dbc = os.environ.get("DBC_PATH")
+    db = cantools.db.load_file(os.path.join(path_to_dbc, "car.dbc"))
+    list_of_msg_names, msg_pb_classes = pb_helpers.get_msg_names_and_classes()
+    decode_plan = DecodePlan(db, msg_pb_classes)
+
+    in_memory(decode_plan)
+    over_pty(decode_plan)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,5 +11,13 @@ setup(
         "serial-broadcast-test.py",
         "data_acq_service.py",
         "server_runner.py",
+        "decode-benchmark.py",
+        "mcap-writer-benchmark.py",
+        "mcap-recover.py",
+        "serial-framer-benchmark.py",
+        "pipeline-benchmark.py",
+        "mcap-replay.py",
+        "mcap-export.py",
+        "raw-convert.py",
     ],
 )
@@ -0,0 +1,125 @@
+import asyncio
+import math
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+from py_data_acq.common.common_types import QueueData, QueueDataBatch
+from py_data_acq.common.derived_signals import DerivedSignalBus, DerivedSignalEngine, parse_definitions
+
+_SECOND = 1_000_000_000
+
+
+def _message_classes():
+    proto = descriptor_pb2.FileDescriptorProto(name="derived_test.proto", package="derived_test", syntax="proto3")
+    for name, field in (("volts", "v"), ("amps", "i")):
+        message = proto.message_type.add(name=name)
+        message.field.add(name=field, number=1, type=descriptor_pb2.FieldDescriptorProto.TYPE_FLOAT)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(proto)
+    return {
+        name: message_factory.GetMessageClass(pool.FindMessageTypeByName(f"derived_test.{name}"))
+        for name in ("volts", "amps")
+    }
+
+
+class _CollectingBus:
+    def __init__(self):
+        self.items = []
+
+    async def put(self, item):
+        self.items.append(item)
+
+
+def _derived(frames, batched):
+    classes = _message_classes()
+    engine = DerivedSignalEngine(
+        parse_definitions("power = Volts.V * Amps.I; energy = integrate(power); power_rate = rate(power)"),
+        classes,
+    )
+    bus = _CollectingBus()
+    derived_bus = DerivedSignalBus(bus, engine)
+
+    async def feed():
+        if not batched:
+            for name, value, timestamp in frames:
+                await derived_bus.put(QueueData(name, classes[name](**{_FIELDS[name]: value}), timestamp=timestamp))
+            return
+        # grouped by message the way the batch decoder hands them over
+        batch = QueueDataBatch()
+        for name in ("volts", "amps"):
+            rows = [(value, timestamp) for frame_name, value, timestamp in frames if frame_name == name]
+            batch.add_group(
+                name,
+                lambda value, name=name: classes[name](**{_FIELDS[name]: value}),
+                [[value for value, _ in rows]],
+                [timestamp for _, timestamp in rows],
+            )
+        await derived_bus.put(batch)
+
+    asyncio.run(feed())
+    outputs = []
+    for item in bus.items:
+        items = item if isinstance(item, QueueDataBatch) else [item]
+        outputs.extend(data for data in items if data.name == "derived_signals")
+    return [(data.timestamp, data.pb_msg.power, data.pb_msg.energy, data.pb_msg.power_rate) for data in outputs]
+
+
+_FIELDS = {"volts": "v", "amps": "i"}
+
+
+def test_batched_matches_unbatched():
+    # the two messages interleave, a batch holds them grouped by message
+    frames = []
+    for step in range(20):
+        frames.append(("volts", 300.0 + step, 2 * step * _SECOND // 10))
+        frames.append(("amps", 10.0 + step % 3, (2 * step + 1) * _SECOND // 10))
+
+    unbatched = _derived(frames, batched=False)
+    batched = _derived(frames, batched=True)
+
+    assert len(batched) == len(unbatched) == 2 * 20 - 1
+    for got, expected in zip(batched, unbatched):
+        assert got[0] == expected[0]
+        for got_value, expected_value in zip(got[1:], expected[1:]):
+            assert math.isclose(got_value, expected_value, rel_tol=1e-6)
+    timestamps = [output[0] for output in batched]
+    assert timestamps == sorted(timestamps)
+
+
+def _evaluate(spec, volts, amps):
+    classes = _message_classes()
+    engine = DerivedSignalEngine(parse_definitions(spec), classes)
+    engine.process(QueueData("volts", classes["volts"](v=volts), timestamp=1))
+    outputs = engine.process(QueueData("amps", classes["amps"](i=amps), timestamp=2))
+    return engine, outputs
+
+
+def test_modulo_by_zero_is_nan():
+    _, outputs = _evaluate("power = Volts.V % Amps.I", 300.0, 0.0)
+    assert math.isnan(outputs[0].pb_msg.power)
+
+
+def test_overflowing_power_is_nan():
+    _, outputs = _evaluate("power = Volts.V ** 2000 + Amps.I", 300.0, 1.0)
+    assert math.isnan(outputs[0].pb_msg.power)
+
+
+def test_complex_power_is_nan():
+    _, outputs = _evaluate("power = Amps.I ** 0.5 + Volts.V", 300.0, -4.0)
+    assert math.isnan(outputs[0].pb_msg.power)
+
+
+def test_raising_signal_is_skipped():
+    classes = _message_classes()
+    engine = DerivedSignalEngine(parse_definitions("power = Volts.V * Amps.I; current = Amps.I"), classes)
+
+    def broken(values, t):
+        raise ZeroDivisionError
+
+    engine.signals[0].evaluate = broken
+    errors = engine.errors.value
+    engine.process(QueueData("volts", classes["volts"](v=300.0), timestamp=1))
+    outputs = engine.process(QueueData("amps", classes["amps"](i=2.0), timestamp=2))
+    assert engine.errors.value == errors + 2
+    # the other signals still come out
+    assert [output.pb_msg.current for output in outputs] == [2.0]
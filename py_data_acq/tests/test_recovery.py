@@ -0,0 +1,95 @@
+import random
+
+import pytest
+from mcap.reader import make_reader
+from mcap.writer import CompressionType, Writer
+
+from py_data_acq.mcap_writer.recovery import recover_mcap
+
+
+def _recording(path, compression=CompressionType.ZSTD, chunk_size=2048, messages=2000):
+    with open(path, "wb") as output:
+        writer = Writer(output, chunk_size=chunk_size, compression=compression)
+        writer.start()
+        schema_id = writer.register_schema(name="test", encoding="jsonschema", data=b"{}")
+        channels = [
+            writer.register_channel(topic=f"topic_{i}", message_encoding="json", schema_id=schema_id)
+            for i in range(3)
+        ]
+        rng = random.Random(0)
+        for i in range(messages):
+            writer.add_message(
+                channel_id=channels[i % len(channels)],
+                log_time=i * 1000,
+                publish_time=i * 1000,
+                data=b'{"value": %d}' % rng.randrange(1 << 32),
+            )
+            if i == messages // 2:
+                writer.add_attachment(create_time=i, log_time=i, name="note", media_type="text/plain", data=b"halfway")
+                writer.add_metadata(name="info", data={"car": "test"})
+        writer.finish()
+    return path.read_bytes()
+
+
+def _recovered(path):
+    with open(path, "rb") as recovered:
+        reader = make_reader(recovered)
+        statistics = reader.get_summary().statistics
+        read = sum(1 for _ in reader.iter_messages())
+    return statistics.message_count, read
+
+
+@pytest.mark.parametrize("compression", [CompressionType.ZSTD, CompressionType.LZ4, CompressionType.NONE])
+def test_recover_cut_at_any_offset(tmp_path, compression):
+    recording = tmp_path / "recording.mcap"
+    data = _recording(recording, compression)
+    cut_path = tmp_path / "cut.mcap"
+    out_path = tmp_path / "recovered.mcap"
+
+    result = recover_mcap(str(recording), str(out_path))
+    assert result["complete"]
+    assert _recovered(out_path) == (2000, 2000)
+
+    rng = random.Random(1)
+    cuts = sorted({8, 9, 20, len(data) // 2, len(data) - 1} | {rng.randrange(8, len(data)) for _ in range(150)})
+    last = 0
+    for cut in cuts:
+        cut_path.write_bytes(data[:cut])
+        result = recover_mcap(str(cut_path), str(out_path))
+        # whatever comes back is a valid file that agrees with its own summary
+        assert _recovered(out_path) == (result["messages"], result["messages"]), cut
+        assert result["recovered_bytes"] <= cut
+        # cutting later never recovers less
+        assert result["messages"] >= last, cut
+        last = result["messages"]
+
+
+def test_recover_stops_at_padding_and_garbage(tmp_path):
+    recording = tmp_path / "recording.mcap"
+    data = _recording(recording)
+    cut = len(data) * 2 // 3
+    out_path = tmp_path / "recovered.mcap"
+    cut_path = tmp_path / "cut.mcap"
+    cut_path.write_bytes(data[:cut])
+    expected = recover_mcap(str(cut_path), str(out_path))["messages"]
+    assert expected > 0
+
+    # a preallocated file zero filled past what made it to disk
+    cut_path.write_bytes(data[:cut] + bytes(1 << 16))
+    recovered = recover_mcap(str(cut_path), str(out_path))
+    assert recovered["messages"] <= expected
+    assert _recovered(out_path) == (recovered["messages"], recovered["messages"])
+
+    # a record header claiming far more than the file holds
+    valid_end = recovered["recovered_bytes"]
+    cut_path.write_bytes(data[:valid_end] + bytes([0x06]) + (1 << 62).to_bytes(8, "little") + bytes(64))
+    recovered = recover_mcap(str(cut_path), str(out_path))
+    assert recovered["recovered_bytes"] == valid_end
+    assert _recovered(out_path) == (recovered["messages"], recovered["messages"])
+
+
+def test_recover_rejects_other_files(tmp_path):
+    path = tmp_path / "not.mcap"
+    path.write_bytes(b"hello world")
+    with pytest.raises(ValueError):
+        recover_mcap(str(path), str(tmp_path / "out.mcap"))
@@ -1,9 +1,22 @@
 #!/usr/bin/env python
 import cantools
 from cantools.database import can, conversion
+import argparse
+import keyword
+import re
 import sys
 import os
 
+# the python module with a pack function per message, written next to hytech.proto
+PACKERS_FILE = "hytech_pack.py"
+
+# what every integer proto type can hold
+_INT_RANGES = {
+    "int32": (-(2**31), 2**31 - 1),
+    "int64": (-(2**63), 2**63 - 1),
+    "uint64": (0, 2**64 - 1),
+}
+
 
 def create_field_name(name: str) -> str:
     replaced_text = name.replace(" ", "_")
@@ -12,97 +25,184 @@ def create_field_name(name: str) -> str:
     return replaced_text
 
 
-def append_proto_message_from_CAN_message(file, can_msg: can.message.Message):
+def proto_field_type(sig: can.signal.Signal) -> str:
     # if the msg has a conversion, we know that the value with be a float
+    if (
+        sig.is_float
+        or ((sig.scale is not None) and (sig.scale != 1.0))
+        or (
+            type(sig.conversion)
+            is not type(conversion.IdentityConversion(is_float=False))
+            and not type(
+                conversion.NamedSignalConversion(
+                    choices={}, scale=0, offset=0, is_float=False
+                )
+            )
+        )
+    ):
+        return "float"
+    elif sig.choices is not None:
+        return "string"
+    elif sig.length == 1:
+        return "bool"
+    elif (sig.length > 1 and sig.length <=32):
+        return "int32"
+    elif (sig.length >= 32 and not sig.is_signed):
+        return "uint64"
+    else:
+        return "int64"
+
+
+def append_proto_message_from_CAN_message(file, can_msg: can.message.Message):
     msgname = can_msg.name
     # type and then name
     file.write("message " + msgname.lower() + " {\n")
     line_index = 0
     for sig in can_msg.signals:
         line_index += 1
+        line = (
+            "    "
+            + proto_field_type(sig)
+            + " "
+            + create_field_name(sig.name)
+            + " = "
+            + str(line_index)
+            + ";"
+        )
+        file.write(line + "\n")
+    file.write("}\n\n")
+    return file
 
-        if (
-            sig.is_float
-            or ((sig.scale is not None) and (sig.scale != 1.0))
-            or (
-                type(sig.conversion)
-                is not type(conversion.IdentityConversion(is_float=False))
-                and not type(
-                    conversion.NamedSignalConversion(
-                        choices={}, scale=0, offset=0, is_float=False
-                    )
-                )
-            )
-        ):
-            line = (
-                "    float "
-                + create_field_name(sig.name)
-                + " = "
-                + str(line_index)
-                + ";"
-            )
-        elif sig.choices is not None:
-            line = (
-                "    string "
-                + create_field_name(sig.name)
-                + " = "
-                + str(line_index)
-                + ";"
-            )
-        elif sig.length == 1:
-            line = (
-                "    bool "
-                + create_field_name(sig.name)
-                + " = "
-                + str(line_index)
-                + ";"
-            )
-        elif (sig.length > 1 and sig.length <=32):
-            line = (
-                "    int32 "
-                + create_field_name(sig.name)
-                + " = "
-                + str(line_index)
-                + ";"
-            )
-        elif (sig.length >= 32 and not sig.is_signed):
-            line = (
-                "    uint64 "
-                + create_field_name(sig.name)
-                + " = "
-                + str(line_index)
-                + ";"
-            )
-        elif (sig.length >= 32 and not sig.is_signed):
-            line = (
-                "    uint64 "
-                + create_field_name(sig.name)
-                + " = "
-                + str(line_index)
-                + ";"
+
+def check_CAN_message(can_msg: can.message.Message) -> tuple[list, list]:
+    """(errors, warnings) about signals the proto fields cant hold, errors break the proto itself"""
+    errors = []
+    warnings = []
+    field_names = {}
+    for sig in can_msg.signals:
+        field_name = create_field_name(sig.name)
+        where = f"{can_msg.name}.{sig.name}"
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", field_name):
+            errors.append(f"{where}: {field_name} is not a valid proto field name")
+        if field_name in field_names:
+            errors.append(f"{where}: field name {field_name} is also used by {field_names[field_name]}")
+        field_names[field_name] = sig.name
+
+        field_type = proto_field_type(sig)
+        if field_type == "float" and sig.choices:
+            warnings.append(f"{where}: is a float field, its choices are dropped")
+        if field_type not in _INT_RANGES:
+            continue
+        if sig.offset != int(sig.offset):
+            warnings.append(f"{where}: offset {sig.offset} gets truncated in an {field_type} field")
+        raw_min, raw_max = (-(2 ** (sig.length - 1)), 2 ** (sig.length - 1) - 1) if sig.is_signed else (0, 2**sig.length - 1)
+        low, high = _INT_RANGES[field_type]
+        if raw_min + sig.offset < low or raw_max + sig.offset > high:
+            warnings.append(
+                f"{where}: values {raw_min + sig.offset} to {raw_max + sig.offset} dont fit an {field_type} field"
             )
+    return errors, warnings
+
+
+def _packer_name(msgname: str) -> str:
+    return "pack_" + re.sub(r"[^0-9a-z_]", "_", msgname)
+
+
+def _choices_name(can_msg: can.message.Message, sig: can.signal.Signal) -> str:
+    return re.sub(r"\W", "_", f"{can_msg.name}_{sig.name}_choices").upper()
+
+
+def append_packer_from_CAN_message(file, can_msg: can.message.Message):
+    """pack function for one message, straight assignments with the conversion each field needs"""
+    msgname = can_msg.name.lower()
+    constants = []
+    lines = []
+    for sig in can_msg.signals:
+        field_name = create_field_name(sig.name)
+        field_type = proto_field_type(sig)
+        value = f"decoded[{sig.name!r}]"
+        if field_type == "string":
+            choices = {
+                # cantools hands over the scaled value when it doesnt decode choices
+                (raw if sig.offset == 0 else raw + sig.offset): str(name)
+                for raw, name in sig.choices.items()
+            }
+            constants.append(f"{_choices_name(can_msg, sig)} = {choices!r}\n")
+            value = f"_choice_name({value}, {_choices_name(can_msg, sig)})"
+        elif field_type == "float":
+            value = f"float({value})"
+        elif field_type == "bool":
+            value = f"bool({value})"
         else:
-            line = (
-                "    int64 "
-                + create_field_name(sig.name)
-                + " = "
-                + str(line_index)
-                + ";"
-            )
-        file.write(line + "\n")
-    file.write("}\n\n")
+            value = f"int({value})"
+        if keyword.iskeyword(field_name):
+            line = f"setattr(pb_msg, {field_name!r}, {value})"
+        else:
+            line = f"pb_msg.{field_name} = {value}"
+        # multiplexed signals are only there for their multiplexer value
+        if sig.multiplexer_ids is not None:
+            lines.append(f"if {sig.name!r} in decoded:")
+            lines.append(f"    {line}")
+        else:
+            lines.append(line)
+
+    if constants:
+        file.write("".join(constants) + "\n\n")
+    file.write(f"def {_packer_name(msgname)}(decoded, pb_msg):\n")
+    for line in lines:
+        file.write(f"    {line}\n")
+    file.write("    return pb_msg\n\n\n")
     return file
 
 
-# load dbc file from the package location
+def write_packers(file, db, dbc_name: str):
+    file.write(f"# generated by dbc_to_proto.py from {dbc_name}, do not edit\n")
+    file.write("# every pack function takes the dict cantools decodes a message into and a new protobuf\n")
+    file.write("# message of the same name, and sets every field with the type hytech.proto gives it\n\n\n")
+    file.write("def _choice_name(value, names):\n")
+    file.write("    # a NamedSignalValue when cantools decoded the choices, the number when it didnt\n")
+    file.write("    if isinstance(value, (int, float)):\n")
+    file.write("        return names.get(value) or str(value)\n")
+    file.write("    return str(value)\n\n\n")
+    packed = []
+    for msg in db.messages:
+        # containers decode into a list of messages, those stay with the generic packer
+        if msg.is_container:
+            continue
+        append_packer_from_CAN_message(file, msg)
+        packed.append(msg.name.lower())
+    file.write("PACKERS = {\n")
+    for msgname in packed:
+        file.write(f"    {msgname!r}: {_packer_name(msgname)},\n")
+    file.write("}\n")
+    return file
+
 
-if len(sys.argv) > 1:
-    path_to_dbc = sys.argv[1]
-else:
-    path_to_dbc = os.environ.get("DBC_PATH")
-full_path = os.path.join(path_to_dbc, "car.dbc")
+# load dbc file from the package location
+parser = argparse.ArgumentParser(description="Write hytech.proto and " + PACKERS_FILE + " from car.dbc")
+parser.add_argument("dbc_path", nargs="?", default=os.environ.get("DBC_PATH"), help="directory with car.dbc, DBC_PATH if not given")
+parser.add_argument("--strict", action="store_true", help="fail on signals whose values dont fit their proto field")
+args = parser.parse_args()
+full_path = os.path.join(args.dbc_path, "car.dbc")
 db = cantools.database.load_file(full_path)
+
+# a DBC / proto mismatch shows up here once instead of as a conversion error on every frame
+errors = []
+warnings = []
+for msg in db.messages:
+    msg_errors, msg_warnings = check_CAN_message(msg)
+    errors += msg_errors
+    warnings += msg_warnings
+for warning in warnings:
+    print(f"warning: {warning}", file=sys.stderr)
+for error in errors:
+    print(f"error: {error}", file=sys.stderr)
+if errors or (args.strict and warnings):
+    sys.exit(1)
+
 with open("hytech.proto", "w+") as proto_file:
     proto_file.write('syntax = "proto3";\n\n')
     for msg in db.messages:
         proto_file = append_proto_message_from_CAN_message(proto_file, msg)
+with open(PACKERS_FILE, "w") as packers_file:
+    write_packers(packers_file, db, os.path.basename(full_path))